@@ -0,0 +1 @@
+"""Offline benchmarks for the Canopy webhook server hot paths."""
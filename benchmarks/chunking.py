@@ -0,0 +1,90 @@
+"""Benchmark the multi-resolution `TokenLengthChunker` against the previous
+per-size implementation.
+
+The previous implementation detokenized every chunk of every size separately. The
+benchmark chunks long Wikipedia articles with both and reports the CPU time and the
+peak traced memory of each.
+
+Usage:
+    python -m benchmarks.chunking --pages "World_War_II" "United_States"
+    python -m benchmarks.chunking --files article-1.txt article-2.txt
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Callable, List
+
+from canopy.knowledge_base.models import KBDocChunk
+from canopy.models.data_models import Document
+
+from src.knowledge import TokenLengthChunker
+from src.settings import LazyTokenizer
+from src.wikipedia import fetch_wiki_data
+
+SIZES = [64, 128, 256, 512]
+
+
+def legacy_chunk_single_document(document: Document) -> List[KBDocChunk]:
+    """The previous implementation: detokenize every chunk of every size."""
+    tokenizer = LazyTokenizer()
+    tokens = tokenizer.tokenize(document.text)
+    chunks = []
+    for size in [size for size in SIZES if size <= len(tokens)]:
+        for i in range(0, len(tokens), size):
+            chunks.append(
+                KBDocChunk(
+                    id=f"{document.id}-{size}-{i // size}",
+                    document_id=document.id,
+                    text=tokenizer.detokenize(tokens[i : i + size]),
+                    source=document.source,
+                    metadata=document.metadata,
+                )
+            )
+    return chunks
+
+
+def measure(name: str, chunk: Callable, documents: List[Document], repeat: int):
+    """Chunk every document `repeat` times and print the CPU time and peak memory."""
+    tracemalloc.start()
+    start = time.process_time()
+    num_chunks = 0
+    for _ in range(repeat):
+        for document in documents:
+            num_chunks += len(chunk(document))
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:>8}: {elapsed / repeat * 1000:8.1f} ms CPU per pass, "
+        f"{peak / 2**20:6.1f} MiB peak, {num_chunks // repeat} chunks"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", nargs="*", default=[], help="Wikipedia page titles")
+    parser.add_argument("--files", nargs="*", default=[], help="Saved article texts")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    texts = [fetch_wiki_data(page, should_filter=False)["content"] for page in args.pages]
+    for path in args.files:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    if not texts:
+        parser.error("Provide at least one page or file to chunk")
+
+    documents = [
+        Document(id=f"doc-{i}", text=text, metadata={"expert_name": "bench"})
+        for i, text in enumerate(texts)
+    ]
+    print(f"Chunking {len(documents)} documents, {sum(map(len, texts))} characters")
+
+    chunker = TokenLengthChunker()
+    measure("legacy", legacy_chunk_single_document, documents, args.repeat)
+    measure("single", chunker.chunk_single_document, documents, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark the snippet deduplication of `query_context` against the previous
+pairwise implementation.
+
+The previous implementation checked every snippet against every other snippet with
+`snippet in s`. The benchmark builds contexts of 10, 100 and 1000 snippets sampled
+from the overlapping 64, 128, 256 and 512 token chunks of synthetic documents, and
+times the pairwise check, the chunk lineage deduplication and the text fallback
+used for foreign chunk IDs. It also checks that they keep the same snippets.
+
+Usage:
+    python -m benchmarks.dedup
+    python -m benchmarks.dedup --counts 10 100 1000 5000 --repeat 3
+"""
+import argparse
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+from src.dedup import deduplicate_snippets
+
+SIZES = [64, 128, 256, 512]
+
+Snippets = List[Tuple[Optional[str], str]]
+
+
+def legacy_deduplicate(snippets: Snippets) -> List[str]:
+    """The previous implementation: check every pair of snippets."""
+    texts = [text for _, text in snippets]
+    return [
+        snippet
+        for snippet in texts
+        if not any(snippet in s for s in texts if s != snippet)
+    ]
+
+
+def make_snippets(count: int, seed: int = 0) -> Snippets:
+    """Sample `count` chunks of synthetic documents, in a random ranking order."""
+    rng = random.Random(seed)
+    chunks = []
+    for document_index in range(max(1, count // 20)):
+        # Every token is a distinct word, so that text containment matches lineage
+        tokens = [f"d{document_index}w{i} " for i in range(2048)]
+        for size in SIZES:
+            for i in range(0, len(tokens), size):
+                chunk_id = f"doc-{document_index}-{size}-{i // size}"
+                chunks.append((chunk_id, "".join(tokens[i : i + size])))
+    return rng.sample(chunks, min(count, len(chunks)))
+
+
+def measure(name: str, deduplicate: Callable, snippets: Snippets, repeat: int):
+    """Time the deduplication of the snippets and return the kept snippets."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        kept = deduplicate(snippets)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:>10}: {elapsed * 1000:9.2f} ms, {len(kept)} kept")
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", nargs="*", type=int, default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for count in args.counts:
+        snippets = make_snippets(count)
+        foreign = [(None, text) for _, text in snippets]
+        print(f"{len(snippets)} snippets")
+
+        expected = measure("legacy", legacy_deduplicate, snippets, args.repeat)
+        assert measure("lineage", deduplicate_snippets, snippets, args.repeat) == expected
+        assert measure("fallback", deduplicate_snippets, foreign, args.repeat) == expected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark the embedding dispatcher against callers that embed independently.
+
+Many concurrent callers embed a few texts each through a `RateLimitedEmbeddings`
+service, which throttles the calls over its limits like the OpenAI API does:
+    - `independent`: every caller makes its own call, and backs off on its own,
+      exponentially, when it is throttled, as the encoders did without the
+      dispatcher
+    - `dispatcher`: every caller goes through an `EmbeddingDispatcher` configured
+      with the limits of the service
+    - `overlimit`: the same, with the limits of the dispatcher set `--overlimit`
+      times higher than those of the service, so that it has to back off
+
+The benchmark reports the calls made, how many were throttled and the time taken,
+and checks that every caller got the embeddings of its own texts.
+
+Usage:
+    python -m benchmarks.embedding
+    python -m benchmarks.embedding --callers 500 --texts 4 --requests 20 --overlimit 8
+"""
+import argparse
+import asyncio
+import time
+from typing import Callable, List
+
+from benchmarks.fakes import HashingRecordEncoder, RateLimitedEmbeddings, make_text
+from src.dispatcher import EmbeddingDispatcher, Throttled
+
+
+async def independent(service: RateLimitedEmbeddings, texts: List[str]):
+    """Embed texts with one call, backing off alone while throttled."""
+    delay = 0.05
+    while True:
+        try:
+            return await service.embed_batch(texts)
+        except Throttled:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+
+async def run(name: str, embed: Callable, service, texts: List[List[str]]):
+    """Embed the texts of every caller concurrently and check the results."""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(embed(caller_texts) for caller_texts in texts))
+    elapsed = time.perf_counter() - start
+
+    # pylint: disable-next=protected-access
+    embed_text = HashingRecordEncoder()._embed_text
+    for caller_texts, vectors in zip(texts, results):
+        assert vectors == [embed_text(text) for text in caller_texts]
+    print(
+        f"{name:>12}: {len(service.batches):5d} calls, {service.throttled:5d} "
+        f"throttled, {elapsed:6.2f} s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--callers", type=int, default=100)
+    parser.add_argument("--texts", type=int, default=3, help="Texts per caller")
+    parser.add_argument("--words", type=int, default=60, help="Words per text")
+    parser.add_argument("--requests", type=int, default=10, help="Calls per period")
+    parser.add_argument("--tokens", type=int, default=10000, help="Tokens per period")
+    parser.add_argument("--period", type=float, default=1.0, help="In seconds")
+    parser.add_argument("--latency", type=float, default=0.02, help="Of every call")
+    parser.add_argument("--overlimit", type=float, default=4.0)
+    args = parser.parse_args()
+
+    texts = [
+        [
+            make_text(args.words, seed=caller * args.texts + i)
+            for i in range(args.texts)
+        ]
+        for caller in range(args.callers)
+    ]
+
+    def service():
+        return RateLimitedEmbeddings(
+            args.requests, args.tokens, args.period, args.latency
+        )
+
+    async def compare():
+        direct = service()
+        await run("independent", lambda t: independent(direct, t), direct, texts)
+
+        for name, factor in [("dispatcher", 1.0), ("overlimit", args.overlimit)]:
+            shared = service()
+            per_minute = 60 / args.period * factor
+            dispatcher = EmbeddingDispatcher(
+                requests_per_minute=args.requests * per_minute,
+                tokens_per_minute=args.tokens * per_minute,
+                burst_seconds=args.period,
+            )
+            await run(
+                name,
+                # pylint: disable-next=cell-var-from-loop
+                lambda t: dispatcher.embed("hashing", t, shared.embed_batch),
+                shared,
+                texts,
+            )
+
+    asyncio.run(compare())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Offline stand-ins for the external services, used by the benchmarks.
+
+    - `InMemoryIndex` is an in-memory `LocalIndex` that counts the vectors read.
+    - `HashingRecordEncoder` embeds texts as hashed bags of words instead of
+      calling OpenAI, so that word overlap drives relevance.
+    - `OfflineKnowledgeBase` is an `ExpertKnowledgeBase` wired to both.
+    - `use_hashing_embeddings` makes every `ExpertRecordEncoder` embed texts like
+      the `HashingRecordEncoder`, for code paths that build their own encoders.
+    - `RateLimitedEmbeddings` is an embedding service with request and token
+      limits per period, which throttles the calls over them like the OpenAI API.
+    - `WordTokenizer` splits texts into words instead of loading the OpenAI
+      encoding, which is downloaded on first use.
+    - `FakeWikiClient` serves the same HTML for every Wikipedia page.
+"""
+import asyncio
+import math
+import random
+import re
+import time
+from collections import deque
+from hashlib import blake2b
+from typing import Deque, Dict, List, Tuple
+
+from canopy.tokenizer.base import BaseTokenizer
+
+from src.dispatcher import Throttled, estimate_tokens
+from src.embedding import ExpertRecordEncoder
+from src.knowledge import ExpertKnowledgeBase
+from src.local_index import LocalIndex
+from src.wiki_client import WikiPage
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class InMemoryIndex(LocalIndex):
+    """An in-memory `LocalIndex` that counts the vectors it reads."""
+
+    def __init__(self):
+        super().__init__(path=None)
+
+        # The number of vectors returned by queries and fetches
+        self.vectors_read = 0
+
+    def query_batch(self, *args, **kwargs) -> List[Dict]:
+        results = super().query_batch(*args, **kwargs)
+        self.vectors_read += sum(len(result["matches"]) for result in results)
+        return results
+
+    def fetch(self, *args, **kwargs) -> Dict:
+        response = super().fetch(*args, **kwargs)
+        self.vectors_read += len(response["vectors"])
+        return response
+
+
+class HashingRecordEncoder(ExpertRecordEncoder):
+    """A record encoder that embeds texts as normalized, hashed bags of words."""
+
+    def __init__(self, dimension: int = 512):
+        super().__init__(model_name="hashing", cache=None)
+        self.dimension = dimension
+
+    def _embed_text(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in WORD_PATTERN.findall(text.lower()):
+            digest = blake2b(word.encode("utf-8"), digest_size=4).digest()
+            vector[int.from_bytes(digest, "little") % self.dimension] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed_text(text) for text in texts]
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_batch(texts)
+
+
+class OfflineKnowledgeBase(ExpertKnowledgeBase):
+    """An `ExpertKnowledgeBase` backed by an `InMemoryIndex` and hashed embeddings."""
+
+    def __init__(self, index: InMemoryIndex, **kwargs):
+        self._offline_index = index
+        super().__init__(**kwargs)
+        self._encoder = HashingRecordEncoder()
+
+    def connect(self):
+        self._index = self._offline_index
+
+    def _is_serverless_env(self):
+        return False
+
+
+def use_hashing_embeddings(dimension: int = 512) -> None:
+    """Make every `ExpertRecordEncoder` embed texts as hashed bags of words."""
+    encoder = HashingRecordEncoder(dimension)
+
+    async def aembed_batch(_, texts: List[str]) -> List[List[float]]:
+        return encoder._embed_batch(texts)  # pylint: disable=protected-access
+
+    ExpertRecordEncoder._embed_batch = lambda _, texts: encoder._embed_batch(texts)
+    ExpertRecordEncoder._aembed_batch = aembed_batch
+
+
+class RateLimitedEmbeddings:
+    """An embedding service that accepts at most `requests` calls and `tokens`
+    tokens per `period` seconds, and embeds texts as hashed bags of words."""
+
+    def __init__(
+        self,
+        requests: int,
+        tokens: int,
+        period: float = 60.0,
+        latency: float = 0.0,
+        dimension: int = 512,
+    ):
+        self.requests = requests
+        self.tokens = tokens
+        self.period = period
+        self.latency = latency
+        self._encoder = HashingRecordEncoder(dimension)
+
+        # The time and tokens of the accepted calls of the current period
+        self._window: Deque[Tuple[float, int]] = deque()
+        # The number of texts of every accepted call
+        self.batches: List[int] = []
+        self.throttled = 0
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts with one call, raising `Throttled` over the limits."""
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self._window and self._window[0][0] <= now - self.period:
+            self._window.popleft()
+
+        tokens = sum(estimate_tokens(text) for text in texts)
+        used = sum(spent for _, spent in self._window)
+        if len(self._window) >= self.requests or used + tokens > self.tokens:
+            self.throttled += 1
+            retry_after = self._window[0][0] + self.period - now if self._window else 0
+            raise Throttled("Rate limit reached", retry_after=retry_after)
+
+        self._window.append((now, tokens))
+        self.batches.append(len(texts))
+        return self._encoder._embed_batch(texts)  # pylint: disable=protected-access
+
+
+class WordTokenizer(BaseTokenizer):
+    """A tokenizer whose tokens are words with their trailing whitespace."""
+
+    TOKEN_PATTERN = re.compile(r"^\s+|\S+\s*")
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.TOKEN_PATTERN.findall(text)
+
+    def detokenize(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+    def messages_token_count(self, messages) -> int:
+        return sum(self.token_count(message.content) + 3 for message in messages)
+
+
+class FakeWikiClient:
+    """A Wikipedia client that serves the same HTML for every page."""
+
+    def __init__(self, html: str):
+        self.html = html
+
+    def fetch_page(self, page: str) -> WikiPage:
+        digest = blake2b(page.encode("utf-8"), digest_size=4).digest()
+        pageid = int.from_bytes(digest, "little")
+        return WikiPage(title=page, pageid=pageid, revid=1, html=self.html)
+
+
+def make_text(num_words: int, seed: int = 0, vocabulary: int = 5000) -> str:
+    """Make a deterministic text of sentences drawn from a fixed vocabulary."""
+    rng = random.Random(seed)
+    words = [f"word{rng.randrange(vocabulary)}" for _ in range(num_words)]
+    return " ".join(
+        " ".join(words[i : i + 12]) + "." for i in range(0, len(words), 12)
+    )
+
+
+def make_html(num_paragraphs: int, seed: int = 0) -> str:
+    """Make a deterministic page that looks like a rendered Wikipedia article."""
+    rng = random.Random(seed)
+    parts = ['<html><body><div class="mw-parser-output">']
+    for i in range(num_paragraphs):
+        text = make_text(rng.randrange(40, 160), seed=seed * 100003 + i)
+        parts.append(f'<p>{text} <a href="/wiki/Link_{i}">link <b>{i}</b></a>.</p>')
+        if i % 10 == 0:
+            parts.append(
+                "<table><tr><td>cell</td><td>value</td></tr></table>"
+                "<style>.mw-parser-output p { margin: 0 }</style>"
+            )
+    parts.append("</div></body></html>")
+    return "\n".join(parts)
@@ -0,0 +1,79 @@
+"""Compare the flat and the hierarchical retrieval modes on an offline relevance
+fixture.
+
+The fixture (`benchmarks/relevance.json`) holds documents about fictional islands,
+each hiding a few facts among filler sentences, and one query per fact with the
+answer it should retrieve. Both modes run against an in-memory index with hashed
+bag-of-words embeddings, so the benchmark needs no network access. For every token
+budget it reports the share of queries whose answer made it into the context, the
+tokens and snippets of the context, and the number of vectors read from the index.
+
+Usage:
+    python -m benchmarks.hierarchy
+    python -m benchmarks.hierarchy --budgets 256 512 1024 --top-k 8
+"""
+import argparse
+import json
+import os
+
+from benchmarks.fakes import InMemoryIndex, OfflineKnowledgeBase
+from src.context import ExpertContextEngine
+from src.hierarchy import FLAT, HIERARCHICAL
+from src.partition import PartitionedDocument, PartitionedQuery
+from src.query import _format_context
+from src.settings import LazyTokenizer
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), "relevance.json")
+
+
+def evaluate(knowledge_base, index, fixture, budget: int, top_k: int):
+    """Run every fixture query and print the relevance and cost of the contexts."""
+    tokenizer = LazyTokenizer()
+    context_engine = ExpertContextEngine(knowledge_base)
+    found = tokens = snippets = 0
+    index.vectors_read = 0
+    for item in fixture["queries"]:
+        query = PartitionedQuery(item["query"], item["partition_name"], top_k=top_k)
+        response = context_engine.query([query], max_context_tokens=budget)
+        context = _format_context(response)
+
+        found += item["answer"] in context
+        tokens += tokenizer.token_count(context)
+        snippets += len(context.splitlines())
+
+    count = len(fixture["queries"])
+    print(
+        f"{knowledge_base.retrieval_mode:>12} @ {budget:>4} tokens: "
+        f"recall {found / count:5.2f}, {tokens / count:6.1f} tokens, "
+        f"{snippets / count:4.1f} snippets, {index.vectors_read / count:5.1f} vectors read"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budgets", nargs="*", type=int, default=[256, 512, 1024])
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(FIXTURE_PATH, "r", encoding="utf-8") as f:
+        fixture = json.load(f)
+
+    index = InMemoryIndex()
+    knowledge_bases = [
+        OfflineKnowledgeBase(index, index_name="relevance", retrieval_mode=mode)
+        for mode in (FLAT, HIERARCHICAL)
+    ]
+    knowledge_bases[0].upsert(
+        [
+            PartitionedDocument(document["partition_name"], document["content"])
+            for document in fixture["documents"]
+        ]
+    )
+
+    for budget in args.budgets:
+        for knowledge_base in knowledge_bases:
+            evaluate(knowledge_base, index, fixture, budget, args.top_k)
+
+
+if __name__ == "__main__":
+    main()
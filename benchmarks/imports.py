@@ -0,0 +1,77 @@
+"""Benchmark the cold-start import time of the server.
+
+Every run imports the module in a fresh interpreter, so nothing is cached in
+`sys.modules`, and reports the median wall time of the import. The last run is made
+with `-X importtime` to list the modules that take the longest to import,
+cumulatively, which is where cold-start regressions show up.
+
+Importing must not need the network, credentials or a database: the settings, the
+tokenizer and the database engine are initialized on first use.
+
+Usage:
+    python -m benchmarks.imports
+    python -m benchmarks.imports --module src.knowledge --repeat 10 --top 20
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Times the import of a module, in a fresh interpreter
+TIMER = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def time_import(module: str) -> float:
+    """Import the module in a fresh interpreter and return the import time."""
+    output = subprocess.run(
+        [sys.executable, "-c", TIMER.format(module=module)],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, top: int) -> List[Tuple[int, str]]:
+    """Return the cumulative import time, in microseconds, of the slowest modules."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stderr
+
+    # Lines look like `import time:   self [us] | cumulative | imported package`
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        timings.append((int(cumulative), name.rstrip()))
+    return sorted(timings, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="src.server")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    timings = [time_import(args.module) for _ in range(args.repeat)]
+    print(
+        f"import {args.module}: median {statistics.median(timings) * 1000:.0f} ms, "
+        f"min {min(timings) * 1000:.0f} ms over {args.repeat} runs"
+    )
+
+    print("\nSlowest imports (cumulative):")
+    for cumulative, name in slowest_imports(args.module, args.top):
+        print(f"{cumulative / 1000:9.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
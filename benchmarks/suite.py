@@ -0,0 +1,360 @@
+"""Run the offline benchmark suite of the ingestion and query hot paths.
+
+Every case runs against deterministic stand-ins (see `benchmarks/fakes.py`), so the
+suite needs no network access or credentials:
+    - `chunk`: `TokenLengthChunker.chunk_single_document` on synthetic documents
+    - `wiki_parse`: `fetch_wiki_data` on saved or synthetic Wikipedia HTML
+    - `hash`: creating a `PartitionedDocument`, which hashes its content
+    - `dedup`: the snippet deduplication of `query_context`
+    - `document` and `context`: `PUT /document` and `GET /context` through a local
+      ASGI client, with hashed embeddings, an in-memory local index and a
+      temporary SQLite database
+
+Texts are tokenized into words by default, since the OpenAI encoding is downloaded
+on first use. Pass `--openai-tokenizer` to measure the production tokenizer.
+
+For every case the suite reports the throughput of the fastest of several rounds,
+the latency percentiles and the peak traced memory (measured in a separate,
+shorter pass, since tracing slows the code down). Results are compared against a
+stored baseline: a case regresses when its throughput drops, or its peak memory
+grows, by more than the tolerance, and the suite then exits with status 1.
+Baselines depend on the machine, so save one on the machine that runs the
+comparison.
+
+Usage:
+    python -m benchmarks.suite
+    python -m benchmarks.suite --cases chunk dedup --ops 500
+    python -m benchmarks.suite --save-baseline
+"""
+import os
+import tempfile
+
+# The directory of the SQLite database, removed when the suite exits
+_DATABASE_DIR = tempfile.TemporaryDirectory(prefix="canopy-bench-")
+
+# Run against an in-memory local index, a temporary SQLite database and no disk
+# caches. The environment is read when the modules of src are imported.
+OFFLINE_ENV = {
+    "INDEX_NAME": "bench",
+    "LOCAL_INDEXES": "bench",
+    "LOCAL_INDEX_PATH": "",
+    "POSTGRESQL_DATABASE_URL": f"sqlite:///{_DATABASE_DIR.name}/bench.db",
+    "EMBEDDING_CACHE_PATH": "",
+    # Hashed embeddings are not rate limited
+    "EMBEDDING_RPM": "0",
+    "EMBEDDING_TPM": "0",
+    "QUERY_CACHE_URL": "",
+    "PINECONE_API_KEY": "offline",
+    "PINECONE_ENVIRONMENT": "offline",
+    "OPENAI_API_KEY": "offline",
+    "SLOW_REQUEST_SECONDS": "inf",
+}
+os.environ.update(OFFLINE_ENV)
+
+# pylint: disable=wrong-import-position
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+import httpx
+from canopy.models.data_models import Document
+from canopy.tokenizer import Tokenizer
+
+from benchmarks.dedup import make_snippets
+from benchmarks.fakes import (
+    FakeWikiClient,
+    WordTokenizer,
+    make_html,
+    make_text,
+    use_hashing_embeddings,
+)
+from src import models, wikipedia
+from src.dedup import deduplicate_snippets
+from src.knowledge import TokenLengthChunker
+from src.partition import PartitionedDocument
+from src.server import app
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# The number of partitions the end-to-end cases write to and query
+PARTITIONS = 20
+
+# An operation of a case, called with the index of the operation
+Operation = Callable[[int], Union[None, Awaitable[None]]]
+
+
+@dataclass
+class CaseResult:
+    """The measurements of a benchmark case."""
+
+    ops: int
+    ops_per_second: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    peak_mib: float
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """Get a percentile of the latencies, in milliseconds."""
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+
+async def _run(operation: Operation, start: int, ops: int, concurrency: int):
+    """Run the operations and return their latencies and the total time."""
+    latencies: List[float] = []
+    is_async = asyncio.iscoroutinefunction(operation)
+    indices = iter(range(start, start + ops))
+
+    async def worker():
+        for i in indices:
+            begin = time.perf_counter()
+            if is_async:
+                await operation(i)
+            else:
+                operation(i)
+            latencies.append(time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency if is_async else 1)))
+    return latencies, time.perf_counter() - begin
+
+
+async def measure(
+    operation: Operation, ops: int, rounds: int, concurrency: int, memory_ops: int
+) -> CaseResult:
+    """Time a case, then trace its peak memory over fresh operations.
+
+    The throughput is the one of the fastest round, which is the least disturbed
+    by the rest of the machine. The latency percentiles cover every round.
+    """
+    latencies: List[float] = []
+    fastest = float("inf")
+    for round_index in range(rounds):
+        round_latencies, elapsed = await _run(
+            operation, round_index * ops, ops, concurrency
+        )
+        latencies.extend(round_latencies)
+        fastest = min(fastest, elapsed)
+
+    tracemalloc.start()
+    await _run(operation, rounds * ops, min(ops, memory_ops), concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return CaseResult(
+        ops=ops,
+        ops_per_second=ops / fastest,
+        p50_ms=percentile(latencies, 0.50),
+        p95_ms=percentile(latencies, 0.95),
+        p99_ms=percentile(latencies, 0.99),
+        peak_mib=peak / 2**20,
+    )
+
+
+async def setup_chunk(args) -> Operation:
+    documents = [
+        Document(id=f"doc-{i}", text=make_text(args.words, seed=i), metadata={})
+        for i in range(8)
+    ]
+    chunker = TokenLengthChunker()
+    return lambda i: chunker.chunk_single_document(documents[i % len(documents)])
+
+
+async def setup_wiki_parse(args) -> Operation:
+    pages = []
+    for path in args.html:
+        with open(path, "r", encoding="utf-8") as f:
+            pages.append(f.read())
+    clients = [FakeWikiClient(html) for html in pages or [make_html(300)]]
+
+    def operation(i: int) -> None:
+        wikipedia.wiki_client = clients[i % len(clients)]
+        wikipedia.fetch_wiki_data(f"Page_{i}")
+
+    return operation
+
+
+async def setup_hash(args) -> Operation:
+    contents = [make_text(args.words, seed=i) for i in range(16)]
+    return lambda i: PartitionedDocument("bench:doc", contents[i % len(contents)])
+
+
+async def setup_dedup(args) -> Operation:
+    snippets = make_snippets(args.snippets)
+    return lambda i: deduplicate_snippets(snippets)
+
+
+def _client() -> httpx.AsyncClient:
+    """A client that calls the app in process, without a network."""
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench"
+    )
+
+
+async def _put_document(client: httpx.AsyncClient, i: int, words: int) -> None:
+    response = await client.put(
+        "/document",
+        json={
+            "content": make_text(words, seed=100000 + i),
+            "partition_name": f"bench:doc{i % PARTITIONS}",
+            "chunk_size": 0,
+        },
+    )
+    response.raise_for_status()
+
+
+async def setup_document(args) -> Operation:
+    client = _client()
+
+    async def operation(i: int) -> None:
+        await _put_document(client, i, args.document_words)
+
+    return operation
+
+
+async def setup_context(args) -> Operation:
+    client = _client()
+    await asyncio.gather(
+        *(_put_document(client, -1 - i, args.document_words) for i in range(PARTITIONS))
+    )
+
+    async def operation(i: int) -> None:
+        # Every query is new, so that it is not answered by the query cache
+        response = await client.get(
+            "/context",
+            params={
+                "query": f"word{i} word{i * 7 + 1}",
+                "partition_name": f"bench:doc{i % PARTITIONS}",
+                "max_context_tokens": 512,
+            },
+        )
+        response.raise_for_status()
+
+    return operation
+
+
+CASES: Dict[str, Callable[[argparse.Namespace], Awaitable[Operation]]] = {
+    "chunk": setup_chunk,
+    "wiki_parse": setup_wiki_parse,
+    "hash": setup_hash,
+    "dedup": setup_dedup,
+    "document": setup_document,
+    "context": setup_context,
+}
+
+# The cases whose operations are HTTP requests, run with the given concurrency
+END_TO_END_CASES = {"document", "context"}
+
+
+def environment() -> Dict:
+    """Describe the machine, to tell whether a baseline is comparable."""
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(
+    results: Dict[str, CaseResult], baseline: Dict, tolerance: float
+) -> List[str]:
+    """Print the change of every case against the baseline and list regressions."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            print(f"{name:>12}: not in the baseline")
+            continue
+
+        throughput = result.ops_per_second / base["ops_per_second"] - 1
+        memory = result.peak_mib / base["peak_mib"] - 1 if base["peak_mib"] else 0.0
+        regressed = throughput < -tolerance or memory > tolerance
+        print(
+            f"{name:>12}: {throughput:+7.1%} ops/s, {memory:+7.1%} peak memory"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+async def run_suite(args) -> Dict[str, CaseResult]:
+    """Run the selected cases and print their results."""
+    if not args.openai_tokenizer:
+        Tokenizer.initialize(WordTokenizer)
+    use_hashing_embeddings()
+    models.create_tables()
+
+    results = {}
+    for name in args.cases:
+        operation = await CASES[name](args)
+        concurrency = args.concurrency if name in END_TO_END_CASES else 1
+        result = await measure(
+            operation, args.ops, args.rounds, concurrency, args.memory_ops
+        )
+        results[name] = result
+        print(
+            f"{name:>12}: {result.ops_per_second:10.1f} ops/s, "
+            f"p50 {result.p50_ms:8.2f} ms, p95 {result.p95_ms:8.2f} ms, "
+            f"p99 {result.p99_ms:8.2f} ms, {result.peak_mib:7.2f} MiB peak"
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="*", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--ops", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--memory-ops", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--words", type=int, default=4000)
+    parser.add_argument("--document-words", type=int, default=600)
+    parser.add_argument("--snippets", type=int, default=100)
+    parser.add_argument("--html", nargs="*", default=[], help="Saved Wikipedia HTML")
+    parser.add_argument("--openai-tokenizer", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run_suite(args))
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "cases": {name: asdict(result) for name, result in results.items()},
+                },
+                f,
+                indent=2,
+            )
+        print(f"Saved the baseline to {args.baseline}")
+        return
+
+    baseline: Optional[Dict] = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    if baseline is None:
+        print("No baseline to compare against, save one with --save-baseline")
+        return
+
+    if baseline.get("environment") != environment():
+        print(f"The baseline was saved on another machine: {baseline['environment']}")
+    print(f"\nCompared to {args.baseline} (tolerance {args.tolerance:.0%}):")
+    if compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
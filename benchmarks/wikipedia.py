@@ -0,0 +1,109 @@
+"""Benchmark the streaming Wikipedia paragraph extractor against the previous
+tree-based implementation.
+
+The previous implementation built the whole lxml tree, ran `xpath('//p')` and built
+the text with repeated string concatenation. The benchmark runs each implementation
+in its own process over saved HTML fixtures and reports the throughput and the peak
+RSS of that process.
+
+Usage:
+    python -m benchmarks.wikipedia --save "World_War_II" "United_States"
+    python -m benchmarks.wikipedia benchmarks/fixtures/*.html
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import List
+
+from lxml import html
+
+from src.wiki_client import wiki_client
+from src.wikipedia import extract_text
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def legacy_extract_text(raw_html: str, should_filter: bool = True) -> str:
+    """The previous implementation of the paragraph extraction."""
+    document = html.document_fromstring(raw_html)
+
+    text = ""
+    for p in document.xpath("//p"):
+        line = p.text_content()
+        if should_filter:
+            stopwords = ["is", "a", "at", "is", "the"]
+            querytext = line.split()
+
+            result = [word for word in querytext if word.lower() not in stopwords]
+            text += " ".join(result)
+        else:
+            text += line
+    return text
+
+
+IMPLEMENTATIONS = {"legacy": legacy_extract_text, "streaming": extract_text}
+
+
+def save_fixtures(pages: List[str]) -> None:
+    """Download the raw HTML of the given pages into the fixtures directory."""
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for page, wiki_page in wiki_client.fetch_pages(pages).items():
+        path = os.path.join(FIXTURES_DIR, f"{page}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(wiki_page.html)
+        print(f"Saved {path}")
+
+
+def run(name: str, paths: List[str], repeat: int) -> None:
+    """Run one implementation over the fixtures and print its results."""
+    extract = IMPLEMENTATIONS[name]
+    size = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                raw_html = f.read()
+            size += len(raw_html)
+            extract(raw_html)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{name:>10}: {size / elapsed / 2**20:7.1f} MiB/s, "
+        f"{elapsed / repeat * 1000:8.1f} ms per pass, {peak_rss:6.1f} MiB peak RSS"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="Saved HTML fixtures")
+    parser.add_argument("--save", nargs="*", default=[], help="Pages to download")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--impl", choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.save:
+        save_fixtures(args.save)
+        return
+    if not args.paths:
+        parser.error("Provide at least one saved HTML fixture")
+
+    if args.impl:
+        run(args.impl, args.paths, args.repeat)
+        return
+
+    # Run every implementation in a fresh process so that the peak RSS is its own
+    for name in IMPLEMENTATIONS:
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.wikipedia", "--impl", name,
+             "--repeat", str(args.repeat), *args.paths],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,73 @@
-import glob
-from typing import Dict, List
+"""Load a corpus of text files into the knowledge base.
 
+Every file is stored under the partition `expert_name:file_name`. Progress is
+checkpointed, so running the same command again after an interruption only
+stores the files that are not stored yet (see `src/loader.py`).
 
-from src.knowledge import store_document
+Usage:
+    python main.py
+    python main.py data/corpus "data/extra/**/*.txt" --expert physics --chunk-size 256
+    python main.py data/corpus --workers 8 --concurrency 8 --restart
+"""
+import argparse
+import asyncio
+import sys
 
-
-def load_files() -> List[Dict[str, str]]:
-    """Load the sample documents from the data directory."""
-    file_paths = glob.glob("data/sample-docs/*")
-
-    documents = []
-    # Create a document for each file
-    for f_path in file_paths:
-        name = f_path.split("/")[-1]  # Get the file name
-
-        # Read the context of the file into a Document object
-        with open(f_path, "r", encoding="utf-8") as f:
-            text = f.read()
-        partition_name = f"physics:{name}"
-        documents.append({"text": text, "partition_name": partition_name})
-
-    return documents
+from src.loader import (
+    DEFAULT_BATCH_FILES,
+    DEFAULT_CHECKPOINT_PATH,
+    DEFAULT_CONCURRENCY,
+    load_corpus,
+)
 
 
 def main():
-    """Main function.
+    """Load the files given on the command line into the knowledge base."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=["data/sample-docs/*"],
+        help="Directories, searched recursively, or glob patterns",
+    )
+    parser.add_argument("--expert", default="physics")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=0,
+        help="Chunk size in tokens, 0 to chunk at 64, 128, 256 and 512 tokens",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="Chunking processes, 0 for one per CPU"
+    )
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--batch-files", type=int, default=DEFAULT_BATCH_FILES)
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH)
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint")
+    args = parser.parse_args()
 
-    Currently we are showing an example of how to load documents into the knowledge base.
-    """
-    # Load the sample documents
-    documents = load_files()
+    report = asyncio.run(
+        load_corpus(
+            args.paths,
+            args.expert,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            concurrency=args.concurrency,
+            batch_files=args.batch_files,
+            checkpoint_path=args.checkpoint,
+            restart=args.restart,
+        )
+    )
 
-    for doc in documents:
-        store_document(doc["text"], doc["partition_name"])
+    for path, error in report.errors.items():
+        print(f"Failed to store {path}: {error}")
+    print(
+        f"Stored {report.stored} files ({report.chunks} chunks) in "
+        f"{report.seconds:.1f}s, skipped {report.skipped} already stored files, "
+        f"{len(report.errors)} failed"
+    )
+    if report.errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
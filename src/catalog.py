@@ -0,0 +1,230 @@
+"""The catalog.py file defines the partition catalog.
+
+The catalog records which documents are stored under every partition and how many
+chunks each of them has, in the `partition_documents` table. Together with the
+`files` table, indexed on `(partition, filename)`, it answers partition existence
+checks and per-partition statistics with index lookups instead of table scans,
+and lists the documents to remove when a partition is deleted.
+
+Catalog writes happen after the chunks are stored. A failed catalog write is
+logged and does not fail the store, since the chunks are already searchable.
+"""
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func
+
+from src import models
+from src.database import SessionLocal
+from src.metrics import log, stage
+from src.partition import Partition, get_partition
+
+# A catalog entry: the partition name, the document ID and the number of chunks
+CatalogEntry = Tuple[str, str, int]
+
+
+class PartitionCatalog:
+    """The documents and chunk counts of every partition."""
+
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+
+    @staticmethod
+    def _documents(db, partition: Partition):
+        """Query the catalog rows of a partition."""
+        rows = db.query(models.PartitionDocument).filter(
+            models.PartitionDocument.expert_name == partition.expert_name
+        )
+        if partition.document_name is not None:
+            rows = rows.filter(
+                models.PartitionDocument.document_name == partition.document_name
+            )
+        return rows
+
+    @staticmethod
+    def _files(db, partition: Partition):
+        """Query the `files` rows of a partition."""
+        rows = db.query(models.File).filter(
+            models.File.partition == partition.expert_name
+        )
+        if partition.document_name is not None:
+            rows = rows.filter(models.File.filename == partition.document_name)
+        return rows
+
+    def record(self, entries: List[CatalogEntry]) -> None:
+        """Record the stored documents and their chunk counts.
+
+        Args:
+            entries (List[CatalogEntry]): The partition name, document ID and chunk
+                count of every stored document
+        """
+        if not entries:
+            return
+
+        db = self._session_factory()
+        try:
+            for partition_name, document_id, chunk_count in entries:
+                partition = get_partition(partition_name)
+                db.merge(
+                    models.PartitionDocument(
+                        expert_name=partition.expert_name,
+                        document_name=partition.document_name or "",
+                        document_id=document_id,
+                        chunk_count=chunk_count,
+                    )
+                )
+            with stage("db_commit"):
+                db.commit()
+        except Exception as exp:  # pylint: disable=broad-except
+            db.rollback()
+            log(f"Failed to record {len(entries)} documents in the catalog: {exp}")
+        finally:
+            db.close()
+
+    def replace(self, partition_name: str, document_id: str, chunk_count: int) -> None:
+        """Record a keyed document as the only document of its partition.
+
+        Args:
+            partition_name (str): The partition name
+            document_id (str): The ID of the document
+            chunk_count (int): The number of chunks of the document
+        """
+        partition = get_partition(partition_name)
+        db = self._session_factory()
+        try:
+            self._documents(db, partition).filter(
+                models.PartitionDocument.document_id != document_id
+            ).delete(synchronize_session=False)
+            db.merge(
+                models.PartitionDocument(
+                    expert_name=partition.expert_name,
+                    document_name=partition.document_name or "",
+                    document_id=document_id,
+                    chunk_count=chunk_count,
+                )
+            )
+            with stage("db_commit"):
+                db.commit()
+        except Exception as exp:  # pylint: disable=broad-except
+            db.rollback()
+            log(f"Failed to record document {document_id} in the catalog: {exp}")
+        finally:
+            db.close()
+
+    def document_ids(self, partition_name: str) -> List[str]:
+        """Get the IDs of the documents stored under the partition."""
+        db = self._session_factory()
+        try:
+            rows = self._documents(db, get_partition(partition_name)).with_entities(
+                models.PartitionDocument.document_id
+            )
+            return sorted({row.document_id for row in rows})
+        finally:
+            db.close()
+
+    def document_partitions(self, partition_name: str) -> List[str]:
+        """Get the `expert_name:document_name` partitions that hold documents or
+        files under the partition."""
+        partition = get_partition(partition_name)
+        db = self._session_factory()
+        try:
+            documents = self._documents(db, partition).with_entities(
+                models.PartitionDocument.document_name
+            )
+            files = self._files(db, partition).with_entities(models.File.filename)
+            names = {row.document_name for row in documents}
+            names.update(row.filename for row in files)
+            return sorted(
+                f"{partition.expert_name}:{name}" for name in names if name
+            )
+        finally:
+            db.close()
+
+    def exists(self, partition_name: str) -> bool:
+        """Check whether any document or file is stored under the partition."""
+        partition = get_partition(partition_name)
+        db = self._session_factory()
+        try:
+            return (
+                self._documents(db, partition).first() is not None
+                or self._files(db, partition).first() is not None
+            )
+        finally:
+            db.close()
+
+    def stats(self, partition_name: str) -> Dict:
+        """Get the number of documents, chunks and files of the partition.
+
+        Args:
+            partition_name (str): The partition name
+
+        Returns:
+            Dict: The partition statistics
+        """
+        partition = get_partition(partition_name)
+        db = self._session_factory()
+        try:
+            documents, chunks = (
+                self._documents(db, partition)
+                .with_entities(
+                    func.count(models.PartitionDocument.document_id),
+                    func.coalesce(func.sum(models.PartitionDocument.chunk_count), 0),
+                )
+                .one()
+            )
+            files = self._files(db, partition).with_entities(func.count()).scalar()
+        finally:
+            db.close()
+
+        return {
+            "partition_name": partition.name,
+            "documents": documents,
+            "chunks": int(chunks),
+            "files": files,
+        }
+
+    def remove(self, partition_name: str) -> Dict:
+        """Remove the catalog and `files` rows of the partition.
+
+        Args:
+            partition_name (str): The partition name
+
+        Returns:
+            Dict: The number of documents and files removed
+        """
+        partition = get_partition(partition_name)
+        db = self._session_factory()
+        try:
+            documents = self._documents(db, partition).delete(synchronize_session=False)
+            hashes = {
+                row.content_hash
+                for row in self._files(db, partition).with_entities(
+                    models.File.content_hash
+                )
+                if row.content_hash is not None
+            }
+            files = self._files(db, partition).delete(synchronize_session=False)
+
+            # Contents are shared by files with the same text, so only the ones that
+            # no remaining file references are removed
+            if hashes:
+                still_used = db.query(models.File.content_hash).filter(
+                    models.File.content_hash.in_(hashes)
+                )
+                db.query(models.FileContent).filter(
+                    models.FileContent.hash.in_(hashes),
+                    models.FileContent.hash.not_in(still_used),
+                ).delete(synchronize_session=False)
+            with stage("db_commit"):
+                db.commit()
+        except Exception:
+            # Nothing is removed unless every row of the partition is
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        return {"documents": documents, "files": files}
+
+
+# The process-wide partition catalog
+partition_catalog = PartitionCatalog()
@@ -0,0 +1,66 @@
+"""The concurrency.py file defines the helpers used to run blocking work from the
+async request path.
+
+Pinecone calls are blocking, so the async endpoints hand them to a dedicated I/O
+thread pool. The pool is sized independently of Starlette's default threadpool
+(`IO_THREADS`, default 128) so that a single worker can keep many slow vector
+database calls in flight at once.
+
+Work admitted by the scheduler (see `src/scheduler.py`) runs on the executor of
+its pool instead: `use_executor` sets the executor of the current context, which
+`run_blocking` hands the work to, so that ingestion does not take the threads of
+the queries.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+# The number of threads available for blocking I/O calls
+IO_THREADS = int(os.getenv("IO_THREADS", "128"))
+
+_io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+# The executor of the current context, if it is not the I/O thread pool
+_current_executor: contextvars.ContextVar[Optional[Executor]] = contextvars.ContextVar(
+    "executor", default=None
+)
+
+
+@contextmanager
+def use_executor(executor: Optional[Executor]) -> Iterator[None]:
+    """Run the blocking work of the current context on the given executor.
+
+    Args:
+        executor (Optional[Executor]): The executor, or None for the I/O thread pool
+    """
+    token = _current_executor.set(executor)
+    try:
+        yield
+    finally:
+        _current_executor.reset(token)
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking function on the executor of the current context, the I/O
+    thread pool by default, and await its result.
+
+    Args:
+        func (Callable): The blocking function to run
+        *args: The positional arguments for the function
+        **kwargs: The keyword arguments for the function
+
+    Returns:
+        Any: The return value of the function
+    """
+    loop = asyncio.get_running_loop()
+
+    # Run in a copy of the caller's context, so that the trace carries over
+    context = contextvars.copy_context()
+    executor = _current_executor.get() or _io_executor
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, func, *args, **kwargs)
+    )
@@ -0,0 +1,150 @@
+"""The content_store.py file defines the compressed store of the file contents.
+
+The text of every file is stored once, compressed, in the `file_contents` table,
+keyed by the hash of the content (the ID `PartitionedDocument` gives the same
+text), and the `files` rows only hold that hash. Files with the same content, e.g.
+a page stored under two partitions, share one blob, and scanning the `files` table
+no longer reads the article texts.
+
+Contents are compressed when they are queued for writing, so an ingestion holds
+the compressed bytes rather than the text until the rows are inserted. They are
+only decompressed when a file body is read, and `iter_text` decompresses a blob
+piece by piece, so a body can be streamed to the client without being held whole.
+
+Blobs are compressed with zlib, or with zstd when `FILE_CONTENT_CODEC` is `zstd` and
+the `zstandard` package is installed. The codec is stored with every blob, so
+changing it does not affect the blobs already stored. Rows written before the store
+existed keep their text in `files.content` and are read as they are.
+"""
+import codecs
+import os
+import zlib
+from typing import Iterator, List, NamedTuple
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from src import models
+from src.partition import PartitionedDocument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+FILE_CONTENT_CODEC = os.getenv("FILE_CONTENT_CODEC", ZLIB)
+
+# The number of compressed bytes decompressed at a time when streaming a body
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ContentBlob(NamedTuple):
+    """A compressed file content."""
+
+    hash: str
+    codec: str
+    size: int
+    data: bytes
+
+
+def compress_content(text: str, codec: str = FILE_CONTENT_CODEC) -> ContentBlob:
+    """Compress a file content.
+
+    Args:
+        text (str): The content
+        codec (str): `zlib` or `zstd`
+
+    Returns:
+        ContentBlob: The compressed content and its hash
+    """
+    raw = text.encode("utf-8")
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ImportError(
+                "The `zstandard` package is required to use FILE_CONTENT_CODEC=zstd"
+            )
+        data = zstandard.ZstdCompressor(level=10).compress(raw)
+    else:
+        codec, data = ZLIB, zlib.compress(raw, 6)
+    # pylint: disable-next=protected-access
+    return ContentBlob(PartitionedDocument._get_uuid(text), codec, len(raw), data)
+
+
+def _decompressed_pieces(codec: str, data: bytes) -> Iterator[bytes]:
+    """Decompress a blob in pieces."""
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ImportError("The `zstandard` package is required to read zstd blobs")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = zlib.decompressobj()
+
+    view = memoryview(data)
+    for start in range(0, len(view), READ_CHUNK_SIZE):
+        piece = decompressor.decompress(view[start : start + READ_CHUNK_SIZE])
+        if piece:
+            yield piece
+    if codec != ZSTD:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def iter_text(codec: str, data: bytes) -> Iterator[str]:
+    """Decompress a blob into text, piece by piece.
+
+    Args:
+        codec (str): The codec of the blob
+        data (bytes): The compressed content
+
+    Yields:
+        str: The next piece of the content
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for piece in _decompressed_pieces(codec, data):
+        text = decoder.decode(piece)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def decompress_content(codec: str, data: bytes) -> str:
+    """Decompress a whole blob into text."""
+    return "".join(iter_text(codec, data))
+
+
+def put_blobs(db: Session, blobs: List[ContentBlob]) -> None:
+    """Insert the blobs that are not stored yet, without committing.
+
+    Args:
+        db (Session): The database session
+        blobs (List[ContentBlob]): The blobs, with unique hashes
+    """
+    if not blobs:
+        return
+
+    stored = {
+        row.hash
+        for row in db.query(models.FileContent.hash).filter(
+            models.FileContent.hash.in_([blob.hash for blob in blobs])
+        )
+    }
+    new = [blob._asdict() for blob in blobs if blob.hash not in stored]
+    if not new:
+        return
+
+    # Another ingestion may store the same content in the meantime
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(models.FileContent).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        statement = sqlite.insert(models.FileContent).on_conflict_do_nothing()
+    else:
+        statement = insert(models.FileContent)
+    db.execute(statement, new)
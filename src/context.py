@@ -0,0 +1,256 @@
+"""The context.py file defines the context engine used for querying the knowledge base.
+
+Canopy's `ContextEngine` only implements the synchronous query path. The
+`ExpertContextEngine` adds an `aquery` method built on the knowledge base's async
+query so that the `/context` endpoint never blocks the event loop, and an
+`aquery_each` method that runs many queries together but builds a separate context
+for each of them.
+
+The `ExpertContextBuilder` stuffs the context like Canopy's `StuffingContextBuilder`,
+but its snippets also carry the ID of the chunk they were made from, so that
+redundant snippets can be dropped by chunk lineage (see `src/dedup.py`).
+
+The `PackingContextBuilder`, used by default, packs the budget from the token counts
+stored with the chunks instead (see `src/packing.py`), so building a context does not
+tokenize anything. It counts the tokens of the snippet texts, which are what the
+context is made of, not of the JSON that Canopy's builders measure. The builder is
+selected with the `CONTEXT_BUILDER` environment variable: `packing` (the default) or
+`stuffing`.
+"""
+import os
+from typing import List, Optional
+
+from canopy.context_engine import ContextEngine
+from canopy.context_engine.context_builder.stuffing import (
+    ContextQueryResult,
+    ContextSnippet,
+    StuffingContextBuilder,
+    StuffingContextContent,
+)
+from canopy.knowledge_base.models import QueryResult
+from canopy.models.data_models import Context, Query
+from canopy.utils.debugging import CANOPY_DEBUG_INFO
+from pydantic import Field
+
+from src.packing import (
+    SEPARATOR_TOKENS,
+    Candidate,
+    document_of,
+    expand,
+    non_overlapping,
+    pack,
+    stored_token_count,
+)
+from src.settings import LazyTokenizer
+
+# The context builders
+PACKING = "packing"
+STUFFING = "stuffing"
+
+CONTEXT_BUILDER = os.getenv("CONTEXT_BUILDER", PACKING)
+
+
+class ExpertContextSnippet(ContextSnippet):
+    """A context snippet that remembers the ID of its chunk.
+
+    The ID is excluded from serialization, so it does not count towards the token
+    budget of the context.
+    """
+
+    id: Optional[str] = Field(default=None, exclude=True)
+
+
+class ExpertContextBuilder(StuffingContextBuilder):
+    """A stuffing context builder whose snippets carry their chunk IDs."""
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        # The parent constructor requires the tokenizer to be initialized already
+        self._tokenizer = LazyTokenizer()
+
+    def build(
+        self, query_results: List[QueryResult], max_context_tokens: int
+    ) -> Context:
+        """Stuff as many of the retrieved documents as fit into the context.
+
+        Args:
+            query_results (List[QueryResult]): The query results, in ranking order
+            max_context_tokens (int): The token budget of the context
+
+        Returns:
+            Context: The context, with one snippet per included document
+        """
+        sorted_docs_with_origin = self._round_robin_sort(query_results)
+
+        context_query_results = [
+            ContextQueryResult(query=qr.query, snippets=[]) for qr in query_results
+        ]
+        debug_info = {"num_docs": len(sorted_docs_with_origin), "snippet_ids": []}
+        content = StuffingContextContent(context_query_results)
+
+        if self._tokenizer.token_count(content.to_text()) > max_context_tokens:
+            return Context(
+                content=StuffingContextContent([]), num_tokens=1, debug_info=debug_info
+            )
+
+        seen_doc_ids = set()
+        for doc, origin_query_idx in sorted_docs_with_origin:
+            if doc.id in seen_doc_ids or doc.text.strip() == "":
+                continue
+            seen_doc_ids.add(doc.id)
+
+            # Try inserting the snippet, and remove it if the context is too long
+            snippets = context_query_results[origin_query_idx].snippets
+            snippets.append(
+                ExpertContextSnippet(id=doc.id, text=doc.text, source=doc.source)
+            )
+            if self._tokenizer.token_count(content.to_text()) > max_context_tokens:
+                snippets.pop()
+            else:
+                debug_info["snippet_ids"].append(doc.id)
+
+        # Remove the queries with no snippets
+        content = StuffingContextContent(
+            [qr for qr in context_query_results if qr.snippets]
+        )
+        return Context(
+            content=content,
+            num_tokens=self._tokenizer.token_count(content.to_text()),
+            debug_info=debug_info if CANOPY_DEBUG_INFO else {},
+        )
+
+
+class PackingContextBuilder(ExpertContextBuilder):
+    """A context builder that packs the budget from the stored chunk token counts."""
+
+    def build(
+        self, query_results: List[QueryResult], max_context_tokens: int
+    ) -> Context:
+        """Pack the best ranked, non-overlapping documents into the context.
+
+        Args:
+            query_results (List[QueryResult]): The query results, in ranking order
+            max_context_tokens (int): The token budget of the context
+
+        Returns:
+            Context: The context, with one snippet per included document
+        """
+        ranked = []
+        candidates = []
+        seen_doc_ids = set()
+        for doc, origin_query_idx in self._round_robin_sort(query_results):
+            if doc.id in seen_doc_ids or doc.text.strip() == "":
+                continue
+            seen_doc_ids.add(doc.id)
+
+            tokens = stored_token_count(doc.metadata)
+            if tokens is None:
+                # Chunks stored before their token counts were recorded
+                tokens = self._tokenizer.token_count(doc.text)
+            start = int(doc.metadata.get("token_start", 0))
+            candidates.append(
+                Candidate(
+                    position=len(ranked),
+                    document_id=document_of(doc.id),
+                    start=start,
+                    end=int(doc.metadata.get("token_end", start + tokens)),
+                    tokens=tokens,
+                    score=doc.score,
+                )
+            )
+            ranked.append((doc, origin_query_idx))
+
+        selected = pack(
+            non_overlapping(candidates, max_context_tokens), max_context_tokens
+        )
+        selected = expand(selected, candidates, max_context_tokens)
+
+        context_query_results = [
+            ContextQueryResult(query=qr.query, snippets=[]) for qr in query_results
+        ]
+        for candidate in selected:
+            doc, origin_query_idx = ranked[candidate.position]
+            context_query_results[origin_query_idx].snippets.append(
+                ExpertContextSnippet(id=doc.id, text=doc.text, source=doc.source)
+            )
+
+        num_tokens = sum(candidate.tokens for candidate in selected)
+        num_tokens += SEPARATOR_TOKENS * max(len(selected) - 1, 0)
+        debug_info = {
+            "num_docs": len(ranked),
+            "snippet_ids": [ranked[candidate.position][0].id for candidate in selected],
+        }
+        return Context(
+            content=StuffingContextContent(
+                [qr for qr in context_query_results if qr.snippets]
+            ),
+            num_tokens=num_tokens,
+            debug_info=debug_info if CANOPY_DEBUG_INFO else {},
+        )
+
+
+class ExpertContextEngine(ContextEngine):
+    """A Canopy context engine with an async query path."""
+
+    _DEFAULT_COMPONENTS = {
+        **ContextEngine._DEFAULT_COMPONENTS,
+        "context_builder": (
+            PackingContextBuilder
+            if CONTEXT_BUILDER == PACKING
+            else ExpertContextBuilder
+        ),
+    }
+
+    async def aquery(
+        self,
+        queries: List[Query],
+        max_context_tokens: int,
+        *,
+        namespace: Optional[str] = None,
+    ) -> Context:
+        """Query the knowledge base and build the context asynchronously.
+
+        Args:
+            queries (List[Query]): The queries to run
+            max_context_tokens (int): The token budget of the context
+            namespace (Optional[str]): The namespace to query
+
+        Returns:
+            Context: The context built from the query results
+        """
+        query_results = await self.knowledge_base.aquery(
+            queries,
+            global_metadata_filter=self.global_metadata_filter,
+            namespace=namespace,
+        )
+        return self.context_builder.build(query_results, max_context_tokens)
+
+    async def aquery_each(
+        self,
+        queries: List[Query],
+        max_context_tokens: List[int],
+        *,
+        namespace: Optional[str] = None,
+    ) -> List[Context]:
+        """Query the knowledge base for many queries at once, and build the context of
+        every query separately.
+
+        The queries are embedded with one batched call and searched concurrently,
+        unlike `aquery` calls made one query at a time.
+
+        Args:
+            queries (List[Query]): The queries to run
+            max_context_tokens (List[int]): The token budget of every query's context
+            namespace (Optional[str]): The namespace to query
+
+        Returns:
+            List[Context]: The context of each query, in order
+        """
+        query_results = await self.knowledge_base.aquery(
+            queries,
+            global_metadata_filter=self.global_metadata_filter,
+            namespace=namespace,
+        )
+        return [
+            self.context_builder.build([query_result], budget)
+            for query_result, budget in zip(query_results, max_context_tokens)
+        ]
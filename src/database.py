@@ -1,19 +1,123 @@
+"""The database.py file defines the database engine and sessions.
+
+The engine is created when the first session is opened (see `src/settings.py`).
+Postgres connections are pooled and checked with a ping before they are handed
+out, so connections dropped by the server are replaced instead of failing a
+request. The pool is configured with the following environment variables:
+    - `DB_POOL_SIZE`: The number of connections kept open (default 10)
+    - `DB_MAX_OVERFLOW`: The number of extra connections opened under load
+      (default 20)
+    - `DB_POOL_TIMEOUT`: The seconds to wait for a free connection (default 30)
+    - `DB_POOL_RECYCLE`: The seconds after which a connection is reopened
+      (default 1800)
+
+A `sqlite://` URL can be used instead of Postgres, e.g. for tests. In-memory
+SQLite databases are shared by every session of the process over a single
+connection, so they only suit single-threaded use; use a SQLite file when
+requests run concurrently.
+
+The async endpoints use `run_in_session`, which runs database work on the
+blocking I/O threads and waits for a free connection without holding a thread.
+"""
+import asyncio
 import os
+from functools import lru_cache
+from typing import Any, Callable, Dict
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.concurrency import run_blocking
+from src.settings import get_settings
 
-SQLALCHEMY_DATABASE_URL = os.environ.get('POSTGRESQL_DATABASE_URL')
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# The session factory is bound to the engine when the first session is opened
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Bounds the sessions opened by `run_in_session` to the size of the pool
+_session_slots = asyncio.Semaphore(DB_POOL_SIZE + DB_MAX_OVERFLOW)
 
 Base = declarative_base()
 
+
+def engine_options(url: str) -> Dict:
+    """Get the `create_engine` options for a database URL.
+
+    Args:
+        url (str): The database URL
+
+    Returns:
+        Dict: The pool and connection options
+    """
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        options = {
+            "pool_pre_ping": True,
+            # Sessions are used from the I/O threads
+            "connect_args": {"check_same_thread": False},
+        }
+        if url.database in (None, "", ":memory:"):
+            # Every connection to `:memory:` would otherwise be a new database
+            options["poolclass"] = StaticPool
+        return options
+
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+@lru_cache(maxsize=None)
+def get_engine() -> Engine:
+    """Create the database engine on first use."""
+    url = get_settings().postgresql_database_url
+    engine = create_engine(url, **engine_options(url))
+    _session_factory.configure(bind=engine)
+    return engine
+
+
+def SessionLocal() -> Session:  # pylint: disable=invalid-name
+    """Open a database session, creating the engine if needed."""
+    get_engine()
+    return _session_factory()
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def run_in_session(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking database function with a new session, and await its result.
+
+    Args:
+        func (Callable): The function, called with the session as first argument
+        *args: The other positional arguments for the function
+        **kwargs: The keyword arguments for the function
+
+    Returns:
+        Any: The return value of the function
+    """
+
+    def call():
+        db = SessionLocal()
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            db.close()
+
+    async with _session_slots:
+        return await run_blocking(call)
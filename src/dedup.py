@@ -0,0 +1,146 @@
+"""The dedup.py file defines the removal of redundant snippets from a context.
+
+Documents are chunked into overlapping chunks of 64, 128, 256 and 512 tokens, so a
+context often holds a small chunk together with a larger chunk that covers it. The
+chunk IDs follow the `{doc}-{size}-{idx}` pattern, which tells exactly which token
+interval of the document a chunk covers: `[idx * size, (idx + 1) * size)`. A chunk
+is contained in another chunk of the same document if its interval is, and for
+every larger size there is only one chunk that can contain it. Containment is
+therefore resolved with a dictionary lookup per chunk size, without comparing any
+text.
+
+Snippets with an ID that does not follow the pattern fall back to text containment.
+Their texts are joined into one haystack so that each snippet is found with a
+single substring search, instead of being compared against every other snippet.
+"""
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# The chunk IDs made by the `TokenLengthChunker`
+CHUNK_ID_PATTERN = re.compile(r"^(?P<document_id>.+)-(?P<size>\d+)-(?P<index>\d+)$")
+
+# Separates the texts in the fallback haystack, so that no match spans two texts
+_SEPARATOR = "\x00"
+
+
+class ChunkLineage(NamedTuple):
+    """The document and token interval covered by a chunk."""
+
+    document_id: str
+    size: int
+    index: int
+
+    @property
+    def start(self) -> int:
+        return self.index * self.size
+
+    @property
+    def end(self) -> int:
+        return (self.index + 1) * self.size
+
+
+def parse_chunk_id(chunk_id: Optional[str]) -> Optional[ChunkLineage]:
+    """Parse the lineage of a chunk from its ID.
+
+    Args:
+        chunk_id (Optional[str]): The chunk ID
+
+    Returns:
+        Optional[ChunkLineage]: The lineage of the chunk, or None for foreign IDs
+    """
+    match = CHUNK_ID_PATTERN.match(chunk_id or "")
+    if match is None or int(match["size"]) <= 0:
+        return None
+    return ChunkLineage(match["document_id"], int(match["size"]), int(match["index"]))
+
+
+def _is_covered(
+    lineage: ChunkLineage, chunks: Dict[str, Dict[int, set]]
+) -> bool:
+    """Check whether another chunk of the same document covers the given chunk."""
+    for size, indices in chunks[lineage.document_id].items():
+        if size <= lineage.size:
+            continue
+
+        # The only chunk of this size that can cover the interval is the one that
+        # holds its start
+        index = lineage.start // size
+        if index in indices and lineage.end <= (index + 1) * size:
+            return True
+    return False
+
+
+def _contained_texts(texts: List[str], foreign: set) -> set:
+    """Find the texts contained in another text, for pairs involving foreign IDs.
+
+    Args:
+        texts (List[str]): The unique snippet texts
+        foreign (set): The texts of the snippets with a foreign ID
+
+    Returns:
+        set: The texts that are contained in another, different text
+    """
+    # Foreign texts are checked against every text, the other texts against the
+    # foreign texts only. A text always occurs once in a haystack that holds it.
+    haystack = _SEPARATOR.join(texts)
+    foreign_haystack = _SEPARATOR.join(text for text in texts if text in foreign)
+
+    contained = set()
+    for text in texts:
+        if text in foreign:
+            search, occurrences = haystack, 1
+        else:
+            search, occurrences = foreign_haystack, 0
+
+        first = search.find(text)
+        if first == -1:
+            continue
+        if occurrences == 0 or search.find(text, first + 1) != -1:
+            contained.add(text)
+    return contained
+
+
+def unique_snippet_indices(snippets: List[Tuple[Optional[str], str]]) -> List[int]:
+    """Find the snippets that are not contained in another snippet of the context.
+
+    Args:
+        snippets (List[Tuple[Optional[str], str]]): The chunk ID and text of every
+            snippet, in ranking order
+
+    Returns:
+        List[int]: The positions of the snippets that are kept, in ranking order
+    """
+    lineages = [parse_chunk_id(chunk_id) for chunk_id, _ in snippets]
+
+    # The chunk indices present in the context, by document and chunk size
+    chunks: Dict[str, Dict[int, set]] = {}
+    for lineage in lineages:
+        if lineage is not None:
+            sizes = chunks.setdefault(lineage.document_id, {})
+            sizes.setdefault(lineage.size, set()).add(lineage.index)
+
+    contained = set()
+    foreign = {text for (_, text), lineage in zip(snippets, lineages) if lineage is None}
+    if foreign:
+        unique_texts = list(dict.fromkeys(text for _, text in snippets))
+        contained = _contained_texts(unique_texts, foreign)
+
+    return [
+        position
+        for position, ((_, text), lineage) in enumerate(zip(snippets, lineages))
+        if text not in contained
+        and (lineage is None or not _is_covered(lineage, chunks))
+    ]
+
+
+def deduplicate_snippets(snippets: List[Tuple[Optional[str], str]]) -> List[str]:
+    """Drop the snippets that are contained in another snippet of the context.
+
+    Args:
+        snippets (List[Tuple[Optional[str], str]]): The chunk ID and text of every
+            snippet, in ranking order
+
+    Returns:
+        List[str]: The texts of the snippets that are kept, in ranking order
+    """
+    return [snippets[position][1] for position in unique_snippet_indices(snippets)]
@@ -0,0 +1,405 @@
+"""The dispatcher.py file defines the shared dispatcher of the embedding requests.
+
+Every knowledge base has its own encoder, so concurrent requests used to call the
+embeddings API separately, a few texts at a time, and each backed off on its own
+when the provider rate limited them. The `EmbeddingDispatcher` is shared by every
+encoder of the process instead:
+    - Texts to embed are queued per model, and the queue is sent as one batch once
+      `EMBEDDING_BATCH_WINDOW_MS` (default 5) passed since its first text, or as
+      soon as it holds `EMBEDDING_BATCH_TEXTS` texts or would exceed
+      `EMBEDDING_BATCH_TOKENS` tokens. While no batch is being sent, the queue is
+      sent right away instead, with the texts queued in the same iteration of the
+      event loop, so that a lone request does not wait for the window. Concurrent
+      callers share batches, a text queued by two callers is embedded once, and
+      every caller gets the vectors of its own texts back.
+    - Every batch takes one request and its tokens from two token buckets, which
+      refill at `EMBEDDING_RPM` requests and `EMBEDDING_TPM` tokens per minute and
+      hold at most `EMBEDDING_BURST_SECONDS` (default 10) of their rate. A rate of
+      0 is unlimited. At most `EMBEDDING_MAX_IN_FLIGHT` batches are sent at once.
+    - When the encoder raises `Throttled`, e.g. on a 429, every batch waits for
+      the `Retry-After` of the response, or an exponential backoff, the budgets
+      are emptied and their refill rates are halved. Each successful batch then
+      restores part of the rate, so the dispatcher settles just under the actual
+      limits of the service. A throttled batch with more tokens than the slowed
+      down budget is split in two, and a batch is retried `EMBEDDING_MAX_RETRIES`
+      times before its callers get the error.
+    - When a batch of several callers fails with another error, e.g. a text the
+      service rejects, the texts of every caller are sent again as a batch of
+      their own, so that only the callers whose batch fails get the error.
+
+Tokens are estimated from the length of the texts, at about 4 characters per
+token, rather than counted, since the budgets only need to be approximate.
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from src.metrics import embedding_requests_total, embedding_texts_total
+
+EMBEDDING_RPM = float(os.getenv("EMBEDDING_RPM", "3000"))
+EMBEDDING_TPM = float(os.getenv("EMBEDDING_TPM", "1000000"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_TEXTS = int(os.getenv("EMBEDDING_BATCH_TEXTS", "400"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "8"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+EMBEDDING_BURST_SECONDS = float(os.getenv("EMBEDDING_BURST_SECONDS", "10"))
+
+# The first backoff, doubled on every retry of a batch, and the longest one
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 60.0
+
+# The lowest fraction of the configured rates the dispatcher slows down to, and
+# the fraction restored by every successful batch
+MIN_RATE_SCALE = 0.05
+RATE_RECOVERY = 0.05
+
+# Embeds a batch of texts with a single request
+EmbedBatch = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+class Throttled(Exception):
+    """Raised by an encoder when the embedding service asks to slow down: a rate
+    limit, or an overloaded or unreachable server."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text."""
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """A budget of units per minute, which can be spent in bursts of `capacity`.
+
+    A rate of 0 is unlimited.
+    """
+
+    def __init__(self, per_minute: float, capacity: float):
+        self.per_minute = per_minute
+        self.capacity = capacity
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, scale: float) -> None:
+        now = time.monotonic()
+        refill = (now - self._updated) * self.per_minute * scale / 60
+        self.available = min(self.capacity, self.available + refill)
+        self._updated = now
+
+    def delay(self, amount: float, scale: float = 1.0) -> float:
+        """Get the seconds until the amount is available, at the scaled rate.
+
+        An amount larger than the capacity only waits for a full bucket.
+        """
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(scale)
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0.0) * 60 / (self.per_minute * scale)
+
+    def take(self, amount: float) -> None:
+        """Spend the amount, which must be available."""
+        if self.per_minute <= 0:
+            return
+        self.available -= min(amount, self.capacity)
+
+    def drain(self) -> None:
+        """Spend the whole budget, so that the next units wait for a refill."""
+        self.available = min(self.available, 0.0)
+
+
+@dataclass
+class _Batch:
+    """The texts queued for a model, waiting to be sent."""
+
+    embed_batch: EmbedBatch
+    texts: List[str] = field(default_factory=list)
+    futures: List[asyncio.Future] = field(default_factory=list)
+    # The caller that queued every text
+    callers: List[int] = field(default_factory=list)
+    tokens: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+
+    def _part(self, indexes: List[int]) -> "_Batch":
+        """Get a batch of the texts at the given indexes."""
+        return _Batch(
+            self.embed_batch,
+            [self.texts[i] for i in indexes],
+            [self.futures[i] for i in indexes],
+            [self.callers[i] for i in indexes],
+            sum(estimate_tokens(self.texts[i]) for i in indexes),
+        )
+
+    def halves(self) -> List["_Batch"]:
+        """Split the batch in two."""
+        middle = len(self.texts) // 2
+        indexes = list(range(len(self.texts)))
+        return [self._part(indexes[:middle]), self._part(indexes[middle:])]
+
+    def per_caller(self) -> List["_Batch"]:
+        """Split the batch into the texts of every caller."""
+        indexes: Dict[int, List[int]] = {}
+        for i, caller in enumerate(self.callers):
+            indexes.setdefault(caller, []).append(i)
+        return [self._part(caller_indexes) for caller_indexes in indexes.values()]
+
+
+class _LoopState:
+    """The queues of the dispatcher on an event loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_in_flight: int):
+        self.loop = loop
+        self.batches: Dict[str, _Batch] = {}
+        # The future of every text that is queued or being embedded
+        self.futures: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.callers = itertools.count()
+        self.tasks: set = set()
+        # The number of batches being sent
+        self.sending = 0
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        # Budgets are spent in arrival order
+        self.gate = asyncio.Lock()
+
+
+class EmbeddingDispatcher:  # pylint: disable=too-many-instance-attributes
+    """Batches the texts of concurrent callers within the rate limits of the
+    embedding service."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        requests_per_minute: float = EMBEDDING_RPM,
+        tokens_per_minute: float = EMBEDDING_TPM,
+        window_seconds: float = EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_batch_texts: int = EMBEDDING_BATCH_TEXTS,
+        max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        burst_seconds: float = EMBEDDING_BURST_SECONDS,
+    ):
+        self.window_seconds = window_seconds
+        self.max_batch_texts = max_batch_texts
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        burst = burst_seconds / 60
+        self.requests = TokenBucket(
+            requests_per_minute, max(1.0, requests_per_minute * burst)
+        )
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute * burst)
+        # A larger batch could never be sent within the token budget
+        self.max_batch_tokens = max_batch_tokens
+        if tokens_per_minute > 0:
+            self.max_batch_tokens = int(min(max_batch_tokens, self.tokens.capacity))
+
+        # The fraction of the configured rates currently used
+        self.rate_scale = 1.0
+        # No batch is sent before this time, after the service throttled one
+        self.paused_until = 0.0
+
+        self._state: Optional[_LoopState] = None
+        self._stats = {"batches": 0, "texts": 0, "throttled": 0, "failed": 0}
+
+    def _loop_state(self) -> _LoopState:
+        """Get the queues of the running event loop, e.g. a new one in tests."""
+        loop = asyncio.get_running_loop()
+        if self._state is None or self._state.loop is not loop:
+            self._state = _LoopState(loop, self.max_in_flight)
+        return self._state
+
+    async def embed(
+        self, model_name: str, texts: List[str], embed_batch: EmbedBatch
+    ) -> List[List[float]]:
+        """Embed texts along with those of the concurrent callers.
+
+        Args:
+            model_name (str): The embedding model, texts are only batched with the
+                texts of the same model
+            texts (List[str]): The texts to embed
+            embed_batch (EmbedBatch): Embeds a batch of texts with one request
+
+        Returns:
+            List[List[float]]: The embedding of each text, in order
+        """
+        state = self._loop_state()
+        caller = next(state.callers)
+        futures = []
+        for text in texts:
+            future = state.futures.get((model_name, text))
+            if future is None:
+                future = state.loop.create_future()
+                state.futures[(model_name, text)] = future
+                self._enqueue(state, model_name, text, future, embed_batch, caller)
+            futures.append(future)
+
+        # A cancelled caller must not cancel the texts it shares with others
+        return list(await asyncio.gather(*(asyncio.shield(f) for f in futures)))
+
+    def _enqueue(  # pylint: disable=too-many-arguments
+        self,
+        state: _LoopState,
+        model_name: str,
+        text: str,
+        future: asyncio.Future,
+        embed_batch: EmbedBatch,
+        caller: int,
+    ) -> None:
+        """Add a text to the queue of its model, sending the queue once it is full."""
+        tokens = estimate_tokens(text)
+        batch = state.batches.get(model_name)
+        if batch is not None and batch.tokens + tokens > self.max_batch_tokens:
+            self._flush(state, model_name)
+            batch = None
+        if batch is None:
+            batch = state.batches[model_name] = _Batch(embed_batch)
+            batch.timer = state.loop.call_later(
+                self.window_seconds if state.sending else 0,
+                self._flush,
+                state,
+                model_name,
+            )
+
+        batch.texts.append(text)
+        batch.futures.append(future)
+        batch.callers.append(caller)
+        batch.tokens += tokens
+        if len(batch.texts) >= self.max_batch_texts:
+            self._flush(state, model_name)
+
+    def _flush(self, state: _LoopState, model_name: str) -> None:
+        """Send the queue of a model as a batch."""
+        batch = state.batches.pop(model_name, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        self._spawn(state, model_name, batch)
+
+    def _spawn(self, state: _LoopState, model_name: str, batch: _Batch) -> None:
+        """Send a batch in a task of its own."""
+        state.sending += 1
+        task = state.loop.create_task(self._send(state, model_name, batch))
+        state.tasks.add(task)
+        task.add_done_callback(state.tasks.discard)
+
+    async def _acquire(self, state: _LoopState, tokens: int) -> None:
+        """Wait until the budgets allow a request of the given tokens, and spend
+        them."""
+        async with state.gate:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.delay(1, self.rate_scale),
+                    self.tokens.delay(tokens, self.rate_scale),
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def _throttle(self, exp: Throttled, attempt: int) -> None:
+        """Pause every batch and slow down after the service throttled a batch."""
+        backoff = min(BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+        delay = max(exp.retry_after or 0.0, backoff * random.uniform(0.5, 1.0))
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.rate_scale = max(MIN_RATE_SCALE, self.rate_scale / 2)
+        # The service is over its limits, whatever burst the budgets still allow
+        self.requests.drain()
+        self.tokens.drain()
+        self._stats["throttled"] += 1
+        embedding_requests_total.inc(1, "throttled")
+
+    async def _embed(
+        self, state: _LoopState, batch: _Batch
+    ) -> Optional[List[List[float]]]:
+        """Embed a batch within the budgets, retrying it while it is throttled.
+
+        Returns:
+            Optional[List[List[float]]]: The embeddings, or None if the batch was
+                throttled with more tokens than the slowed down budget allows,
+                and should be split
+        """
+        attempt = 0
+        while True:
+            await self._acquire(state, batch.tokens)
+            try:
+                return await batch.embed_batch(batch.texts)
+            except Throttled as exp:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self._throttle(exp, attempt)
+                budget = self.max_batch_tokens * self.rate_scale
+                if len(batch.texts) > 1 and batch.tokens > budget:
+                    return None
+
+    async def _send(self, state: _LoopState, model_name: str, batch: _Batch) -> None:
+        """Embed a batch and hand the embeddings to the callers."""
+        split = False
+        try:
+            async with state.in_flight:
+                vectors = await self._embed(state, batch)
+            if vectors is None:
+                split = True
+                for half in batch.halves():
+                    self._spawn(state, model_name, half)
+                return
+            if len(vectors) != len(batch.texts):
+                raise ValueError(
+                    f"Got {len(vectors)} embeddings for {len(batch.texts)} texts"
+                )
+
+            self.rate_scale = min(1.0, self.rate_scale + RATE_RECOVERY)
+            self._stats["batches"] += 1
+            self._stats["texts"] += len(batch.texts)
+            embedding_requests_total.inc(1, "ok")
+            embedding_texts_total.inc(len(batch.texts))
+            for future, vector in zip(batch.futures, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as exp:  # pylint: disable=broad-except
+            self._stats["failed"] += 1
+            embedding_requests_total.inc(1, "failed")
+            # A service that throttles every retry fails every caller alike, but
+            # another error may come from the texts of one caller only
+            parts = [] if isinstance(exp, Throttled) else batch.per_caller()
+            if len(parts) > 1:
+                split = True
+                for part in parts:
+                    self._spawn(state, model_name, part)
+                return
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(exp)
+        finally:
+            state.sending -= 1
+            if not split:
+                for text in batch.texts:
+                    state.futures.pop((model_name, text), None)
+            # The callers that were cancelled never retrieve the error
+            for future in batch.futures:
+                if future.done() and not future.cancelled():
+                    future.exception()
+
+    def get_stats(self) -> Dict:
+        """Get the number of batches and texts embedded, and the current rate."""
+        batches = self._stats["batches"]
+        return {
+            **self._stats,
+            "texts_per_batch": self._stats["texts"] / batches if batches else 0.0,
+            "rate_scale": self.rate_scale,
+        }
+
+
+# The process-wide dispatcher of the embedding requests
+embedding_dispatcher = EmbeddingDispatcher()
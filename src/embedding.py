@@ -0,0 +1,218 @@
+"""The embedding.py file defines the record encoder used by the knowledge base.
+
+The `ExpertRecordEncoder` is the Canopy `OpenAIRecordEncoder` with two additions:
+
+    - A native async implementation. Canopy only ships the synchronous encoding
+      path, so the async methods call the OpenAI embeddings API through
+      `AsyncOpenAI`. The texts are handed to the shared `EmbeddingDispatcher`,
+      which batches them with the texts of the concurrent requests and keeps the
+      calls within the rate limits (see `src/dispatcher.py`).
+    - An embedding cache. Both chunk and query encoding look every text up in the
+      content-addressed `EmbeddingCache` first and only embed the texts that are
+      not cached yet, once per unique text.
+"""
+import asyncio
+from typing import Dict, List, Optional
+
+import openai
+
+from canopy.knowledge_base.models import KBDocChunk, KBEncodedDocChunk, KBQuery
+from canopy.knowledge_base.record_encoder import OpenAIRecordEncoder
+from canopy.models.data_models import Query
+from openai import AsyncOpenAI
+
+from src.concurrency import run_blocking
+from src.dispatcher import EmbeddingDispatcher, Throttled, embedding_dispatcher
+from src.embedding_cache import CacheKey, EmbeddingCache, embedding_cache
+from src.metrics import timed
+
+# The default OpenAI embedding model, which is also Canopy's default
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def _retry_after(response) -> Optional[float]:
+    """Get the seconds to wait from the `Retry-After` header of a response."""
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class ExpertRecordEncoder(OpenAIRecordEncoder):
+    """An OpenAI record encoder that supports async encoding and caching."""
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL,
+        batch_size: int = 400,
+        cache: Optional[EmbeddingCache] = embedding_cache,
+        dispatcher: Optional[EmbeddingDispatcher] = embedding_dispatcher,
+    ):
+        super().__init__(model_name=model_name, batch_size=batch_size)
+        self.model_name = model_name
+        self.cache = cache
+        self.dispatcher = dispatcher
+
+        # The async client is created on first use so that it binds to the running loop
+        self._async_client = None
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        """Split the texts into batches of the encoder's batch size."""
+        return [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed the given texts with a single OpenAI call."""
+        return self._dense_encoder.encode_documents(texts)
+
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed the given texts with a single async OpenAI call.
+
+        The client does not retry by itself: rate limits and server errors are
+        raised as `Throttled`, so that the dispatcher backs every request off.
+        """
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(max_retries=0)
+
+        try:
+            response = await self._async_client.embeddings.create(
+                model=self.model_name, input=texts
+            )
+        except openai.RateLimitError as exp:
+            raise Throttled(str(exp), _retry_after(exp.response)) from exp
+        except (openai.InternalServerError, openai.APIConnectionError) as exp:
+            raise Throttled(str(exp)) from exp
+        return [item.embedding for item in response.data]
+
+    @staticmethod
+    def _missing(
+        keys: List[CacheKey], texts: List[str], cached: Dict[CacheKey, List[float]]
+    ) -> Dict[CacheKey, str]:
+        """Get the unique texts that are missing from the cache, by key."""
+        return {key: text for key, text in zip(keys, texts) if key not in cached}
+
+    @timed("embed")
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed the given texts, only calling OpenAI once for every uncached text.
+
+        Args:
+            texts (List[str]): The texts to embed
+
+        Returns:
+            List[List[float]]: The embedding of each text, in order
+        """
+        keys = [EmbeddingCache.key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys) if self.cache is not None else {}
+        missing = self._missing(keys, texts, vectors)
+        if missing:
+            new_vectors = [
+                vector
+                for batch in self._batches(list(missing.values()))
+                for vector in self._embed_batch(batch)
+            ]
+            new = dict(zip(missing, new_vectors))
+            if self.cache is not None:
+                # Return the vectors at the precision that later cache hits have
+                new = self.cache.put_many(new)
+            vectors.update(new)
+
+        return [vectors[key] for key in keys]
+
+    @timed("embed")
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        """Async version of `embed`, embedding the missing texts through the
+        dispatcher, or every batch of them concurrently without one.
+
+        Args:
+            texts (List[str]): The texts to embed
+
+        Returns:
+            List[List[float]]: The embedding of each text, in order
+        """
+        keys = [EmbeddingCache.key(self.model_name, text) for text in texts]
+        vectors = {}
+        if self.cache is not None:
+            vectors = await run_blocking(self.cache.get_many, keys)
+        missing = self._missing(keys, texts, vectors)
+        if missing:
+            if self.dispatcher is not None:
+                new_vectors = await self.dispatcher.embed(
+                    self.model_name, list(missing.values()), self._aembed_batch
+                )
+            else:
+                results = await asyncio.gather(
+                    *(
+                        self._aembed_batch(batch)
+                        for batch in self._batches(list(missing.values()))
+                    )
+                )
+                new_vectors = [vector for batch in results for vector in batch]
+            new = dict(zip(missing, new_vectors))
+            if self.cache is not None:
+                new = await run_blocking(self.cache.put_many, new)
+            vectors.update(new)
+
+        return [vectors[key] for key in keys]
+
+    def encode_documents(self, documents: List[KBDocChunk]) -> List[KBEncodedDocChunk]:
+        """Encode the given chunks.
+
+        Args:
+            documents (List[KBDocChunk]): The chunks to encode
+
+        Returns:
+            List[KBEncodedDocChunk]: The encoded chunks, in order
+        """
+        values = self.embed([doc.text for doc in documents])
+        return [
+            KBEncodedDocChunk(**doc.model_dump(), values=vector)
+            for doc, vector in zip(documents, values)
+        ]
+
+    def encode_queries(self, queries: List[Query]) -> List[KBQuery]:
+        """Encode the given queries.
+
+        Args:
+            queries (List[Query]): The queries to encode
+
+        Returns:
+            List[KBQuery]: The encoded queries, in order
+        """
+        values = self.embed([query.text for query in queries])
+        return [
+            KBQuery(**query.model_dump(), values=vector)
+            for query, vector in zip(queries, values)
+        ]
+
+    async def aencode_documents(
+        self, documents: List[KBDocChunk]
+    ) -> List[KBEncodedDocChunk]:
+        """Async version of `encode_documents`.
+
+        Args:
+            documents (List[KBDocChunk]): The chunks to encode
+
+        Returns:
+            List[KBEncodedDocChunk]: The encoded chunks, in order
+        """
+        values = await self.aembed([doc.text for doc in documents])
+        return [
+            KBEncodedDocChunk(**doc.model_dump(), values=vector)
+            for doc, vector in zip(documents, values)
+        ]
+
+    async def aencode_queries(self, queries: List[Query]) -> List[KBQuery]:
+        """Async version of `encode_queries`.
+
+        Args:
+            queries (List[Query]): The queries to encode
+
+        Returns:
+            List[KBQuery]: The encoded queries, in order
+        """
+        values = await self.aembed([query.text for query in queries])
+        return [
+            KBQuery(**query.model_dump(), values=vector)
+            for query, vector in zip(queries, values)
+        ]
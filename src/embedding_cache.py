@@ -0,0 +1,199 @@
+"""The embedding_cache.py file defines a content-addressed cache of embeddings.
+
+Embeddings are keyed by the encoder model and the SHA-256 of the embedded text, so
+the same text is only ever embedded once per model: re-uploads of a page to another
+partition, identical chunks across chunk sizes and repeated queries all hit the
+cache. Lookups go through an in-process LRU first and then through a local SQLite
+store that persists across restarts, with one query per batch of missing keys.
+Both levels hold the vectors as float32, as stored on disk, so a text gets the
+same vector from either level.
+
+The cache is configured with the following environment variables:
+    - `EMBEDDING_CACHE_PATH`: The SQLite file (default `.cache/embeddings.sqlite3`).
+      Set it to an empty string to only keep the in-process LRU.
+    - `EMBEDDING_CACHE_SIZE`: The number of embeddings kept in the LRU (default 10000)
+"""
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple
+
+# A cached embedding is identified by the model name and the hash of the text
+CacheKey = Tuple[str, bytes]
+
+# The number of keys per lookup query, within SQLite's limit of bound variables
+_QUERY_BATCH_SIZE = 500
+
+
+@dataclass
+class EmbeddingCacheStats:
+    """Counters describing how the embedding cache has been used."""
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups that did not need a new embedding."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+
+class EmbeddingCache:
+    """A two level (LRU and SQLite) cache of embeddings."""
+
+    def __init__(self, path: Optional[str] = None, max_memory_items: int = 10000):
+        self.path = path
+        self.max_memory_items = max_memory_items
+
+        self._memory: "OrderedDict[CacheKey, List[float]]" = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+        # Guards the LRU and the stats, and is never held during SQLite queries
+        self._lock = threading.Lock()
+        # Serializes the use of the SQLite connection
+        self._db_lock = threading.Lock()
+        self.stats = EmbeddingCacheStats()
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        """Create an embedding cache configured from the environment."""
+        return cls(
+            path=os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3") or None,
+            max_memory_items=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+        )
+
+    @staticmethod
+    def key(model_name: str, text: str) -> CacheKey:
+        """Get the cache key of the given text embedded with the given model."""
+        return (model_name, sha256(text.encode("utf-8")).digest())
+
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """Open the SQLite store on first use."""
+        if self.path and self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def _pack(vector: List[float]) -> bytes:
+        """Encode a vector as float32."""
+        return array("f", vector).tobytes()
+
+    @staticmethod
+    def _unpack(data: bytes) -> List[float]:
+        """Decode a float32 vector."""
+        return array("f", data).tolist()
+
+    def _load(self, keys: List[CacheKey]) -> Dict[CacheKey, List[float]]:
+        """Read the given keys from the SQLite store, with one query per model and
+        batch of keys."""
+        by_model: Dict[str, List[bytes]] = {}
+        for model, text_hash in keys:
+            by_model.setdefault(model, []).append(text_hash)
+
+        found = {}
+        with self._db_lock:
+            connection = self._get_connection()
+            if connection is None:
+                return found
+            for model, hashes in by_model.items():
+                for i in range(0, len(hashes), _QUERY_BATCH_SIZE):
+                    batch = hashes[i : i + _QUERY_BATCH_SIZE]
+                    rows = connection.execute(
+                        "SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                        f"AND text_hash IN ({', '.join('?' * len(batch))})",
+                        [model, *batch],
+                    )
+                    for text_hash, data in rows:
+                        found[(model, text_hash)] = self._unpack(data)
+        return found
+
+    def _remember(self, key: CacheKey, vector: List[float]) -> None:
+        """Put the vector in the LRU, evicting the least recently used one if full."""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[CacheKey]) -> Dict[CacheKey, List[float]]:
+        """Look up the given keys.
+
+        Args:
+            keys (List[CacheKey]): The keys to look up
+
+        Returns:
+            Dict[CacheKey, List[float]]: The cached vectors of the keys that were found
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing.append(key)
+                    continue
+                self._memory.move_to_end(key)
+                found[key] = vector
+                self.stats.memory_hits += 1
+
+        loaded = self._load(missing) if missing else {}
+        with self._lock:
+            for key, vector in loaded.items():
+                self._remember(key, vector)
+            self.stats.disk_hits += len(loaded)
+            self.stats.misses += len(missing) - len(loaded)
+        found.update(loaded)
+        return found
+
+    def put_many(
+        self, vectors: Dict[CacheKey, List[float]]
+    ) -> Dict[CacheKey, List[float]]:
+        """Store the given vectors in both cache levels.
+
+        Args:
+            vectors (Dict[CacheKey, List[float]]): The vectors to store, by key
+
+        Returns:
+            Dict[CacheKey, List[float]]: The vectors as stored, in float32, which
+                later lookups return
+        """
+        packed = {key: self._pack(vector) for key, vector in vectors.items()}
+        stored = {key: self._unpack(data) for key, data in packed.items()}
+        with self._lock:
+            for key, vector in stored.items():
+                self._remember(key, vector)
+
+        with self._db_lock:
+            connection = self._get_connection()
+            if connection is not None:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) "
+                    "VALUES (?, ?, ?)",
+                    [(*key, data) for key, data in packed.items()],
+                )
+                connection.commit()
+        return stored
+
+    def get_stats(self) -> Dict:
+        """Get the hit and miss counters along with the hit rate."""
+        with self._lock:
+            return {
+                **asdict(self.stats),
+                "hit_rate": self.stats.hit_rate,
+                "memory_items": len(self._memory),
+            }
+
+
+# The process-wide embedding cache shared by every record encoder
+embedding_cache = EmbeddingCache.from_env()
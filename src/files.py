@@ -0,0 +1,211 @@
+"""The files.py file defines the bulk operations on the `files` table.
+
+- `list_files` pages through the files with a keyset cursor: every page starts
+  after the last ID of the previous one, so a page costs an index range scan
+  however deep it is, unlike `OFFSET`. The `content` column, which holds the
+  whole text of every page, is only read when it is asked for.
+- `iter_files` streams the files in batches from a server-side cursor, so that
+  exporting every file holds one batch in memory at a time.
+- `insert_files` inserts many rows with a single `executemany`, without loading
+  them back, instead of adding and refreshing them one by one. The contents are
+  stored compressed and deduplicated (see `src/content_store.py`).
+- `iter_file_body` streams the content of a single file, decompressing it piece by
+  piece.
+"""
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import Row, Select, insert, select
+from sqlalchemy.orm import Session
+
+from src import models
+from src.content_store import (
+    ContentBlob,
+    compress_content,
+    decompress_content,
+    iter_text,
+    put_blobs,
+)
+from src.database import SessionLocal
+from src.metrics import stage
+
+# The number of files returned per page by default, and at most
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The number of files read from the cursor at a time when streaming
+STREAM_BATCH_SIZE = 100
+
+# The columns listed when the content is not asked for
+SUMMARY_COLUMNS = [
+    models.File.id,
+    models.File.filename,
+    models.File.partition,
+    models.File.created_at,
+]
+
+
+# The columns of the content, whether it is stored inline or compressed
+CONTENT_COLUMNS = [
+    models.File.content,
+    models.File.content_hash,
+    models.FileContent.codec,
+    models.FileContent.data,
+]
+
+
+def _select_files(
+    after: Optional[int], partition: Optional[str], include_content: bool
+) -> Select:
+    """Select the files after the cursor, ordered by ID."""
+    if include_content:
+        query = select(*SUMMARY_COLUMNS, *CONTENT_COLUMNS).outerjoin(
+            models.FileContent, models.FileContent.hash == models.File.content_hash
+        )
+    else:
+        query = select(*SUMMARY_COLUMNS)
+    query = query.order_by(models.File.id)
+    if after is not None:
+        query = query.where(models.File.id > after)
+    if partition is not None:
+        query = query.where(models.File.partition == partition)
+    return query
+
+
+def file_dict(row: Row) -> Dict:
+    """Convert a selected file into a dictionary, decompressing its content."""
+    file = row._asdict()
+    if "content_hash" in file:
+        content_hash, codec, data = (
+            file.pop("content_hash"),
+            file.pop("codec"),
+            file.pop("data"),
+        )
+        if content_hash is not None and data is not None:
+            file["content"] = decompress_content(codec, data)
+    return file
+
+
+def list_files(
+    db: Session,
+    after: Optional[int] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    partition: Optional[str] = None,
+    include_content: bool = False,
+) -> Tuple[List[Dict], Optional[int]]:
+    """List a page of files, ordered by ID.
+
+    Args:
+        db (Session): The database session
+        after (Optional[int]): The cursor, i.e. the last ID of the previous page
+        limit (int): The maximum number of files in the page
+        partition (Optional[str]): Only list the files of this partition
+        include_content (bool): Whether to read the content of the files
+
+    Returns:
+        Tuple[List[Dict], Optional[int]]: The files, and the cursor of the next page
+            or None if this is the last page
+    """
+    # Read one more row to know whether there is a next page
+    query = _select_files(after, partition, include_content).limit(limit + 1)
+    rows = db.execute(query).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return [file_dict(row) for row in rows], next_cursor
+
+
+def iter_files(
+    after: Optional[int] = None,
+    partition: Optional[str] = None,
+    include_content: bool = True,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> Iterator[List[Dict]]:
+    """Stream every file after the cursor, ordered by ID, in batches.
+
+    The generator holds its own session, which is closed once it is exhausted or
+    closed, e.g. when the client of a streaming response disconnects.
+
+    Args:
+        after (Optional[int]): Only stream the files after this ID
+        partition (Optional[str]): Only stream the files of this partition
+        include_content (bool): Whether to read the content of the files
+        batch_size (int): The number of files read from the cursor at a time
+
+    Yields:
+        List[Dict]: The next batch of files
+    """
+    db = SessionLocal()
+    try:
+        query = _select_files(after, partition, include_content)
+        result = db.execute(query.execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            yield [file_dict(row) for row in rows]
+    finally:
+        db.close()
+
+
+def find_file(db: Session, filename: str) -> Optional[Row]:
+    """Find a file by name, without reading its content.
+
+    Returns:
+        Optional[Row]: The `filename`, `partition`, inline `content` and compressed
+            `codec` and `data` of the file, or None if it does not exist
+    """
+    query = (
+        select(
+            models.File.filename,
+            models.File.partition,
+            models.File.content,
+            models.FileContent.codec,
+            models.FileContent.data,
+        )
+        .outerjoin(
+            models.FileContent, models.FileContent.hash == models.File.content_hash
+        )
+        # Files are looked up by the partition they were stored under
+        .where(models.File.partition == filename)
+        .limit(1)
+    )
+    return db.execute(query).first()
+
+
+def iter_file_body(file: Row) -> Iterator[str]:
+    """Stream the content of a file found with `find_file`, piece by piece."""
+    if file.data is None:
+        yield file.content
+    else:
+        yield from iter_text(file.codec, file.data)
+
+
+def insert_files(db: Session, rows: List[Dict]) -> int:
+    """Insert many files with a single statement and commit.
+
+    The contents are stored once per unique content, compressed, and the rows only
+    reference them.
+
+    Args:
+        db (Session): The database session
+        rows (List[Dict]): The `filename`, `partition` and `content` of every file.
+            The content is either the text or a `ContentBlob` made ahead of time.
+
+    Returns:
+        int: The number of inserted files
+    """
+    if not rows:
+        return 0
+
+    blobs: Dict[str, ContentBlob] = {}
+    values = []
+    for row in rows:
+        content: Union[str, ContentBlob] = row["content"]
+        if not isinstance(content, ContentBlob):
+            content = compress_content(content)
+        blobs[content.hash] = content
+        values.append({**row, "content": "", "content_hash": content.hash})
+
+    with stage("db_commit"):
+        put_blobs(db, list(blobs.values()))
+        db.execute(insert(models.File), values)
+        db.commit()
+    return len(rows)
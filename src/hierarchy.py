@@ -0,0 +1,267 @@
+"""The hierarchy.py file defines the hierarchy-aware retrieval mode.
+
+The `TokenLengthChunker` stores every document at several chunk sizes. Each chunk is
+tagged with its level (0 for the smallest size of the document), its size, the
+token interval of the document it covers and its number of tokens. In the
+hierarchical retrieval mode, the knowledge base only searches the finest level and
+then assembles the hits:
+    - Hits that cover enough of a larger chunk are promoted to the smallest larger
+      chunk that encloses them, which is fetched by ID
+    - Hits that are next to each other are merged into a single span, as long as
+      the span stays within the largest chunk size
+so the context holds fewer, denser and non-overlapping snippets.
+
+The retrieval mode is configured with the following environment variables:
+    - `RETRIEVAL_MODE`: `flat` (search every chunk size, the default) or
+      `hierarchical`
+    - `HIERARCHY_PROMOTE_RATIO`: The fraction of a larger chunk that its hits must
+      cover for them to be promoted to it (default 0.5)
+"""
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from canopy.knowledge_base.models import KBDocChunkWithScore
+
+# The retrieval modes
+FLAT = "flat"
+HIERARCHICAL = "hierarchical"
+
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", FLAT)
+PROMOTE_RATIO = float(os.getenv("HIERARCHY_PROMOTE_RATIO", "0.5"))
+
+# Fetches the metadata of the chunks with the given IDs, keyed by chunk ID
+FetchChunks = Callable[[List[str]], Dict[str, Dict]]
+
+
+def chunk_metadata(
+    metadata: Dict, level: int, chunk_size: int, token_start: int, token_end: int
+) -> Dict:
+    """Tag the metadata of a document with the position of one of its chunks.
+
+    Args:
+        metadata (Dict): The metadata of the document
+        level (int): The level of the chunk size, 0 being the smallest size
+        chunk_size (int): The size of the chunk in tokens
+        token_start (int): The index of the first token of the chunk
+        token_end (int): The index after the last token of the chunk
+
+    Returns:
+        Dict: The metadata of the chunk
+    """
+    return {
+        **metadata,
+        "chunk_level": level,
+        "chunk_size": chunk_size,
+        "token_start": token_start,
+        "token_end": token_end,
+        # Packs the context without tokenizing the chunk again (see `src/packing.py`)
+        "token_count": token_end - token_start,
+    }
+
+
+def fine_filter(metadata_filter: Optional[Dict]) -> Dict:
+    """Restrict a metadata filter to the finest level of every document."""
+    return {**(metadata_filter or {}), "chunk_level": 0}
+
+
+@dataclass
+class Span:
+    """A token interval of a document that is part of the context."""
+
+    id: str
+    document_id: str
+    start: int
+    end: int
+    score: float
+    source: str = ""
+    metadata: Dict = field(default_factory=dict)
+    text: Optional[str] = None
+
+    # The spans that were promoted to this one, if its text still has to be fetched
+    children: List["Span"] = field(default_factory=list)
+
+    @classmethod
+    def from_hit(cls, hit: KBDocChunkWithScore) -> Optional["Span"]:
+        """Make a span from a search hit, or None if it has no offsets."""
+        if "token_start" not in hit.metadata or "token_end" not in hit.metadata:
+            return None
+        return cls(
+            id=hit.id,
+            document_id=hit.document_id,
+            start=int(hit.metadata["token_start"]),
+            end=int(hit.metadata["token_end"]),
+            score=hit.score,
+            source=hit.source,
+            metadata=hit.metadata,
+            text=hit.text,
+        )
+
+    def to_hit(self) -> KBDocChunkWithScore:
+        """Convert the span back into a search hit."""
+        return KBDocChunkWithScore(
+            id=self.id,
+            text=self.text,
+            document_id=self.document_id,
+            score=self.score,
+            source=self.source,
+            metadata={
+                **self.metadata,
+                "chunk_size": self.end - self.start,
+                "token_start": self.start,
+                "token_end": self.end,
+                "token_count": self.end - self.start,
+            },
+        )
+
+
+def promote(spans: List[Span], sizes: List[int], ratio: float) -> List[Span]:
+    """Promote groups of spans to the smallest larger chunk that encloses them.
+
+    A group is promoted if it has at least two spans and they cover at least `ratio`
+    of the enclosing chunk. Spans are promoted a single level up, so that promoted
+    chunks stay small enough to be packed into the context.
+
+    Args:
+        spans (List[Span]): The spans to promote
+        sizes (List[int]): The chunk sizes of the documents
+        ratio (float): The fraction of an enclosing chunk that must be covered
+
+    Returns:
+        List[Span]: The spans after promotion. Promoted spans have no text yet.
+    """
+    groups = defaultdict(list)
+    promoted = []
+    for span in spans:
+        # The smallest chunk size that can enclose the span
+        size = next((size for size in sorted(sizes) if size > span.end - span.start), 0)
+        parent_index = span.start // size if size else 0
+        if size and (span.end - 1) // size == parent_index:
+            groups[(span.document_id, size, parent_index)].append(span)
+        else:
+            promoted.append(span)
+
+    for (document_id, size, parent_index), group in groups.items():
+        covered = sum(span.end - span.start for span in group)
+        if len(group) < 2 or covered < ratio * size:
+            promoted.extend(group)
+            continue
+
+        promoted.append(
+            Span(
+                id=f"{document_id}-{size}-{parent_index}",
+                document_id=document_id,
+                start=parent_index * size,
+                end=(parent_index + 1) * size,
+                score=max(span.score for span in group),
+                source=group[0].source,
+                metadata=group[0].metadata,
+                children=group,
+            )
+        )
+
+    return promoted
+
+
+def fill_texts(spans: List[Span], fetch: FetchChunks) -> List[Span]:
+    """Fetch the text of the promoted spans.
+
+    Promoted chunks that do not exist, e.g. because the document is too short or was
+    chunked at other sizes, are replaced by the spans they were promoted from.
+
+    Args:
+        spans (List[Span]): The spans, some of them without text
+        fetch (FetchChunks): Fetches chunks by ID
+
+    Returns:
+        List[Span]: The spans, all of them with text
+    """
+    filled = []
+    while spans:
+        missing = [span for span in spans if span.text is None]
+        fetched = fetch([span.id for span in missing]) if missing else {}
+
+        pending = []
+        for span in spans:
+            if span.text is not None:
+                filled.append(span)
+            elif span.id in fetched:
+                metadata = dict(fetched[span.id])
+                span.text = metadata.pop("text")
+                span.end = int(metadata.get("token_end", span.end))
+                span.children = []
+                filled.append(span)
+            else:
+                pending.extend(span.children)
+        spans = pending
+
+    return filled
+
+
+def merge_adjacent(spans: List[Span], max_tokens: Optional[int] = None) -> List[Span]:
+    """Merge the spans of a document that are next to each other.
+
+    A span is not merged into the previous one if the merged span would be longer
+    than `max_tokens`, so that it still fits in the contexts its spans fit in.
+
+    Args:
+        spans (List[Span]): Non-overlapping spans with text
+        max_tokens (Optional[int]): The number of tokens of a merged span, at most.
+            Spans are merged regardless of their length if None.
+
+    Returns:
+        List[Span]: The merged spans, with the best score of the spans they hold
+    """
+    merged: List[Span] = []
+    for span in sorted(spans, key=lambda span: (span.document_id, span.start)):
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and previous.document_id == span.document_id
+            and previous.end == span.start
+            and (max_tokens is None or span.end - previous.start <= max_tokens)
+        ):
+            previous.id = f"{span.document_id}-{previous.start}:{span.end}"
+            previous.end = span.end
+            previous.text += span.text
+            previous.score = max(previous.score, span.score)
+        else:
+            merged.append(span)
+    return merged
+
+
+def assemble(
+    hits: List[KBDocChunkWithScore],
+    sizes: List[int],
+    fetch: FetchChunks,
+    ratio: float = PROMOTE_RATIO,
+) -> List[KBDocChunkWithScore]:
+    """Assemble the hits of a fine level search into the context candidates.
+
+    Args:
+        hits (List[KBDocChunkWithScore]): The hits of the fine level search
+        sizes (List[int]): The chunk sizes of the documents
+        fetch (FetchChunks): Fetches chunks by ID
+        ratio (float): The fraction of a larger chunk that must be covered
+
+    Returns:
+        List[KBDocChunkWithScore]: The promoted and merged hits, best score first.
+            Merged hits are no longer than the largest chunk size.
+    """
+    spans = []
+    untagged = []
+    for hit in hits:
+        span = Span.from_hit(hit)
+        if span is None:
+            # Chunks stored before they were tagged are used as they are
+            untagged.append(hit)
+        else:
+            spans.append(span)
+
+    spans = merge_adjacent(
+        fill_texts(promote(spans, sizes, ratio), fetch), max(sizes, default=None)
+    )
+    return sorted(
+        [span.to_hit() for span in spans] + untagged, key=lambda hit: -hit.score
+    )
@@ -0,0 +1,215 @@
+"""The ingest.py file defines the bulk ingestion pipeline for Wikipedia pages.
+
+The pipeline takes a list of pages and:
+    1. Checks which pages are already stored with a single batched query
+    2. Looks up the latest revisions of the remaining pages, 50 pages per request
+       (see `src/wiki_client.py`), then fetches, chunks, embeds and upserts them
+       concurrently. Fetching and storing are separate stages, each bounded by the
+       job's concurrency limit
+    3. Inserts the new `files` rows in batches, with one statement per batch,
+       instead of committing row by row. Their contents are compressed as soon as
+       the pages are stored (see `src/content_store.py`)
+
+A page that fails at any step, including the insert of its batch of rows, is
+recorded in the job's errors and does not stop the other pages. The queued rows
+are inserted whenever the job ends.
+
+Every run is tracked by an `IngestJob`, so that it can either be awaited directly
+or run in the background and polled for its progress.
+"""
+import asyncio
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from src import models
+from src.concurrency import run_blocking
+from src.content_store import compress_content
+from src.database import run_in_session
+from src.files import insert_files
+from src.knowledge import astore_document
+from src.metrics import log, with_trace
+from src.wiki_client import wiki_client
+from src.wikipedia import fetch_wiki_data
+
+# The number of new `files` rows inserted per commit
+DB_BATCH_SIZE = 20
+
+
+@dataclass
+class IngestJob:  # pylint: disable=too-many-instance-attributes
+    """The state and progress of a bulk ingestion job."""
+
+    pages: List[str]
+    should_filter: bool = True
+    chunk_size: int = 0
+    concurrency: int = 8
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    status: str = "pending"
+    added: List[str] = field(default_factory=list)
+    already_present: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def titles(self) -> List[str]:
+        """The unique page titles of the job, in order."""
+        return list(dict.fromkeys(page.split("/")[-1] for page in self.pages))
+
+    def progress(self) -> Dict:
+        """Get the job's status and progress."""
+        total = len(self.titles)
+        processed = len(self.added) + len(self.already_present) + len(self.errors)
+        return {
+            **asdict(self),
+            "total": total,
+            "processed": processed,
+        }
+
+
+class _FileWriter:
+    """Inserts new `files` rows in batches, and records their pages in the job as
+    added once they are inserted."""
+
+    def __init__(self, job: IngestJob, batch_size: int = DB_BATCH_SIZE):
+        self.job = job
+        self.batch_size = batch_size
+        self._rows: List[Dict] = []
+        self._titles: List[str] = []
+
+    async def add(self, title: str, row: Dict) -> None:
+        """Queue the row of a page, inserting the queued rows once a batch is full.
+
+        The content is compressed right away, so that the queue does not hold the
+        texts of the pages.
+        """
+        content = await run_blocking(compress_content, row["content"])
+        self._rows.append({**row, "content": content})
+        self._titles.append(title)
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Insert every queued row with a single statement.
+
+        If the insert fails, every page of the batch is recorded as failed.
+        """
+        rows, self._rows = self._rows, []
+        titles, self._titles = self._titles, []
+        if not rows:
+            return
+
+        try:
+            await run_in_session(insert_files, rows)
+        except Exception as exp:  # pylint: disable=broad-except
+            log(f"Failed to insert the files of {len(titles)} pages: {exp}")
+            for title in titles:
+                self.job.errors[title] = str(exp)
+            return
+        self.job.added.extend(titles)
+
+
+def _find_present(db: Session, titles: List[str]) -> set:
+    """Get the titles that are already stored, with a single query."""
+    rows = db.query(models.File.partition).filter(models.File.partition.in_(titles))
+    return {row.partition for row in rows}
+
+
+@with_trace
+async def run_job(job: IngestJob) -> IngestJob:
+    """Run the ingestion pipeline for the given job.
+
+    Args:
+        job (IngestJob): The job to run
+
+    Returns:
+        IngestJob: The finished job
+    """
+    job.status = "running"
+    titles = job.titles
+
+    present = await run_in_session(_find_present, titles) if titles else set()
+    job.already_present.extend(title for title in titles if title in present)
+    missing = [title for title in titles if title not in present]
+
+    try:
+        revisions = await run_blocking(wiki_client.lookup_revisions, missing)
+    except Exception as exp:  # pylint: disable=broad-except
+        # Every page looks its revision up on its own instead
+        log(f"Failed to look up the revisions of {len(missing)} pages: {exp}")
+        revisions = {}
+
+    fetch_limit = asyncio.Semaphore(job.concurrency)
+    store_limit = asyncio.Semaphore(job.concurrency)
+    writer = _FileWriter(job)
+
+    async def ingest_page(title: str) -> None:
+        try:
+            async with fetch_limit:
+                wiki_payload = await run_blocking(
+                    fetch_wiki_data,
+                    page=title,
+                    should_filter=job.should_filter,
+                    revid=revisions.get(title),
+                )
+            async with store_limit:
+                await astore_document(
+                    wiki_payload["content"],
+                    wiki_payload["partition_name"],
+                    chunk_size=job.chunk_size,
+                )
+            await writer.add(
+                title,
+                {
+                    "filename": wiki_payload["partition_name"].split(":")[1],
+                    "partition": wiki_payload["partition_name"].split(":")[0],
+                    "content": wiki_payload["content"],
+                },
+            )
+        except Exception as exp:  # pylint: disable=broad-except
+            log(f"Failed to ingest page {title}: {exp}")
+            job.errors[title] = str(exp)
+
+    try:
+        await asyncio.gather(*(ingest_page(title) for title in missing))
+    except BaseException:
+        job.status = "failed"
+        raise
+    finally:
+        # The pages stored before the job ended still get their rows
+        await writer.flush()
+
+    job.status = "completed"
+    return job
+
+
+class JobRegistry:
+    """An in-process registry of the most recent ingestion jobs."""
+
+    def __init__(self, max_jobs: int = 100):
+        self.max_jobs = max_jobs
+        self._jobs: Dict[str, IngestJob] = {}
+
+    def create(self, **kwargs) -> IngestJob:
+        """Create and register a new job, forgetting the oldest finished jobs."""
+        job = IngestJob(**kwargs)
+        self._jobs[job.id] = job
+
+        finished = [
+            job_id
+            for job_id, old_job in self._jobs.items()
+            if old_job.status in ("completed", "failed")
+        ]
+        for job_id in finished[: max(len(self._jobs) - self.max_jobs, 0)]:
+            del self._jobs[job_id]
+
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        """Get the job with the given ID."""
+        return self._jobs.get(job_id)
+
+
+# The process-wide registry of ingestion jobs
+ingest_jobs = JobRegistry()
@@ -3,20 +3,68 @@
 To make things simple, the file only has one exported member, which is the 
 `store_data` function. This function is called by the `/store` endpoint.
 """
+import asyncio
+import math
 import os
-from typing import List
+import re
+from collections import Counter, deque
+from hashlib import blake2b
+from itertools import islice
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from canopy.knowledge_base import KnowledgeBase
 from canopy.knowledge_base.chunker.base import Chunker
-from canopy.knowledge_base.models import KBDocChunk
-from canopy.models.data_models import Document
-from canopy.tokenizer import Tokenizer
+from canopy.knowledge_base.knowledge_base import RESERVED_METADATA_KEYS
+from canopy.knowledge_base.models import (
+    DocumentWithScore,
+    KBDocChunk,
+    KBEncodedDocChunk,
+    KBQuery,
+    KBQueryResult,
+    QueryResult,
+)
+from canopy.models.data_models import Document, Query
 
-from src.partition import PartitionedDocument
+from src.catalog import CatalogEntry, partition_catalog
+from src.concurrency import run_blocking
+from src.embedding import ExpertRecordEncoder
+from src.hierarchy import (
+    HIERARCHICAL,
+    RETRIEVAL_MODE,
+    assemble,
+    chunk_metadata,
+    fine_filter,
+)
+from src.local_index import LocalIndex, local_indexes
+from src.metrics import chunks_total, log, stage, tokens_total, with_trace
+from src.partition import Partition, PartitionedDocument, get_partition
+from src.pool import KnowledgeBasePool
+from src.query_cache import query_cache
+from src.revisions import ChunkDiff, chunk_hashes, diff_chunks
+from src.scheduler import partition_writes
+from src.settings import LazyTokenizer, get_settings
 
 # The name of the Pinecone index to use for the knowledge base
 INDEX_NAME = os.getenv("INDEX_NAME")
 
+# Keyed documents are split into sections after sentences and lines
+_SECTION_UNIT_PATTERN = re.compile(r"(?<=[.!?]\s)|(?<=\n)")
+# The longest section, in characters, so that it has at most `_SECTION_SPAN` tokens
+_MAX_SECTION_CHARS = 2**18
+# The token offsets reserved for every section of a keyed document
+_SECTION_SPAN = 2**20
+# Token offsets are stored as float64 metadata, which is exact up to 2**53
+_MAX_TOKEN_OFFSET = 2**53
+
 
 class TokenLengthChunker(Chunker):
     """A document chunker that chunks documents based on the number of tokens.
@@ -30,47 +78,260 @@ class TokenLengthChunker(Chunker):
 
     This process will be terminated early if the document is less than 512 tokens (or
     256 tokens, 128 tokens, etc.)
+
+    Keyed documents are chunked by sections instead (see `iter_keyed_chunks`), so
+    that an edit only changes the chunks of the section it falls in.
     """
 
     def __init__(self, chunk_size: int = 0):
-        self.tokenizer = Tokenizer()
+        self.tokenizer = LazyTokenizer()
 
         # The chunk sizes that we make chunks for
         self.sizes = [chunk_size] if chunk_size > 0 else [64, 128, 256, 512]
 
-    def _make_chunks(
-        self, document: Document, tokens: List[str], chunk_size: int
-    ) -> List[KBDocChunk]:
+        # Whether detokenizing adjacent blocks separately and joining the text gives
+        # the same result as detokenizing the blocks together. Probed on first use.
+        self._joinable: Optional[bool] = None
+
+    @staticmethod
+    def _make_chunk(  # pylint: disable=too-many-arguments
+        document: Document,
+        chunk_size: int,
+        chunk_index: int,
+        text: str,
+        level: int = 0,
+        num_tokens: Optional[int] = None,
+    ) -> KBDocChunk:
+        """Make a single chunk of the given document.
+
+        The chunk is built with `model_construct`, which skips validation of the
+        already validated document fields. Its metadata is tagged with the level,
+        size and token interval of the chunk for hierarchy-aware retrieval.
+        """
+        token_start = chunk_index * chunk_size
+        token_end = token_start + chunk_size
+        if num_tokens is not None:
+            token_end = min(token_end, num_tokens)
+
+        return KBDocChunk.model_construct(
+            # Id the chunk by the document id, the chunk size, and the chunk index
+            id=f"{document.id}-{chunk_size}-{chunk_index}",
+            document_id=document.id,
+            text=text,
+            source=document.source,
+            metadata=chunk_metadata(
+                document.metadata, level, chunk_size, token_start, token_end
+            ),
+        )
+
+    def _is_joinable(self, tokens: List[str], block_size: int) -> bool:
+        """Check whether blocks of detokenized text can be joined into larger chunks.
+
+        Args:
+            tokens (List[str]): The document tokens
+            block_size (int): The size of the base blocks
+
+        Returns:
+            bool: Whether joining detokenized blocks is exact for this tokenizer
+        """
+        if self._joinable is None:
+            if len(tokens) < 2 * block_size:
+                return False
+
+            joined = self.tokenizer.detokenize(
+                tokens[:block_size]
+            ) + self.tokenizer.detokenize(tokens[block_size : 2 * block_size])
+            self._joinable = joined == self.tokenizer.detokenize(tokens[: 2 * block_size])
+
+        return self._joinable
+
+    def _make_chunks(  # pylint: disable=too-many-arguments
+        self,
+        document: Document,
+        tokens: List[str],
+        chunk_size: int,
+        level: int = 0,
+        first_token: int = 0,
+    ) -> Iterator[KBDocChunk]:
         """Make chunks of the given size from the given tokens.
 
         Args:
             tokens (List[str]): The tokens to chunk
             chunk_size (int): The size of the chunks
+            level (int): The level of the chunk size, 0 being the smallest size
+            first_token (int): The offset of the tokens in the document, a multiple
+                of the chunk size
 
         Returns:
-            List[KBDocChunk]: The list of chunks
+            Iterator[KBDocChunk]: The chunks
         """
-        chunks = []
-
-        print(f"Making chunks of size {chunk_size} for document {document.id}")
-
         # Iterate over the document tokens in chunks of the given size
         for i in range(0, len(tokens), chunk_size):
-            # Create the chunk text by detokenizing the tokens and compute the index of the chunk
             chunk_text = self.tokenizer.detokenize(tokens[i : i + chunk_size])
-            chunk_index = i // chunk_size
-
-            chunk = KBDocChunk(
-                # Id the chunk by the document id, the chunk size, and the chunk index
-                id=f"{document.id}-{chunk_size}-{chunk_index}",
-                document_id=document.id,
-                text=chunk_text,
-                source=document.source,
-                metadata=document.metadata,
+            yield self._make_chunk(
+                document,
+                chunk_size,
+                (first_token + i) // chunk_size,
+                chunk_text,
+                level,
+                first_token + len(tokens),
             )
-            chunks.append(chunk)
 
-        return chunks
+    def iter_chunks(
+        self, document: Document, text: Optional[str] = None, first_token: int = 0
+    ) -> Iterator[KBDocChunk]:
+        """Chunk a single document at every chunk size in a single pass.
+
+        The document is detokenized once, in blocks of the smallest chunk size. Each
+        larger chunk size that is a multiple of the smallest one is built by joining
+        adjacent blocks, as soon as its last block has been detokenized. Sizes that
+        are not a multiple, or tokenizers for which joining is not exact, fall back
+        to detokenizing the exact chunk boundaries.
+
+        Args:
+            document (Document): The document to chunk
+            text (Optional[str]): The part of the document to chunk, all of it by
+                default
+            first_token (int): The offset of the part in the document, a multiple
+                of every chunk size
+
+        Returns:
+            Iterator[KBDocChunk]: The chunks, in the order they are completed
+        """
+        # Tokenize the document text
+        with stage("tokenize"):
+            tokens = self.tokenizer.tokenize(document.text if text is None else text)
+        tokens_total.inc(len(tokens))
+        if not tokens:
+            return
+        chunk_sizes = sorted(size for size in self.sizes if size <= len(tokens))
+
+        # If the doucment is less than 64 tokens, we will simply chunk the entire document
+        # as one chunk. A short section is a partial chunk of the smallest size instead,
+        # so that its offset stays a multiple of the chunk size.
+        if not chunk_sizes:
+            chunk_size = min(self.sizes) if first_token else len(tokens)
+            yield from self._make_chunks(
+                document, tokens, chunk_size, first_token=first_token
+            )
+            return
+
+        block_size = chunk_sizes[0]
+        joinable = self._is_joinable(tokens, block_size)
+        levels = {size: level for level, size in enumerate(chunk_sizes)}
+
+        # The number of base blocks that make up a chunk, for every joined chunk size
+        blocks_per_chunk = {
+            size: size // block_size
+            for size in chunk_sizes[1:]
+            if joinable and size % block_size == 0
+        }
+        exact_sizes = [size for size in chunk_sizes[1:] if size not in blocks_per_chunk]
+
+        # Only the most recent blocks are needed to build the next larger chunks
+        blocks = deque(maxlen=max(blocks_per_chunk.values(), default=1))
+        num_blocks = -(-len(tokens) // block_size)
+        num_tokens = first_token + len(tokens)
+        for block_index in range(num_blocks):
+            start = block_index * block_size
+            block_text = self.tokenizer.detokenize(tokens[start : start + block_size])
+            blocks.append(block_text)
+            yield self._make_chunk(
+                document,
+                block_size,
+                first_token // block_size + block_index,
+                block_text,
+                0,
+                num_tokens,
+            )
+
+            is_last_block = block_index == num_blocks - 1
+            for size, per_chunk in blocks_per_chunk.items():
+                if (block_index + 1) % per_chunk == 0 or is_last_block:
+                    # The final chunk of a size may be made of fewer blocks
+                    count = block_index % per_chunk + 1
+                    chunk_text = "".join(islice(blocks, len(blocks) - count, None))
+                    yield self._make_chunk(
+                        document,
+                        size,
+                        first_token // size + block_index // per_chunk,
+                        chunk_text,
+                        levels[size],
+                        num_tokens,
+                    )
+
+        for size in exact_sizes:
+            yield from self._make_chunks(
+                document, tokens, size, levels[size], first_token
+            )
+
+    def sections(self, text: str) -> List[str]:
+        """Split a text into sections at boundaries that only depend on the text
+        around them.
+
+        The text is split after every sentence and line, and a section ends after
+        a sentence or line with a probability proportional to its length, drawn
+        from its hash, so that sections hold about 4 chunks of the smallest size,
+        or one of the largest, on average. Editing the text only changes the
+        section it falls in, or merges it with the next one.
+
+        Args:
+            text (str): The text of the document
+
+        Returns:
+            List[str]: The sections, which join back into the text
+        """
+        target = max(4 * min(self.sizes), max(self.sizes))
+        sections: List[str] = []
+        current: List[str] = []
+        length = 0
+        for unit in _SECTION_UNIT_PATTERN.split(text):
+            for start in range(0, len(unit), _MAX_SECTION_CHARS):
+                part = unit[start : start + _MAX_SECTION_CHARS]
+                if current and length + len(part) > _MAX_SECTION_CHARS:
+                    sections.append("".join(current))
+                    current, length = [], 0
+                current.append(part)
+                length += len(part)
+
+                digest = blake2b(part.encode("utf-8"), digest_size=8).digest()
+                if int.from_bytes(digest, "big") % target < len(part) // 4 + 1:
+                    sections.append("".join(current))
+                    current, length = [], 0
+
+        if current:
+            sections.append("".join(current))
+        return sections
+
+    def iter_keyed_chunks(self, document: Document) -> Iterator[KBDocChunk]:
+        """Chunk a keyed document section by section.
+
+        The token offsets, and so the chunk IDs, of every section are drawn from
+        the hash of its text rather than from its position, so that the sections an
+        edit did not touch keep their chunks. Every section gets `_SECTION_SPAN`
+        tokens, aligned on every chunk size, so that chunks of different sections
+        never overlap or join in the hierarchical retrieval.
+
+        Args:
+            document (Document): The keyed document to chunk
+
+        Returns:
+            Iterator[KBDocChunk]: The chunks of every section
+        """
+        span = math.lcm(*self.sizes) * -(-_SECTION_SPAN // math.lcm(*self.sizes))
+        num_slots = _MAX_TOKEN_OFFSET // span
+        used = set()
+        occurrences: Counter = Counter()
+        for section in self.sections(document.text):
+            # Repeated sections are told apart by their occurrence
+            occurrences[section] += 1
+            key = f"{occurrences[section]}:{section}".encode("utf-8")
+            digest = blake2b(key, digest_size=8).digest()
+            slot = int.from_bytes(digest, "big") % num_slots
+            while slot in used:
+                slot = (slot + 1) % num_slots
+            used.add(slot)
+            yield from self.iter_chunks(document, section, slot * span)
 
     def chunk_single_document(self, document: Document) -> List[KBDocChunk]:
         """Chunk a single document into multiple chunks.
@@ -81,69 +342,438 @@ class TokenLengthChunker(Chunker):
         Returns:
             List[KBDocChunk]: The list of chunks
         """
-        # Tokenize the document text
-        tokens = self.tokenizer.tokenize(document.text)
-        chunk_sizes = [size for size in self.sizes if size <= len(tokens)]
+        with stage("chunk"):
+            chunks = list(self.iter_chunks(document))
+        self._count(chunks)
+        return chunks
 
-        # If the doucment is less than 64 tokens, we will simply chunk the entire document
-        # as one chunk
-        if not chunk_sizes:
-            chunks = self._make_chunks(document, tokens, len(tokens))
-            return chunks
+    def chunk_keyed_document(self, document: Document) -> List[KBDocChunk]:
+        """Chunk a keyed document section by section (see `iter_keyed_chunks`).
 
-        print(
-            f"Chunking document {document.id} into {len(chunk_sizes)} different chunk sizes"
-        )
-        # Otherwise, if the document is at least 64 tokens, we will chunk it into multiple
-        # chunks of varying sizes
-        chunks = []
-        for size in chunk_sizes:
-            new_chunks = self._make_chunks(document, tokens, size)
-            chunks.extend(new_chunks)
-
-        print(f"Chunked document {document.id} into {len(chunks)} chunks")
+        Args:
+            document (Document): The document to chunk
+
+        Returns:
+            List[KBDocChunk]: The list of chunks
+        """
+        with stage("chunk"):
+            chunks = list(self.iter_keyed_chunks(document))
+        self._count(chunks)
         return chunks
 
+    def _count(self, chunks: List[KBDocChunk]) -> None:
+        """Count the chunks made at every chunk size."""
+        # Documents smaller than every chunk size make a single chunk of their size
+        for size, count in Counter(
+            chunk.metadata.get("chunk_size") for chunk in chunks
+        ).items():
+            chunks_total.inc(count, str(size) if size in self.sizes else "document")
+
     async def achunk_single_document(self, document: Document) -> List[KBDocChunk]:
-        """Async implementation of document chunking."""
-        raise NotImplementedError()
+        """Chunk a single document without blocking the event loop.
+
+        Tokenization is CPU-bound, so the synchronous chunker is run on a worker
+        thread of the current executor.
+
+        Args:
+            document (Document): The document to chunk
+
+        Returns:
+            List[KBDocChunk]: The list of chunks
+        """
+        return await run_blocking(self.chunk_single_document, document)
+
+    async def achunk_keyed_document(self, document: Document) -> List[KBDocChunk]:
+        """Async version of `chunk_keyed_document`."""
+        return await run_blocking(self.chunk_keyed_document, document)
+
+
+def check_metadata(documents: Iterable[Union[Document, KBDocChunk]]) -> None:
+    """Reject the documents whose metadata uses the keys Canopy stores chunk fields
+    under, as `KnowledgeBase.upsert` does.
+
+    Raises:
+        ValueError: If a document has a reserved metadata key
+    """
+    for doc in documents:
+        forbidden_keys = set(doc.metadata).intersection(RESERVED_METADATA_KEYS)
+        if forbidden_keys:
+            raise ValueError(
+                f"Document with id {doc.id} contains reserved metadata keys: "
+                f"{forbidden_keys}. Please remove them and try again."
+            )
 
 
 class ExpertKnowledgeBase(KnowledgeBase):
     """The Knowledge Base for the AIA Experts. Managed through Canopy."""
 
-    def __init__(self, chunk_size: int = 0, index_name: str = INDEX_NAME, chunker: Chunker = None):
+    def __init__(
+        self,
+        chunk_size: int = 0,
+        index_name: str = INDEX_NAME,
+        chunker: Chunker = None,
+        retrieval_mode: str = RETRIEVAL_MODE,
+    ):
         # Set the default Chunker if none is provided
         if not chunker:
             chunker = TokenLengthChunker(chunk_size=chunk_size)
 
+        # Whether queries search every chunk size or only the finest level
+        self.retrieval_mode = retrieval_mode
+
+        # The index name before Canopy adds its prefix, which selects local indexes
+        self.requested_index_name = index_name
+
         # Instantiate the KnowledgeBase class
-        super().__init__(index_name=index_name, chunker=chunker)
+        super().__init__(
+            index_name=index_name, record_encoder=ExpertRecordEncoder(), chunker=chunker
+        )
 
         # Connect to the index
         self.connect()
 
+    def connect(self) -> None:
+        """Connect to the index, or open it locally if it is served locally.
+
+        Local indexes (see `src/local_index.py`) are selected by the name the
+        knowledge base was created with.
+        """
+        if self._index is None and local_indexes.is_local(self.requested_index_name):
+            self._index = local_indexes.get(self.requested_index_name)
+            return
+        super().connect()
+
+    def _is_serverless_env(self) -> bool:
+        # Local indexes support deleting by metadata filter
+        if isinstance(self._index, LocalIndex):
+            return False
+        return super()._is_serverless_env()
+
+    def _write_chunks(
+        self,
+        document_ids: List[str],
+        encoded_chunks: List[KBEncodedDocChunk],
+        namespace: str,
+        batch_size: int,
+        show_progress_bar: bool = False,
+    ) -> Dict[str, int]:
+        """Replace the stored chunks of the given documents with the encoded chunks.
+
+        Args:
+            document_ids (List[str]): The IDs of the documents the chunks belong to
+            encoded_chunks (List[KBEncodedDocChunk]): The encoded chunks to write
+            namespace (str): The namespace to write to
+            batch_size (int): The number of vectors per upsert request
+            show_progress_bar (bool): Whether to show a progress bar while upserting
+
+        Returns:
+            Dict[str, int]: The number of chunks written for every document ID
+        """
+        if self._index is None:
+            raise RuntimeError(self._connection_error_msg)
+
+        # The number of chunks per document may have changed, so remove the existing
+        # chunks of these documents before writing the new ones. Like Canopy, this is
+        # skipped on serverless indexes, which do not support deleting by metadata.
+        with stage("vector_upsert"):
+            if not self._is_serverless_env():
+                self.delete(document_ids=document_ids, namespace=namespace)
+
+            self._index.upsert(
+                [chunk.to_db_record() for chunk in encoded_chunks],
+                namespace=namespace,
+                batch_size=batch_size,
+                show_progress=show_progress_bar,
+            )
+        return dict(Counter(chunk.document_id for chunk in encoded_chunks))
+
     def upsert(
         self,
         documents: List[Document],
         namespace: str = "",
         batch_size: int = 200,
         show_progress_bar: bool = False,
-    ):
+    ) -> Dict[str, int]:
         """Upsert the given documents into the knowledge base.
 
         Args:
             documents (List[Document]): The documents to upsert
+
+        Returns:
+            Dict[str, int]: The number of chunks stored for every document ID
+        """
+        check_metadata(documents)
+        chunks = self._chunker.chunk_documents(documents)
+        encoded_chunks = self._encoder.encode_documents(chunks)
+        return self._write_chunks(
+            [doc.id for doc in documents],
+            encoded_chunks,
+            namespace,
+            batch_size,
+            show_progress_bar,
+        )
+
+    async def aupsert(
+        self,
+        documents: List[Document],
+        namespace: str = "",
+        batch_size: int = 200,
+    ) -> Dict[str, int]:
+        """Upsert the given documents into the knowledge base asynchronously.
+
+        Chunking runs on a worker thread, embedding uses the async OpenAI client and
+        the blocking Pinecone writes run on the I/O thread pool.
+
+        Args:
+            documents (List[Document]): The documents to upsert
+
+        Returns:
+            Dict[str, int]: The number of chunks stored for every document ID
+        """
+        check_metadata(documents)
+        chunks = await self._chunker.achunk_documents(documents)
+        return await self.aupsert_chunks(
+            [doc.id for doc in documents], chunks, namespace, batch_size
+        )
+
+    async def aupsert_chunks(
+        self,
+        document_ids: List[str],
+        chunks: List[KBDocChunk],
+        namespace: str = "",
+        batch_size: int = 200,
+    ) -> Dict[str, int]:
+        """Embed and upsert chunks that were made ahead of time, e.g. in another
+        process, replacing the stored chunks of their documents.
+
+        Args:
+            document_ids (List[str]): The IDs of the documents the chunks belong to
+            chunks (List[KBDocChunk]): The chunks of the documents
+
+        Returns:
+            Dict[str, int]: The number of chunks stored for every document ID
+        """
+        check_metadata(chunks)
+        encoded_chunks = await self._encoder.aencode_documents(chunks)
+        return await run_blocking(
+            self._write_chunks, document_ids, encoded_chunks, namespace, batch_size
+        )
+
+    def _write_diff(
+        self,
+        encoded_chunks: List[KBEncodedDocChunk],
+        stale_ids: List[str],
+        namespace: str,
+        batch_size: int,
+    ) -> None:
+        """Upsert the changed chunks of a keyed document and delete its stale ones."""
+        if self._index is None:
+            raise RuntimeError(self._connection_error_msg)
+
+        with stage("vector_upsert"):
+            if encoded_chunks:
+                self._index.upsert(
+                    [chunk.to_db_record() for chunk in encoded_chunks],
+                    namespace=namespace,
+                    batch_size=batch_size,
+                )
+            if stale_ids:
+                self._index.delete(ids=stale_ids, namespace=namespace)
+
+    def diff_document(self, document: Document, stored: Dict[str, str]) -> ChunkDiff:
+        """Chunk a keyed document and diff its chunks against the stored ones.
+
+        Args:
+            document (Document): The new revision of the document
+            stored (Dict[str, str]): The hash of every stored chunk, by ID
+
+        Returns:
+            ChunkDiff: The changed chunks and the stale chunk IDs
+        """
+        check_metadata([document])
+        return diff_chunks(self._chunker.chunk_keyed_document(document), stored)
+
+    async def adiff_document(
+        self, document: Document, stored: Dict[str, str]
+    ) -> ChunkDiff:
+        """Async version of `diff_document`, chunking on a worker thread."""
+        check_metadata([document])
+        chunks = await self._chunker.achunk_keyed_document(document)
+        return diff_chunks(chunks, stored)
+
+    def update_chunks(
+        self, diff: ChunkDiff, namespace: str = "", batch_size: int = 200
+    ) -> None:
+        """Embed and upsert only the changed chunks of a keyed document, and delete
+        its stale chunks.
+
+        Args:
+            diff (ChunkDiff): The diff of the document against its stored chunks
+        """
+        encoded_chunks = (
+            self._encoder.encode_documents(diff.changed) if diff.changed else []
+        )
+        self._write_diff(encoded_chunks, diff.stale, namespace, batch_size)
+
+    async def aupdate_chunks(
+        self, diff: ChunkDiff, namespace: str = "", batch_size: int = 200
+    ) -> None:
+        """Async version of `update_chunks`."""
+        encoded_chunks = (
+            await self._encoder.aencode_documents(diff.changed) if diff.changed else []
+        )
+        await run_blocking(
+            self._write_diff, encoded_chunks, diff.stale, namespace, batch_size
+        )
+
+    def delete_documents(self, document_ids: List[str], namespace: str = "") -> None:
+        """Delete every chunk of the given documents.
+
+        Serverless indexes do not support deleting by metadata filter, so the chunks
+        are listed by ID prefix and deleted by ID instead.
+
+        Args:
+            document_ids (List[str]): The IDs of the documents to delete
+            namespace (str): The namespace to delete from
+        """
+        if self._index is None:
+            raise RuntimeError(self._connection_error_msg)
+
+        if not self._is_serverless_env():
+            self.delete(document_ids=document_ids, namespace=namespace)
+            return
+
+        for document_id in document_ids:
+            prefix = f"{document_id}-"
+            for chunk_ids in self._index.list(prefix=prefix, namespace=namespace):
+                self._index.delete(ids=chunk_ids, namespace=namespace)
+
+    def delete_partition(
+        self,
+        partition: Partition,
+        document_ids: List[str],
+        namespace: str = "",
+    ) -> None:
+        """Delete every chunk stored under the given partition.
+
+        Indexes that support deleting by metadata filter delete the chunks matching
+        the partition filter. Serverless indexes do not, so the chunks of the given
+        documents are listed by ID prefix and deleted by ID instead.
+
+        Args:
+            partition (Partition): The partition to delete
+            document_ids (List[str]): The IDs of the documents of the partition
+            namespace (str): The namespace to delete from
+        """
+        if self._index is None:
+            raise RuntimeError(self._connection_error_msg)
+
+        if not self._is_serverless_env():
+            self._index.delete(filter=partition.get_filter(), namespace=namespace)
+            return
+
+        self.delete_documents(document_ids, namespace)
+
+    def fetch_chunks(
+        self, ids: List[str], namespace: Optional[str] = None
+    ) -> Dict[str, Dict]:
+        """Fetch stored chunks by ID.
+
+        Args:
+            ids (List[str]): The chunk IDs
+            namespace (Optional[str]): The namespace to fetch from
+
+        Returns:
+            Dict[str, Dict]: The metadata (including the text) of the chunks that
+                exist, keyed by chunk ID
+        """
+        if self._index is None:
+            raise RuntimeError(self._connection_error_msg)
+
+        response = self._index.fetch(ids=ids, namespace=namespace)
+        return {
+            chunk_id: dict(vector["metadata"])
+            for chunk_id, vector in response["vectors"].items()
+        }
+
+    def _query_index(
+        self,
+        query: KBQuery,
+        global_metadata_filter: Optional[dict],
+        namespace: Optional[str] = None,
+    ) -> KBQueryResult:
+        """Query the index for a single encoded query.
+
+        In the hierarchical retrieval mode, only the finest level of the documents is
+        searched and the hits are promoted to larger chunks or merged (see
+        `src/hierarchy.py`).
         """
+        with stage("vector_query"):
+            if self.retrieval_mode != HIERARCHICAL:
+                return super()._query_index(query, global_metadata_filter, namespace)
+
+            fine_query = query.model_copy(
+                update={"metadata_filter": fine_filter(query.metadata_filter)}
+            )
+            result = super()._query_index(fine_query, global_metadata_filter, namespace)
+            documents = assemble(
+                result.documents,
+                getattr(self._chunker, "sizes", []),
+                lambda ids: self.fetch_chunks(ids, namespace=namespace),
+            )
+            return KBQueryResult(query=result.query, documents=documents)
 
-        super().upsert(
-            documents,
-            namespace=namespace,
-            batch_size=batch_size,
-            show_progress_bar=show_progress_bar,
+    async def aquery(
+        self,
+        queries: List[Query],
+        global_metadata_filter: Optional[dict] = None,
+        namespace: Optional[str] = None,
+    ) -> List[QueryResult]:
+        """Query the knowledge base asynchronously.
+
+        The queries are embedded with one async OpenAI call and the Pinecone queries
+        run concurrently on the I/O thread pool.
+
+        Args:
+            queries (List[Query]): The queries to run
+            global_metadata_filter (Optional[dict]): A filter applied to every query
+            namespace (Optional[str]): The namespace to query
+
+        Returns:
+            List[QueryResult]: The result of each query, in order
+        """
+        encoded_queries = await self._encoder.aencode_queries(queries)
+        results = await asyncio.gather(
+            *(
+                run_blocking(self._query_index, query, global_metadata_filter, namespace)
+                for query in encoded_queries
+            )
         )
+        results = self._reranker.rerank(results)
+
+        return [
+            QueryResult(
+                query=result.query,
+                documents=[
+                    DocumentWithScore(**doc.model_dump(exclude={"document_id"}))
+                    for doc in result.documents
+                ],
+            )
+            for result in results
+        ]
+
+
+def _create_knowledge_base(index_name: str, chunk_size: int) -> ExpertKnowledgeBase:
+    """Create a connected knowledge base, validating the settings on first use."""
+    get_settings()
+    return ExpertKnowledgeBase(chunk_size=chunk_size, index_name=index_name)
+
 
+# The process-wide pool of connected knowledge bases, keyed by (index_name, chunk_size)
+kb_pool = KnowledgeBasePool(factory=_create_knowledge_base)
 
+
+@with_trace
 def store_document(content: str, partition_name: str, chunk_size: int) -> Document:
     """Create a chunked document and store the chunks under the
     given partition name.
@@ -156,10 +786,349 @@ def store_document(content: str, partition_name: str, chunk_size: int) -> Docume
     # Create a document object
     doc = PartitionedDocument(partition_name, content)
 
-    # Create a knowledge base object
-    kb = ExpertKnowledgeBase(chunk_size=chunk_size)
+    # Get a connected knowledge base from the pool
+    kb = kb_pool.get_knowledge_base(INDEX_NAME, chunk_size)
 
     # Upsert the document into the knowledge base
-    kb.upsert([doc])
+    try:
+        chunk_counts = kb.upsert([doc])
+    except Exception:
+        # Make sure a broken connection is replaced on the next request
+        kb_pool.invalidate(INDEX_NAME, chunk_size)
+        raise
+
+    # Cached contexts of the partition may be missing the new document
+    query_cache.invalidate(partition_name)
+    partition_catalog.record([(partition_name, doc.id, chunk_counts.get(doc.id, 0))])
 
     return doc
+
+
+@with_trace
+async def astore_document(content: str, partition_name: str, chunk_size: int) -> Document:
+    """Async version of `store_document`.
+
+    Args:
+        content (str): The content of the document
+        partition_name (str): The name of the partition to store the document under
+    """
+    doc = PartitionedDocument(partition_name, content)
+
+    async def write() -> None:
+        # Getting a pooled knowledge base may connect to the index, which blocks
+        kb = await run_blocking(kb_pool.get_knowledge_base, INDEX_NAME, chunk_size)
+
+        try:
+            chunk_counts = await kb.aupsert([doc])
+        except Exception:
+            kb_pool.invalidate(INDEX_NAME, chunk_size)
+            raise
+
+        await query_cache.ainvalidate(partition_name)
+        await run_blocking(
+            partition_catalog.record,
+            [(partition_name, doc.id, chunk_counts.get(doc.id, 0))],
+        )
+
+    # Concurrent stores of the same content under the partition are written once
+    await partition_writes.run(
+        partition_name, ("store", partition_name, doc.id, chunk_size), write
+    )
+    return doc
+
+
+def _update_result(doc: Document, diff: ChunkDiff) -> Dict:
+    """Summarize the update of a keyed document."""
+    return {
+        "document_id": doc.id,
+        "embedded": len(diff.changed),
+        "deleted": len(diff.stale),
+        "unchanged": diff.unchanged,
+    }
+
+
+@with_trace
+def update_document(content: str, partition_name: str, chunk_size: int) -> Dict:
+    """Store a new revision of the document of a partition, only embedding and
+    upserting the chunks that changed since the stored revision.
+
+    The document is keyed by its partition (see `src/revisions.py`). The chunks of
+    documents stored under the partition by `store_document` are deleted, so that
+    the partition only holds the new revision.
+
+    Args:
+        content (str): The content of the document
+        partition_name (str): The `expert_name:document_name` of the document
+
+    Returns:
+        Dict: The document ID and the number of embedded, deleted and unchanged
+            chunks
+    """
+    doc = PartitionedDocument(partition_name, content, keyed=True)
+    kb = kb_pool.get_knowledge_base(INDEX_NAME, chunk_size)
+
+    diff = kb.diff_document(doc, chunk_hashes.hashes(doc.id))
+    previous = [
+        document_id
+        for document_id in partition_catalog.document_ids(partition_name)
+        if document_id != doc.id
+    ]
+
+    try:
+        kb.update_chunks(diff)
+        if previous:
+            kb.delete_documents(previous)
+    except Exception:
+        kb_pool.invalidate(INDEX_NAME, chunk_size)
+        raise
+
+    chunk_hashes.apply(doc.id, diff)
+    if diff.changed or diff.stale or previous:
+        query_cache.invalidate(partition_name)
+    partition_catalog.replace(partition_name, doc.id, len(diff.hashes))
+
+    return _update_result(doc, diff)
+
+
+@with_trace
+async def aupdate_document(content: str, partition_name: str, chunk_size: int) -> Dict:
+    """Async version of `update_document`.
+
+    Args:
+        content (str): The content of the document
+        partition_name (str): The `expert_name:document_name` of the document
+    """
+    doc = PartitionedDocument(partition_name, content, keyed=True)
+
+    # The diff must not interleave with another revision of the document
+    async def write() -> Dict:
+        kb = await run_blocking(kb_pool.get_knowledge_base, INDEX_NAME, chunk_size)
+
+        stored = await run_blocking(chunk_hashes.hashes, doc.id)
+        diff = await kb.adiff_document(doc, stored)
+        previous = [
+            document_id
+            for document_id in await run_blocking(
+                partition_catalog.document_ids, partition_name
+            )
+            if document_id != doc.id
+        ]
+
+        try:
+            await kb.aupdate_chunks(diff)
+            if previous:
+                await run_blocking(kb.delete_documents, previous)
+        except Exception:
+            kb_pool.invalidate(INDEX_NAME, chunk_size)
+            raise
+
+        await run_blocking(chunk_hashes.apply, doc.id, diff)
+        if diff.changed or diff.stale or previous:
+            await query_cache.ainvalidate(partition_name)
+        await run_blocking(
+            partition_catalog.replace, partition_name, doc.id, len(diff.hashes)
+        )
+
+        return _update_result(doc, diff)
+
+    # pylint: disable-next=protected-access
+    revision = PartitionedDocument._get_uuid(content)
+    return await partition_writes.run(
+        partition_name, ("update", partition_name, revision, chunk_size), write
+    )
+
+
+class DocumentInput(NamedTuple):
+    """A document to store with `store_documents`."""
+
+    content: str
+    partition_name: str
+    chunk_size: int = 0
+
+
+# The documents of a batch grouped by chunk size, and the index of each document's
+# result for every chunk size
+_DocumentGroups = Tuple[Dict[int, Dict[str, Document]], Dict[int, List[int]]]
+
+
+def _group_documents(
+    documents: List[DocumentInput],
+) -> Tuple[_DocumentGroups, List[Dict]]:
+    """Create the partitioned documents of a batch, grouped by chunk size.
+
+    Documents with identical content hash to the same ID, so they are only chunked
+    and embedded once per chunk size. Their chunks have the same IDs, at every
+    chunk size the sizes share, so they can only be stored under one partition: a
+    document with the same content as an earlier document of the batch, but
+    another partition, is reported as not stored.
+
+    Args:
+        documents (List[DocumentInput]): The documents of the batch
+
+    Returns:
+        Tuple[_DocumentGroups, List[Dict]]: The grouped documents and the result of
+            every document, in order
+    """
+    groups: Dict[int, Dict[str, Document]] = {}
+    members: Dict[int, List[int]] = {}
+    # The partition that every document is stored under, by document ID
+    owners: Dict[str, str] = {}
+    results = []
+    for i, document in enumerate(documents):
+        try:
+            doc = PartitionedDocument(document.partition_name, document.content)
+        except ValueError as exp:
+            results.append({"document_id": None, "error": str(exp)})
+            continue
+
+        owner = owners.setdefault(doc.id, document.partition_name)
+        if get_partition(owner) != get_partition(document.partition_name):
+            results.append(
+                {
+                    "document_id": None,
+                    "error": (
+                        f"A document with the same content is stored under {owner} "
+                        f"in this batch"
+                    ),
+                }
+            )
+            continue
+
+        groups.setdefault(document.chunk_size, {}).setdefault(doc.id, doc)
+        members.setdefault(document.chunk_size, []).append(i)
+        results.append({"document_id": doc.id, "error": None})
+
+    return (groups, members), results
+
+
+def _catalog_entries(
+    documents: List[DocumentInput],
+    results: List[Dict],
+    indices: List[int],
+    chunk_counts: Dict[str, int],
+) -> List[CatalogEntry]:
+    """Get the catalog entries of the stored documents of a chunk size group."""
+    return [
+        (
+            documents[i].partition_name,
+            results[i]["document_id"],
+            chunk_counts.get(results[i]["document_id"], 0),
+        )
+        for i in indices
+    ]
+
+
+def _fail_group(results: List[Dict], indices: List[int], exp: Exception) -> None:
+    """Record the failure of a chunk size group on every document of the group."""
+    log(f"Failed to store {len(indices)} documents: {exp}")
+    for i in indices:
+        results[i]["error"] = "Error while saving the document"
+
+
+@with_trace
+def store_documents(documents: List[DocumentInput], batch_size: int = 200) -> List[Dict]:
+    """Store a batch of documents, upserting the chunks of every document together.
+
+    The chunks of all the documents that share a chunk size are embedded and upserted
+    in full batches instead of one document at a time.
+
+    Args:
+        documents (List[DocumentInput]): The documents to store
+        batch_size (int): The number of vectors per upsert request
+
+    Returns:
+        List[Dict]: The `document_id` and `error` of every document, in order
+    """
+    (groups, members), results = _group_documents(documents)
+
+    for chunk_size, docs in groups.items():
+        kb = kb_pool.get_knowledge_base(INDEX_NAME, chunk_size)
+        try:
+            chunk_counts = kb.upsert(list(docs.values()), batch_size=batch_size)
+        except Exception as exp:  # pylint: disable=broad-except
+            kb_pool.invalidate(INDEX_NAME, chunk_size)
+            _fail_group(results, members[chunk_size], exp)
+            continue
+
+        for i in members[chunk_size]:
+            query_cache.invalidate(documents[i].partition_name)
+        partition_catalog.record(
+            _catalog_entries(documents, results, members[chunk_size], chunk_counts)
+        )
+
+    return results
+
+
+@with_trace
+async def astore_documents(
+    documents: List[DocumentInput], batch_size: int = 200
+) -> List[Dict]:
+    """Async version of `store_documents`, storing every chunk size concurrently.
+
+    Args:
+        documents (List[DocumentInput]): The documents to store
+        batch_size (int): The number of vectors per upsert request
+
+    Returns:
+        List[Dict]: The `document_id` and `error` of every document, in order
+    """
+    (groups, members), results = _group_documents(documents)
+
+    async def store_group(chunk_size: int, docs: List[Document]) -> None:
+        kb = await run_blocking(kb_pool.get_knowledge_base, INDEX_NAME, chunk_size)
+        try:
+            chunk_counts = await kb.aupsert(docs, batch_size=batch_size)
+        except Exception as exp:  # pylint: disable=broad-except
+            kb_pool.invalidate(INDEX_NAME, chunk_size)
+            _fail_group(results, members[chunk_size], exp)
+            return
+
+        for i in members[chunk_size]:
+            await query_cache.ainvalidate(documents[i].partition_name)
+        await run_blocking(
+            partition_catalog.record,
+            _catalog_entries(documents, results, members[chunk_size], chunk_counts),
+        )
+
+    async with partition_writes.lock(
+        document.partition_name for document in documents
+    ):
+        await asyncio.gather(
+            *(
+                store_group(chunk_size, list(docs.values()))
+                for chunk_size, docs in groups.items()
+            )
+        )
+    return results
+
+
+@with_trace
+def delete_partition(partition_name: str) -> Dict:
+    """Delete every chunk, catalog entry and file stored under the given partition.
+
+    Args:
+        partition_name (str): The name of the partition to delete
+
+    Returns:
+        Dict: The partition name and the number of documents and files removed
+    """
+    partition = get_partition(partition_name)
+    document_ids = partition_catalog.document_ids(partition_name)
+    # Deleting an expert also deletes the documents of its document partitions,
+    # whose cached contexts are keyed by their own generations
+    invalidated = [partition_name]
+    if partition.document_name is None:
+        invalidated.extend(partition_catalog.document_partitions(partition_name))
+
+    kb = kb_pool.get_knowledge_base(INDEX_NAME)
+    try:
+        kb.delete_partition(partition, document_ids)
+    except Exception:
+        kb_pool.invalidate(INDEX_NAME)
+        raise
+
+    chunk_hashes.remove(document_ids)
+    removed = partition_catalog.remove(partition_name)
+    for name in invalidated:
+        query_cache.invalidate(name)
+    return {"partition_name": partition.name, **removed}
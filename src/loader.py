@@ -0,0 +1,305 @@
+"""The loader.py file defines the corpus loader, which stores a directory of text
+files in the knowledge base.
+
+The files are streamed through a pipeline of two bounded stages:
+    1. Reading, hashing, tokenizing and chunking, which are CPU bound, run in a pool
+       of worker processes, so that they scale with the cores instead of being held
+       back by the GIL. At most two files per worker are in flight.
+    2. Embedding and upserting, which wait on the network, run as a few concurrent
+       async tasks. The chunks of several files are embedded and upserted together,
+       in full batches.
+
+Only the paths are listed up front: the content of a file is read by the worker
+that chunks it, so the memory used does not grow with the size of the corpus.
+
+Every stored file is appended to a checkpoint file, keyed by the expert and chunk
+size it was stored for and by its path, size and modification time. A load that is
+interrupted, or that failed on some files, can be run again with the same checkpoint
+and only stores the files that are new, changed or not stored yet.
+"""
+import asyncio
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Set, TextIO
+
+from canopy.knowledge_base.models import KBDocChunk
+
+from src.catalog import partition_catalog
+from src.concurrency import run_blocking
+from src.knowledge import INDEX_NAME, TokenLengthChunker, kb_pool
+from src.metrics import log, with_trace
+from src.partition import PartitionedDocument
+from src.query_cache import query_cache
+
+DEFAULT_CHECKPOINT_PATH = ".cache/loader-checkpoint.jsonl"
+
+# The number of files whose chunks are embedded and upserted together
+DEFAULT_BATCH_FILES = 16
+
+# The number of batches embedded and upserted concurrently
+DEFAULT_CONCURRENCY = 4
+
+# The chunker of every chunk size, per worker process
+_chunkers: Dict[int, TokenLengthChunker] = {}
+
+
+class SourceFile(NamedTuple):
+    """A file of the corpus and its checkpoint key."""
+
+    path: str
+    key: str
+
+
+class ChunkedFile(NamedTuple):
+    """The chunks of a file, made by a worker process."""
+
+    source: SourceFile
+    partition_name: str
+    document_id: str
+    chunks: List[KBDocChunk]
+
+
+def iter_sources(
+    patterns: Iterable[str], expert_name: str, chunk_size: int
+) -> Iterator[SourceFile]:
+    """List the files of the corpus, without reading them.
+
+    The same file loaded for another expert or at another chunk size has another
+    checkpoint key, so that it is stored again.
+
+    Args:
+        patterns (Iterable[str]): Directories, searched recursively, or glob patterns
+        expert_name (str): The expert the files are stored for
+        chunk_size (int): The chunk size the files are stored at
+
+    Yields:
+        SourceFile: Every regular file, once, in sorted order per pattern
+    """
+    seen: Set[str] = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*")
+        for path in sorted(glob.iglob(pattern, recursive=True)):
+            if path in seen or not os.path.isfile(path):
+                continue
+            seen.add(path)
+            stat = os.stat(path)
+            yield SourceFile(
+                path,
+                f"{expert_name}:{chunk_size}:{path}:{stat.st_size}:{stat.st_mtime_ns}",
+            )
+
+
+def chunk_file(source: SourceFile, expert_name: str, chunk_size: int) -> ChunkedFile:
+    """Read a file and chunk it, in a worker process.
+
+    The file is stored under the partition `expert_name:file_name`.
+
+    Args:
+        source (SourceFile): The file
+        expert_name (str): The expert the file belongs to
+        chunk_size (int): The chunk size, or 0 to chunk at 64, 128, 256 and 512
+            tokens
+
+    Returns:
+        ChunkedFile: The chunks of the file
+    """
+    with open(source.path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if not content.strip():
+        raise ValueError("The file is empty")
+
+    partition_name = f"{expert_name}:{os.path.basename(source.path)}"
+    document = PartitionedDocument(partition_name, content)
+
+    chunker = _chunkers.get(chunk_size)
+    if chunker is None:
+        chunker = _chunkers[chunk_size] = TokenLengthChunker(chunk_size)
+    chunks = chunker.chunk_single_document(document)
+    return ChunkedFile(source, partition_name, document.id, chunks)
+
+
+class Checkpoint:
+    """The keys of the stored files, appended to a JSON lines file."""
+
+    def __init__(self, path: str, restart: bool = False):
+        self.path = path
+        self.done: Set[str] = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        elif os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    # A line cut short by an interruption is ignored
+                    try:
+                        self.done.add(json.loads(line)["key"])
+                    except (ValueError, KeyError):
+                        continue
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file: TextIO = open(path, "a", encoding="utf-8")
+
+    def add(self, files: List[ChunkedFile]) -> None:
+        """Record stored files, flushing them to disk."""
+        for file in files:
+            self.done.add(file.source.key)
+            self._file.write(
+                json.dumps(
+                    {
+                        "key": file.source.key,
+                        "partition_name": file.partition_name,
+                        "document_id": file.document_id,
+                        "chunks": len(file.chunks),
+                    }
+                )
+                + "\n"
+            )
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+@dataclass
+class LoadReport:
+    """The outcome of a corpus load."""
+
+    stored: int = 0
+    chunks: int = 0
+    skipped: int = 0
+    errors: Dict[str, str] = field(default_factory=dict)
+    seconds: float = 0.0
+
+
+async def _store_batch(files: List[ChunkedFile], chunk_size: int) -> Dict[str, int]:
+    """Embed and upsert the chunks of a batch of files, then catalog them."""
+    # Files with identical content hash to the same document, chunked once
+    unique = {file.document_id: file for file in reversed(files)}
+
+    kb = await run_blocking(kb_pool.get_knowledge_base, INDEX_NAME, chunk_size)
+    try:
+        chunk_counts = await kb.aupsert_chunks(
+            list(unique), [chunk for file in unique.values() for chunk in file.chunks]
+        )
+    except Exception:
+        kb_pool.invalidate(INDEX_NAME, chunk_size)
+        raise
+
+    entries = [
+        (file.partition_name, file.document_id, chunk_counts.get(file.document_id, 0))
+        for file in files
+    ]
+    for file in files:
+        await query_cache.ainvalidate(file.partition_name)
+    await run_blocking(partition_catalog.record, entries)
+    return chunk_counts
+
+
+@with_trace
+async def load_corpus(  # pylint: disable=too-many-arguments,too-many-locals
+    patterns: Iterable[str],
+    expert_name: str,
+    chunk_size: int = 0,
+    workers: int = 0,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    batch_files: int = DEFAULT_BATCH_FILES,
+    checkpoint_path: str = DEFAULT_CHECKPOINT_PATH,
+    restart: bool = False,
+) -> LoadReport:
+    """Store the files of a corpus, resuming from the checkpoint.
+
+    Args:
+        patterns (Iterable[str]): Directories, searched recursively, or glob patterns
+        expert_name (str): The expert the files belong to
+        chunk_size (int): The chunk size, or 0 to chunk at 64, 128, 256 and 512
+            tokens
+        workers (int): The number of chunking processes, or 0 for one per CPU
+        concurrency (int): The number of batches embedded and upserted concurrently
+        batch_files (int): The number of files embedded and upserted together
+        checkpoint_path (str): The file recording the stored files
+        restart (bool): Whether to discard the checkpoint and store every file
+
+    Returns:
+        LoadReport: The number of stored and skipped files, and the failures
+    """
+    start = time.perf_counter()
+    report = LoadReport()
+    workers = workers or os.cpu_count() or 1
+    checkpoint = Checkpoint(checkpoint_path, restart)
+    loop = asyncio.get_running_loop()
+
+    # Bounds the chunked files waiting for the embedding stage
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+
+    async def produce(pool: ProcessPoolExecutor) -> None:
+        in_flight: Dict[asyncio.Future, str] = {}
+
+        async def collect(when: str) -> None:
+            done, _ = await asyncio.wait(in_flight, return_when=when)
+            for future in done:
+                path = in_flight.pop(future)
+                try:
+                    await queue.put(future.result())
+                except Exception as exp:  # pylint: disable=broad-except
+                    report.errors[path] = str(exp)
+
+        for source in iter_sources(patterns, expert_name, chunk_size):
+            if source.key in checkpoint.done:
+                report.skipped += 1
+                continue
+            if len(in_flight) >= workers * 2:
+                await collect(asyncio.FIRST_COMPLETED)
+            future = loop.run_in_executor(
+                pool, chunk_file, source, expert_name, chunk_size
+            )
+            in_flight[future] = source.path
+        while in_flight:
+            await collect(asyncio.FIRST_COMPLETED)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def flush(batch: List[ChunkedFile]) -> None:
+        try:
+            await _store_batch(batch, chunk_size)
+        except Exception as exp:  # pylint: disable=broad-except
+            log(f"Failed to store {len(batch)} files: {exp}")
+            for file in batch:
+                report.errors[file.source.path] = "Error while saving the document"
+            return
+
+        checkpoint.add(batch)
+        report.stored += len(batch)
+        report.chunks += sum(len(file.chunks) for file in batch)
+        elapsed = time.perf_counter() - start
+        log(
+            f"Stored {report.stored} files, {report.chunks} chunks "
+            f"({report.stored / elapsed:.1f} files/s)"
+        )
+
+    async def consume() -> None:
+        batch: List[ChunkedFile] = []
+        while True:
+            file = await queue.get()
+            if file is None:
+                break
+            batch.append(file)
+            if len(batch) >= batch_files:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            consumers = [consume() for _ in range(concurrency)]
+            await asyncio.gather(produce(pool), *consumers)
+    finally:
+        checkpoint.close()
+
+    report.seconds = time.perf_counter() - start
+    return report
@@ -0,0 +1,497 @@
+"""The local_index.py file defines a local, in-process vector index.
+
+The `LocalIndex` implements the part of the Pinecone index API that the knowledge
+base uses (`upsert`, `query`, `fetch`, `delete` and `describe_index_stats`), so it
+can stand in for a remote Pinecone index behind the existing `ExpertKnowledgeBase`.
+Queries against it never leave the process, and tests can run without a live
+service.
+
+The vectors are kept in a float32 NumPy array, which is a memory-mapped file when
+the index is stored on disk. The metadata of the vectors is kept in memory and, on
+disk, in a SQLite table next to the vectors. A query scores its candidate rows with
+a single matrix product and selects the top-k with `argpartition`. Candidate rows
+are pre-filtered with an inverted index over the partition fields of the metadata
+(`expert_name`, `document_name` and `document_id`), and any other filter conditions
+are only checked on those candidates.
+
+Indexes are made local with the following environment variables:
+    - `LOCAL_INDEXES`: A comma-separated list of the index names to serve locally
+    - `LOCAL_INDEX_PATH`: The directory the local indexes are stored in (default
+      `.cache/indexes`). Set it to an empty string to keep them in memory only.
+"""
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# The metadata fields with an inverted index, used to pre-filter the candidates
+INDEXED_FIELDS = ("expert_name", "document_name", "document_id")
+
+# The number of rows the vector store grows by, at least
+MIN_CAPACITY = 1024
+
+
+def matches_filter(metadata: Dict, metadata_filter: Optional[Dict]) -> bool:
+    """Check whether the metadata satisfies a Pinecone metadata filter.
+
+    Only the `$eq`, `$ne`, `$in` and `$nin` operators, and plain values, are
+    supported.
+
+    Args:
+        metadata (Dict): The metadata of a vector
+        metadata_filter (Optional[Dict]): The filter
+
+    Returns:
+        bool: Whether the metadata satisfies every condition of the filter
+    """
+    for key, condition in (metadata_filter or {}).items():
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            if operator == "$eq" and value != operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$nin" and value in operand:
+                return False
+    return True
+
+
+class LocalIndex:
+    """A local vector index, in memory or memory-mapped from disk.
+
+    Vectors are scored by their dot product with the query vector, like a Pinecone
+    index with the `dotproduct` metric.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.dimension: Optional[int] = None
+        self._lock = threading.RLock()
+
+        # The vector of every row, the first `_num_rows` rows being in use
+        self._vectors: Optional[np.ndarray] = None
+        self._num_rows = 0
+
+        # The namespace, ID and metadata of every row, None for the free rows
+        self._records: List[Optional[Tuple[str, str, Dict]]] = []
+        self._free_rows: List[int] = []
+        self._rows: Dict[Tuple[str, str], int] = {}
+
+        # The rows of every namespace, and of every (namespace, field, value)
+        self._namespace_rows: Dict[str, Set[int]] = defaultdict(set)
+        self._postings: Dict[Tuple[str, str, Any], Set[int]] = defaultdict(set)
+
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._load()
+
+    # ---------------------------------------------------------------- storage
+
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    def _load(self) -> None:
+        """Open the index stored on disk, creating it if it does not exist."""
+        os.makedirs(self.path, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "records.sqlite3"), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records "
+            "(row INTEGER PRIMARY KEY, namespace TEXT, id TEXT, metadata TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)"
+        )
+        setting = self._db.execute(
+            "SELECT value FROM settings WHERE key = 'dimension'"
+        ).fetchone()
+        if setting is None:
+            return
+
+        self.dimension = int(setting[0])
+        rows = self._db.execute("SELECT row, namespace, id, metadata FROM records")
+        for row, namespace, record_id, metadata in rows:
+            self._ensure_row(row)
+            self._add_record(row, namespace, record_id, json.loads(metadata))
+        self._free_rows = [
+            row for row in range(self._num_rows) if self._records[row] is None
+        ]
+
+        if os.path.exists(self._vectors_path()):
+            capacity = os.path.getsize(self._vectors_path()) // (4 * self.dimension)
+            self._vectors = self._open_vectors(capacity)
+
+    def _open_vectors(self, capacity: int) -> np.memmap:
+        """Memory-map the vectors file, which holds `capacity` rows."""
+        return np.memmap(
+            self._vectors_path(),
+            dtype=np.float32,
+            mode="r+",
+            shape=(capacity, self.dimension),
+        )
+
+    def _grow(self, capacity: int) -> None:
+        """Grow the vector store so that it holds at least `capacity` rows."""
+        current = 0 if self._vectors is None else self._vectors.shape[0]
+        if capacity <= current:
+            return
+        capacity = max(capacity, 2 * current, MIN_CAPACITY)
+
+        if self.path:
+            if self._vectors is not None:
+                self._vectors.flush()
+            with open(self._vectors_path(), "ab") as f:
+                f.truncate(capacity * self.dimension * 4)
+            self._vectors = self._open_vectors(capacity)
+        else:
+            vectors = np.zeros((capacity, self.dimension), dtype=np.float32)
+            if self._vectors is not None:
+                vectors[:current] = self._vectors
+            self._vectors = vectors
+
+    def _ensure_row(self, row: int) -> None:
+        """Make sure the record list has an entry for the given row."""
+        if row >= len(self._records):
+            self._records.extend([None] * (row + 1 - len(self._records)))
+        self._num_rows = max(self._num_rows, row + 1)
+
+    def _add_record(self, row: int, namespace: str, record_id: str, metadata: Dict):
+        """Register a record in the in-memory lookups."""
+        self._records[row] = (namespace, record_id, metadata)
+        self._rows[(namespace, record_id)] = row
+        self._namespace_rows[namespace].add(row)
+        for field in INDEXED_FIELDS:
+            if field in metadata:
+                self._postings[(namespace, field, metadata[field])].add(row)
+
+    def _remove_record(self, row: int, free: bool = True) -> None:
+        """Remove a record from the in-memory lookups and free its row."""
+        namespace, record_id, metadata = self._records[row]
+        self._records[row] = None
+        del self._rows[(namespace, record_id)]
+        self._namespace_rows[namespace].discard(row)
+        for field in INDEXED_FIELDS:
+            if field in metadata:
+                self._postings[(namespace, field, metadata[field])].discard(row)
+        if free:
+            self._free_rows.append(row)
+
+    # ---------------------------------------------------------------- writes
+
+    def upsert(  # pylint: disable=unused-argument
+        self, vectors: List[Dict], namespace: Optional[str] = None, **kwargs
+    ) -> Dict:
+        """Insert or replace the given records.
+
+        Args:
+            vectors (List[Dict]): The records, with an `id`, `values` and `metadata`
+            namespace (Optional[str]): The namespace to write to
+
+        Returns:
+            Dict: The number of records upserted
+        """
+        namespace = namespace or ""
+        if not vectors:
+            return {"upserted_count": 0}
+
+        values = np.asarray([record["values"] for record in vectors], dtype=np.float32)
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = values.shape[1]
+                if self._db is not None:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO settings VALUES ('dimension', ?)",
+                        (self.dimension,),
+                    )
+            if values.shape[1] != self.dimension:
+                raise ValueError(
+                    f"Vector dimension {values.shape[1]} does not match the index "
+                    f"dimension {self.dimension}"
+                )
+
+            rows = []
+            for record in vectors:
+                key = (namespace, record["id"])
+                if key in self._rows:
+                    # Replace the record in place
+                    row = self._rows[key]
+                    self._remove_record(row, free=False)
+                elif self._free_rows:
+                    row = self._free_rows.pop()
+                else:
+                    row = self._num_rows
+                self._ensure_row(row)
+                metadata = dict(record.get("metadata") or {})
+                self._add_record(row, namespace, record["id"], metadata)
+                rows.append(row)
+
+            self._grow(self._num_rows)
+            self._vectors[rows] = values
+
+            if self._db is not None:
+                self._vectors.flush()
+                with self._db:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)",
+                        [
+                            (row, namespace, record_id, json.dumps(metadata))
+                            for row, (_, record_id, metadata) in zip(
+                                rows, (self._records[row] for row in rows)
+                            )
+                        ],
+                    )
+
+        return {"upserted_count": len(vectors)}
+
+    def delete(  # pylint: disable=unused-argument
+        self,
+        ids: Optional[List[str]] = None,
+        delete_all: bool = False,
+        namespace: Optional[str] = None,
+        filter: Optional[Dict] = None,  # pylint: disable=redefined-builtin
+        **kwargs,
+    ) -> Dict:
+        """Delete records by ID, by metadata filter, or all records of a namespace.
+
+        Args:
+            ids (Optional[List[str]]): The IDs of the records to delete
+            delete_all (bool): Whether to delete every record of the namespace
+            namespace (Optional[str]): The namespace to delete from
+            filter (Optional[Dict]): The metadata filter of the records to delete
+
+        Returns:
+            Dict: An empty response, like Pinecone
+        """
+        namespace = namespace or ""
+        with self._lock:
+            rows = {
+                self._rows[(namespace, record_id)]
+                for record_id in ids or []
+                if (namespace, record_id) in self._rows
+            }
+            if delete_all:
+                rows |= self._namespace_rows[namespace]
+            if filter:
+                rows |= set(self._filter_rows(namespace, filter).tolist())
+
+            for row in rows:
+                self._remove_record(row)
+
+            if self._db is not None and rows:
+                with self._db:
+                    self._db.executemany(
+                        "DELETE FROM records WHERE row = ?", [(row,) for row in rows]
+                    )
+        return {}
+
+    # ---------------------------------------------------------------- reads
+
+    def _filter_rows(
+        self, namespace: str, metadata_filter: Optional[Dict]
+    ) -> np.ndarray:
+        """Get the rows of the namespace that satisfy the metadata filter.
+
+        The conditions on indexed fields are resolved with the inverted index. The
+        remaining conditions are only checked on the rows that are left.
+        """
+        candidates = self._namespace_rows[namespace]
+        remaining = {}
+        for key, condition in (metadata_filter or {}).items():
+            if key not in INDEXED_FIELDS:
+                remaining[key] = condition
+                continue
+
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            values: Optional[Iterable] = None
+            if set(condition) == {"$eq"}:
+                values = [condition["$eq"]]
+            elif set(condition) == {"$in"}:
+                values = condition["$in"]
+
+            if values is None:
+                remaining[key] = condition
+                continue
+            rows = set().union(
+                *(self._postings.get((namespace, key, value), ()) for value in values)
+            )
+            candidates = candidates & rows
+
+        if remaining:
+            candidates = [
+                row
+                for row in candidates
+                if matches_filter(self._records[row][2], remaining)
+            ]
+        return np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+
+    def query_batch(
+        self,
+        vectors: List[List[float]],
+        top_k: int,
+        namespace: Optional[str] = None,
+        filter: Optional[Dict] = None,  # pylint: disable=redefined-builtin
+        include_metadata: bool = True,
+    ) -> List[Dict]:
+        """Run several queries with the same filter using one matrix product.
+
+        Args:
+            vectors (List[List[float]]): The query vectors
+            top_k (int): The number of matches per query
+            namespace (Optional[str]): The namespace to query
+            filter (Optional[Dict]): The metadata filter of the matches
+            include_metadata (bool): Whether to include the metadata of the matches
+
+        Returns:
+            List[Dict]: The matches of every query, in order
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        with self._lock:
+            rows = self._filter_rows(namespace or "", filter)
+            if not len(rows) or top_k <= 0:
+                return [{"matches": [], "namespace": namespace or ""} for _ in vectors]
+
+            # Score every candidate against every query at once. When most rows are
+            # candidates, scoring the contiguous block avoids copying the rows.
+            if 2 * len(rows) > self._num_rows:
+                scores = (self._vectors[: self._num_rows] @ queries.T)[rows]
+            else:
+                scores = self._vectors[rows] @ queries.T
+            k = min(top_k, len(rows))
+            best = np.argpartition(-scores, k - 1, axis=0)[:k]
+
+            results = []
+            for query_index in range(len(queries)):
+                top = best[:, query_index]
+                top = top[np.argsort(-scores[top, query_index], kind="stable")]
+                matches = []
+                for candidate in top:
+                    _, record_id, metadata = self._records[rows[candidate]]
+                    score = float(scores[candidate, query_index])
+                    match = {"id": record_id, "score": score}
+                    if include_metadata:
+                        match["metadata"] = dict(metadata)
+                    matches.append(match)
+                results.append({"matches": matches, "namespace": namespace or ""})
+        return results
+
+    def query(  # pylint: disable=unused-argument
+        self,
+        vector: List[float],
+        top_k: int,
+        namespace: Optional[str] = None,
+        filter: Optional[Dict] = None,  # pylint: disable=redefined-builtin
+        include_metadata: bool = True,
+        **kwargs,
+    ) -> Dict:
+        """Get the `top_k` records with the highest dot product with the vector.
+
+        Args:
+            vector (List[float]): The query vector
+            top_k (int): The number of matches
+            namespace (Optional[str]): The namespace to query
+            filter (Optional[Dict]): The metadata filter of the matches
+            include_metadata (bool): Whether to include the metadata of the matches
+
+        Returns:
+            Dict: The matches, best first
+        """
+        return self.query_batch([vector], top_k, namespace, filter, include_metadata)[0]
+
+    def fetch(  # pylint: disable=unused-argument
+        self, ids: List[str], namespace: Optional[str] = None, **kwargs
+    ) -> Dict:
+        """Get the records with the given IDs.
+
+        Args:
+            ids (List[str]): The record IDs
+            namespace (Optional[str]): The namespace to fetch from
+
+        Returns:
+            Dict: The records that exist, keyed by ID
+        """
+        namespace = namespace or ""
+        with self._lock:
+            vectors = {}
+            for record_id in ids:
+                row = self._rows.get((namespace, record_id))
+                if row is not None:
+                    vectors[record_id] = {
+                        "id": record_id,
+                        "values": self._vectors[row].tolist(),
+                        "metadata": dict(self._records[row][2]),
+                    }
+        return {"vectors": vectors, "namespace": namespace}
+
+    def describe_index_stats(self, **kwargs) -> Dict:  # pylint: disable=unused-argument
+        """Get the dimension of the index and the number of vectors per namespace."""
+        with self._lock:
+            namespaces = {
+                namespace: {"vector_count": len(rows)}
+                for namespace, rows in self._namespace_rows.items()
+                if rows
+            }
+            return {
+                "dimension": self.dimension or 0,
+                "namespaces": namespaces,
+                "total_vector_count": len(self._rows),
+            }
+
+    def close(self) -> None:
+        """Flush the vectors and close the metadata store."""
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class LocalIndexRegistry:
+    """The local indexes of the process, one per index name."""
+
+    def __init__(self, names: Iterable[str] = (), path: Optional[str] = None):
+        self.names = {name for name in names if name}
+        self.path = path
+        self._indexes: Dict[str, LocalIndex] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "LocalIndexRegistry":
+        """Create a registry configured from the environment."""
+        return cls(
+            names=os.getenv("LOCAL_INDEXES", "").split(","),
+            path=os.getenv("LOCAL_INDEX_PATH", ".cache/indexes"),
+        )
+
+    def is_local(self, index_name: Optional[str]) -> bool:
+        """Check whether the given index is served locally."""
+        return index_name in self.names
+
+    def get(self, index_name: str) -> LocalIndex:
+        """Get the local index with the given name, opening it on first use."""
+        with self._lock:
+            if index_name not in self._indexes:
+                path = os.path.join(self.path, index_name) if self.path else None
+                self._indexes[index_name] = LocalIndex(path)
+            return self._indexes[index_name]
+
+    def close(self) -> None:
+        """Close every open local index."""
+        with self._lock:
+            for index in self._indexes.values():
+                index.close()
+            self._indexes.clear()
+
+
+# The process-wide registry of local indexes
+local_indexes = LocalIndexRegistry.from_env()
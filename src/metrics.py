@@ -0,0 +1,386 @@
+"""The metrics.py file defines the latency instrumentation of the pipeline.
+
+Every stage of the ingestion and query pipelines is timed with `stage(name)`:
+    - `wiki_fetch` and `html_parse` when ingesting Wikipedia pages
+    - `tokenize`, `chunk`, `embed` and `vector_upsert` when storing documents
+    - `embed`, `vector_query` and `dedup` when querying a context
+    - `db_commit` when writing the catalog or the `files` table
+
+The durations are recorded in a histogram per stage, along with counters of the
+chunks made per chunk size, of the tokens processed and of the embedding requests
+(see `src/dispatcher.py`), and the queue depth and wait times of the scheduler
+pools (see `src/scheduler.py`). They are exposed in the Prometheus text format by
+the `/metrics` endpoint.
+
+Every request also gets a trace ID, taken from its `X-Trace-Id` header or
+generated, which is carried by a context variable through `store_document`,
+`query_context` and the threads they hand work to. Calls made outside of a
+request, e.g. by the loader script, start their own trace (see `with_trace`). The
+`TracingMiddleware` returns the trace ID and the time spent in every stage in the
+`X-Trace-Id` and `Server-Timing` response headers, and logs the requests slower
+than `SLOW_REQUEST_SECONDS` (default 1) with their stage breakdown.
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# The upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "1"))
+
+TRACE_HEADER = "X-Trace-Id"
+
+# The media type of the Prometheus text format
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(label: Optional[str], value: str, extra: str = "") -> str:
+    """Format the labels of a sample."""
+    pairs = []
+    if label is not None:
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{label}="{escaped}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A counter, optionally split by the value of one label."""
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, label_value: str = "") -> None:
+        """Increment the counter of the given label value."""
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        """Render the counter in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for value, count in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label, value)} {count:g}")
+        return lines
+
+
+class Gauge:
+    """A value that goes up and down, optionally split by the value of one label."""
+
+    def __init__(self, name: str, documentation: str, label: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, label_value: str = "") -> None:
+        """Set the value of the given label value."""
+        with self._lock:
+            self._values[label_value] = value
+
+    def render(self) -> List[str]:
+        """Render the gauge in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        with self._lock:
+            for value, current in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label, value)} {current:g}")
+        return lines
+
+
+class Histogram:
+    """A histogram of durations, split by the value of one label."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label: str,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+
+        # The bucket counts, sum and count of every label value
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float) -> None:
+        """Record a duration."""
+        with self._lock:
+            counts, totals = self._series.setdefault(
+                label_value, ([0] * len(self.buckets), [0.0, 0.0])
+            )
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            totals[0] += seconds
+            totals[1] += 1
+
+    def render(self) -> List[str]:
+        """Render the histogram in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for value, (counts, (total, count)) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _labels(self.label, value, f'le="{bound:g}"')
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _labels(self.label, value, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count:g}")
+                lines.append(f"{self.name}_sum{_labels(self.label, value)} {total:.6f}")
+                lines.append(f"{self.name}_count{_labels(self.label, value)} {count:g}")
+        return lines
+
+
+stage_duration = Histogram(
+    "canopy_stage_duration_seconds", "The duration of every pipeline stage.", "stage"
+)
+request_duration = Histogram(
+    "canopy_request_duration_seconds", "The duration of the HTTP requests.", "route"
+)
+chunks_total = Counter(
+    "canopy_chunks_total", "The number of chunks made, by chunk size.", "chunk_size"
+)
+tokens_total = Counter("canopy_tokens_total", "The number of document tokens chunked.")
+embedding_requests_total = Counter(
+    "canopy_embedding_requests_total",
+    "The number of embedding requests sent, by outcome.",
+    "outcome",
+)
+embedding_texts_total = Counter(
+    "canopy_embedding_texts_total", "The number of texts sent to be embedded."
+)
+queue_depth = Gauge(
+    "canopy_scheduler_queue_depth",
+    "The number of requests waiting for a slot, by pool.",
+    "pool",
+)
+in_flight = Gauge(
+    "canopy_scheduler_in_flight", "The number of requests running, by pool.", "pool"
+)
+queue_wait = Histogram(
+    "canopy_scheduler_wait_seconds",
+    "The time requests waited for a slot, by pool.",
+    "pool",
+)
+rejected_total = Counter(
+    "canopy_scheduler_rejected_total",
+    "The number of requests rejected with a 429, by pool.",
+    "pool",
+)
+
+METRICS = [
+    stage_duration,
+    request_duration,
+    chunks_total,
+    tokens_total,
+    embedding_requests_total,
+    embedding_texts_total,
+    queue_depth,
+    in_flight,
+    queue_wait,
+    rejected_total,
+]
+
+
+def render_metrics() -> str:
+    """Render every metric in the Prometheus text format."""
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+@dataclass
+class Trace:
+    """The trace ID of a request and the time it spent in every stage."""
+
+    id: str
+    stages: Dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, stage_name: str, seconds: float) -> None:
+        """Add time spent in a stage, which may run in several threads at once."""
+        with self._lock:
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """Format the stage durations as a `Server-Timing` header value."""
+        with self._lock:
+            return ", ".join(
+                f"{name};dur={seconds * 1000:.1f}"
+                for name, seconds in self.stages.items()
+            )
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    """Get the trace ID of the current request, if any."""
+    trace = _current_trace.get()
+    return trace.id if trace is not None else None
+
+
+@contextmanager
+def traced(trace_id: Optional[str] = None) -> Iterator[Trace]:
+    """Use the current trace, or start a new one for work outside of a request.
+
+    Args:
+        trace_id (Optional[str]): The ID of the new trace, generated if not given
+
+    Yields:
+        Trace: The current trace
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        yield trace
+        return
+
+    trace = Trace(id=trace_id or uuid.uuid4().hex)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def with_trace(func: Callable) -> Callable:
+    """Run a function, sync or async, in the current trace or in a new one."""
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with traced():
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with traced():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a pipeline stage, in the stage histogram and in the current trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_duration.observe(name, elapsed)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+
+def timed(name: str) -> Callable:
+    """Decorate a function, sync or async, to time its calls as a pipeline stage."""
+
+    def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log(message: str) -> None:
+    """Print a message tagged with the current trace ID."""
+    trace_id = current_trace_id()
+    print(f"[trace={trace_id}] {message}" if trace_id else message)
+
+
+class TracingMiddleware:
+    """An ASGI middleware that traces every HTTP request.
+
+    It is a plain ASGI middleware rather than a `BaseHTTPMiddleware`, so that the
+    trace context variable reaches the endpoints and streaming responses are not
+    buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        trace_id = headers.get(TRACE_HEADER.lower().encode(), b"").decode() or None
+        start = time.perf_counter()
+        status = [500]
+
+        with traced(trace_id) as trace:
+
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    status[0] = message["status"]
+                    extra = [(TRACE_HEADER.encode(), trace.id.encode())]
+                    timing = trace.server_timing()
+                    if timing:
+                        extra.append((b"Server-Timing", timing.encode()))
+                    headers = [*message.get("headers", []), *extra]
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                elapsed = time.perf_counter() - start
+                route = scope.get("route")
+                request_duration.observe(getattr(route, "path", "unmatched"), elapsed)
+                if elapsed > SLOW_REQUEST_SECONDS:
+                    stages = [
+                        f"{name}={seconds * 1000:.0f}ms"
+                        for name, seconds in trace.stages.items()
+                    ]
+                    log(
+                        " ".join(
+                            [
+                                f"Slow request {scope['method']} {scope['path']}",
+                                f"{status[0]} {elapsed * 1000:.0f}ms",
+                                *stages,
+                            ]
+                        )
+                    )
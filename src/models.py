@@ -1,12 +1,83 @@
-from .database import Base
-from sqlalchemy import Column, Integer, String, TIMESTAMP, text
+from .database import Base, get_engine
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    TIMESTAMP,
+    func,
+    inspect,
+    text,
+)
 
 
 class File(Base):
     __tablename__ = "files"
+    __table_args__ = (
+        Index("ix_files_partition_filename", "partition", "filename"),
+        # Keyset pagination of the files of a partition
+        Index("ix_files_partition_id", "partition", "id"),
+    )
 
     id = Column(Integer,primary_key=True,nullable=False)
     filename = Column(String,nullable=False)
+    # Empty for the files whose content is in `file_contents`
     content = Column(String,nullable=False)
     partition = Column(String, nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True), server_default=text('now()'))
\ No newline at end of file
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    # The hash of the compressed content (see `src/content_store.py`)
+    content_hash = Column(String, nullable=True)
+
+
+class FileContent(Base):
+    """A compressed file content, shared by the files with the same content."""
+
+    __tablename__ = "file_contents"
+
+    hash = Column(String, primary_key=True)
+    codec = Column(String, nullable=False)
+    # The size of the uncompressed content, in bytes
+    size = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
+class PartitionDocument(Base):
+    """A document stored in the knowledge base, with its number of chunks."""
+
+    __tablename__ = "partition_documents"
+
+    expert_name = Column(String, primary_key=True)
+    # Empty for documents stored under an expert-wide partition
+    document_name = Column(String, primary_key=True, default="")
+    document_id = Column(String, primary_key=True)
+    chunk_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(
+        TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class DocumentChunk(Base):
+    """The content hash of a stored chunk of a keyed document."""
+
+    __tablename__ = "document_chunks"
+
+    chunk_id = Column(String, primary_key=True)
+    document_id = Column(String, nullable=False, index=True)
+    content_hash = Column(String, nullable=False)
+
+
+def create_tables():
+    """Create the missing tables and indexes."""
+    engine = get_engine()
+    Base.metadata.create_all(bind=engine)
+
+    # `create_all` skips the indexes of the tables that already exist
+    for index in File.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+    # and the columns that were added to them since
+    columns = {column["name"] for column in inspect(engine).get_columns("files")}
+    if "content_hash" not in columns:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE files ADD COLUMN content_hash VARCHAR"))
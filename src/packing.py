@@ -0,0 +1,200 @@
+"""The packing.py file defines how retrieved chunks are packed into a token budget.
+
+Every chunk records its number of tokens in its metadata when it is made (see
+`chunk_metadata`), so the context can be packed without tokenizing the snippets
+again at query time. Packing then works on the ranked chunks in three steps:
+    1. Chunks that overlap a better ranked chunk of the same document are dropped,
+       since the documents are stored at several overlapping chunk sizes
+    2. The remaining chunks are selected with a 0/1 knapsack: the selection with
+       the best total score whose tokens fit in the budget. Stuffing the chunks in
+       ranking order instead keeps whatever happens to fit after the first chunks,
+       which often leaves part of the budget unused.
+    3. While budget is left, selected chunks are replaced by the retrieved larger
+       chunks that contain them, best ranked first, so that the context holds
+       more of the text around its best hits
+
+The knapsack runs over at most `MAX_PACKING_CELLS` token capacities. Larger budgets
+are packed in units of several tokens, rounding every chunk up, so a selection
+never exceeds the budget.
+"""
+import re
+from typing import List, NamedTuple, Optional
+
+# The number of token capacities the knapsack is solved for, at most
+MAX_PACKING_CELLS = 512
+
+# The tokens added by the newline that separates two snippets of a context
+SEPARATOR_TOKENS = 1
+
+# The IDs of stored chunks, `{doc}-{size}-{idx}`, and of hierarchical spans,
+# `{doc}-{start}:{end}` (see `src/hierarchy.py`)
+_CHUNK_ID_PATTERN = re.compile(r"^(?P<document_id>.+)-(?:\d+-\d+|\d+:\d+)$")
+
+
+class Candidate(NamedTuple):
+    """A retrieved chunk that may be packed into the context."""
+
+    # The position of the chunk in ranking order
+    position: int
+    # The document of the chunk, or None if it is unknown
+    document_id: Optional[str]
+    start: int
+    end: int
+    tokens: int
+    score: float
+
+
+def document_of(chunk_id: str) -> Optional[str]:
+    """Get the document ID of a chunk from the chunk ID, if it follows our pattern."""
+    match = _CHUNK_ID_PATTERN.match(chunk_id or "")
+    return match["document_id"] if match else None
+
+
+def stored_token_count(metadata: dict) -> Optional[int]:
+    """Get the number of tokens of a chunk from its metadata.
+
+    Args:
+        metadata (dict): The metadata of the chunk
+
+    Returns:
+        Optional[int]: The number of tokens, or None for chunks stored before their
+            token counts were recorded
+    """
+    if "token_count" in metadata:
+        return int(metadata["token_count"])
+    if "token_start" in metadata and "token_end" in metadata:
+        return int(metadata["token_end"]) - int(metadata["token_start"])
+    return None
+
+
+def non_overlapping(candidates: List[Candidate], budget: int) -> List[Candidate]:
+    """Drop the chunks that overlap a better ranked chunk of the same document.
+
+    Chunks that do not fit in the budget on their own are dropped first, so that
+    they do not shadow the smaller chunks they overlap.
+
+    Args:
+        candidates (List[Candidate]): The chunks, in ranking order
+        budget (int): The token budget
+
+    Returns:
+        List[Candidate]: The chunks that are kept, in ranking order
+    """
+    kept: List[Candidate] = []
+    for candidate in candidates:
+        if candidate.tokens + SEPARATOR_TOKENS > budget:
+            continue
+        if candidate.document_id is not None and any(
+            other.document_id == candidate.document_id
+            and other.start < candidate.end
+            and candidate.start < other.end
+            for other in kept
+        ):
+            continue
+        kept.append(candidate)
+    return kept
+
+
+def pack(candidates: List[Candidate], budget: int) -> List[Candidate]:
+    """Select the chunks with the best total score that fit in the token budget.
+
+    Args:
+        candidates (List[Candidate]): Non-overlapping chunks, in ranking order
+        budget (int): The token budget
+
+    Returns:
+        List[Candidate]: The selected chunks, in ranking order
+    """
+    if budget <= 0:
+        return []
+
+    costs = [candidate.tokens + SEPARATOR_TOKENS for candidate in candidates]
+    if sum(costs) <= budget:
+        return candidates
+
+    unit = -(-budget // MAX_PACKING_CELLS)
+    capacity = budget // unit
+    costs = [-(-cost // unit) for cost in costs]
+
+    # Scores only rank the chunks, so the better ranked of two equal chunks wins
+    count = len(candidates)
+    values = [
+        max(candidate.score, 0.0) + 1e-6 * (count - i)
+        for i, candidate in enumerate(candidates)
+    ]
+
+    # The best value with at most `w` units, and whether each chunk was taken
+    best = [0.0] * (capacity + 1)
+    taken = []
+    for cost, value in zip(costs, values):
+        took = bytearray(capacity + 1)
+        for w in range(capacity, cost - 1, -1):
+            with_chunk = best[w - cost] + value
+            if with_chunk > best[w]:
+                best[w] = with_chunk
+                took[w] = 1
+        taken.append(took)
+
+    selected = []
+    w = capacity
+    for i in range(count - 1, -1, -1):
+        if taken[i][w]:
+            selected.append(candidates[i])
+            w -= costs[i]
+    return selected[::-1]
+
+
+def _contains(outer: Candidate, inner: Candidate) -> bool:
+    """Check whether a chunk contains another chunk of the same document."""
+    return (
+        outer.document_id is not None
+        and outer.document_id == inner.document_id
+        and outer.start <= inner.start
+        and inner.end <= outer.end
+    )
+
+
+def expand(
+    selected: List[Candidate], candidates: List[Candidate], budget: int
+) -> List[Candidate]:
+    """Replace selected chunks by larger retrieved chunks that contain them, while
+    they fit in the budget.
+
+    Args:
+        selected (List[Candidate]): The packed chunks, in ranking order
+        candidates (List[Candidate]): Every retrieved chunk, in ranking order
+        budget (int): The token budget
+
+    Returns:
+        List[Candidate]: The chunks of the context, ordered by their best hit
+    """
+    left = budget - sum(candidate.tokens + SEPARATOR_TOKENS for candidate in selected)
+    # Every chunk keeps the rank of the best selected chunk it replaced
+    ranks = {candidate.position: candidate.position for candidate in selected}
+    for candidate in candidates:
+        if candidate.position in ranks or candidate.document_id is None:
+            continue
+        overlapping = [
+            other
+            for other in selected
+            if other.document_id == candidate.document_id
+            and other.start < candidate.end
+            and candidate.start < other.end
+        ]
+        if not overlapping or not all(
+            _contains(candidate, other) for other in overlapping
+        ):
+            continue
+
+        extra = candidate.tokens - sum(other.tokens for other in overlapping)
+        extra -= SEPARATOR_TOKENS * (len(overlapping) - 1)
+        if extra > left:
+            continue
+
+        left -= extra
+        replaced = {other.position for other in overlapping}
+        ranks[candidate.position] = min(ranks.pop(position) for position in replaced)
+        selected = [other for other in selected if other.position not in replaced]
+        selected.append(candidate)
+
+    return sorted(selected, key=lambda candidate: ranks[candidate.position])
@@ -1,49 +1,80 @@
 """The partition.py file defines the partition object, which is used for parsing
 a partition name and returning the appropriate metadata filter.
 
-To make things simple, the file only has one exported member, which is the 
-`PartitionedDocument` class. This class is instantiated with a `partition_value: str` 
+Partition names are parsed and validated once by the partition registry
+(`get_partition`), which caches the resulting immutable `Partition` objects, so
+documents and queries of the same partition share the same precompiled filter.
+
+The `PartitionedDocument` class is instantiated with a `partition_value: str`
 argument and the `content: str` argument. It is a superclass of the Canopy Document
-object.
+object. Its ID is the hash of its content, or of its partition for keyed documents
+(see `src/revisions.py`).
 """
+from dataclasses import dataclass, field
+from functools import lru_cache
 from hashlib import sha3_256
+from types import MappingProxyType
 from uuid import UUID
-from typing import Dict, Optional
+from typing import Dict, Mapping, Optional
 
 from canopy.models.data_models import Document, Query
 
+# The number of parsed partitions kept by the registry
+PARTITION_CACHE_SIZE = 4096
+
+
+@dataclass(frozen=True)
+class Partition:
+    """A parsed partition name of the form `expert_name[:document_name]`."""
+
+    expert_name: str
+    document_name: Optional[str] = None
 
-class Partition:  # pylint: disable=too-few-public-methods
-    """A partition object that can be used to get the metadata filter for a partition."""
+    # The read-only metadata filter of the partition
+    filter: Mapping = field(init=False, repr=False, compare=False)
 
-    def __init__(self, partition_value: str):
-        # Validate the partition value
-        self.partition_value = partition_value
+    def __post_init__(self):
+        metadata_filter = {"expert_name": self.expert_name}
+        if self.document_name is not None:
+            metadata_filter["document_name"] = self.document_name
+        object.__setattr__(self, "filter", MappingProxyType(metadata_filter))
 
-    def get_filter(self) -> str:
+    @property
+    def name(self) -> str:
+        """The partition name."""
+        if self.document_name is None:
+            return self.expert_name
+        return f"{self.expert_name}:{self.document_name}"
+
+    def get_filter(self) -> Dict:
         """Get the filter that can be used to filter documents based on the partition value.
 
         Returns:
-            str: The filter
+            Dict: A copy of the filter, which the caller may modify
         """
-        metadata_filter = {}
-        items = self.partition_value.split(":")
-        for i, item in enumerate(items):
-            match (i):
-                # Extract the expert name
-                case 0:
-                    expert_name = item
-                    metadata_filter["expert_name"] = expert_name
-                case 1:
-                    # Extract the document name
-                    document_name = item
-                    metadata_filter["document_name"] = document_name
-                case _:
-                    raise ValueError(
-                        f"Partition value {self.partition_value} is invalid.\n"
-                        f"It should be of the form `expert_name:document_name`."
-                    )
-        return metadata_filter
+        return dict(self.filter)
+
+
+@lru_cache(maxsize=PARTITION_CACHE_SIZE)
+def get_partition(partition_value: str) -> Partition:
+    """Parse and validate a partition name, once per name.
+
+    Args:
+        partition_value (str): The partition name
+
+    Returns:
+        Partition: The cached partition
+
+    Raises:
+        ValueError: If the partition name has more than two parts
+    """
+    items = partition_value.split(":")
+    if len(items) > 2:
+        raise ValueError(
+            f"Partition value {partition_value} is invalid.\n"
+            f"It should be of the form `expert_name:document_name`."
+        )
+    return Partition(*items)
 
 
 class PartitionedDocument(Document):  # pylint: disable=too-few-public-methods
@@ -51,20 +82,33 @@ class PartitionedDocument(Document):  # pylint: disable=too-few-public-methods
     the partition value.
     """
 
-    def __init__(self, partition_name: str, content: str) -> None:
-        metadata = Partition(partition_name).get_filter()
+    def __init__(self, partition_name: str, content: str, keyed: bool = False) -> None:
+        partition = get_partition(partition_name)
+        metadata = partition.get_filter()
 
         # Set the seed for the UUID from the 8 byte keccak hash of the content str
-        # This way if the same document is uploaded twice, we will not double store it
-
-        super().__init__(id=self._get_uuid(content), text=content, metadata=metadata)
+        # This way if the same document is uploaded twice, we will not double store it.
+        # Keyed documents are identified by their partition instead, so that every
+        # revision of the document keeps the same ID and chunk IDs.
+        if keyed:
+            if partition.document_name is None:
+                raise ValueError(
+                    f"Partition value {partition_name} has no document name.\n"
+                    f"Keyed documents need a partition of the form "
+                    f"`expert_name:document_name`."
+                )
+            seed = f"partition:{partition.name}"
+        else:
+            seed = content
+
+        super().__init__(id=self._get_uuid(seed), text=content, metadata=metadata)
 
     @staticmethod
     def _get_uuid(content: str) -> str:
         """Get the UUID for the document.
 
         Args:
-            content (str): The content of the document
+            content (str): The content of the document, or the key of a keyed document
 
         Returns:
             str: The UUID
@@ -93,10 +137,9 @@ class PartitionedQuery(Query):
         metadata_filter: Optional[Dict] = None,
         **kwargs,
     ) -> None:
-        # Establish the metadata_filter or setup a blank dictionary if none is provided
-        metadata_filter = metadata_filter or {}
-
-        # Update the metadata filter to include the partition filter values
-        metadata_filter.update(Partition(partition_name).get_filter())
-        print(metadata_filter)
+        # Combine the given filter with the partition filter, without modifying either
+        metadata_filter = {
+            **(metadata_filter or {}),
+            **get_partition(partition_name).filter,
+        }
         super().__init__(text=text, metadata_filter=metadata_filter, **kwargs)
@@ -0,0 +1,160 @@
+"""The pool.py file defines a process-wide pool of connected knowledge bases.
+
+Constructing an `ExpertKnowledgeBase` builds a new chunker, a new tokenizer and
+performs a Pinecone `connect()` handshake. The `KnowledgeBasePool` keeps one
+connected knowledge base (and one `ContextEngine`) per `(index_name, chunk_size)`
+key so that requests can reuse them instead of paying that setup cost every time.
+
+Entries are health-checked at most once every `health_check_interval` seconds and
+are reconnected lazily, on the next request, once they are found to be broken or
+are explicitly invalidated by a caller that saw an operation fail. Health checks
+and connections hold a lock of their own key only, so a slow or unreachable index
+does not delay the requests for the other keys.
+"""
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Tuple
+
+from canopy.knowledge_base import KnowledgeBase
+
+from src.context import ExpertContextEngine
+from src.metrics import log
+
+# Pool entries are keyed by the index name and the chunk size of the knowledge base
+PoolKey = Tuple[str, int]
+
+
+@dataclass
+class PoolStats:
+    """Counters describing how the pool has been used."""
+
+    created: int = 0
+    reused: int = 0
+    reconnected: int = 0
+    health_checks: int = 0
+
+
+@dataclass
+class _PoolEntry:
+    """A connected knowledge base and the context engine built on top of it."""
+
+    knowledge_base: KnowledgeBase
+    context_engine: ExpertContextEngine = None
+    last_checked: float = 0.0
+
+
+class KnowledgeBasePool:
+    """A thread-safe pool of connected knowledge bases and context engines."""
+
+    def __init__(
+        self,
+        factory: Callable[[str, int], KnowledgeBase],
+        health_check_interval: float = 60.0,
+    ):
+        # The factory is called with `(index_name, chunk_size)` and must return a
+        # connected knowledge base
+        self._factory = factory
+        self.health_check_interval = health_check_interval
+
+        self._entries: Dict[PoolKey, _PoolEntry] = {}
+        # Guards the entries and the stats, and is never held during network calls
+        self._lock = threading.Lock()
+        # Serializes the health checks and connections of every key
+        self._key_locks: Dict[PoolKey, threading.Lock] = {}
+        self.stats = PoolStats()
+
+    def _is_healthy(self, entry: _PoolEntry) -> bool:
+        """Check the entry's index connection if it has not been checked recently."""
+        now = time.monotonic()
+        if now - entry.last_checked < self.health_check_interval:
+            return True
+
+        with self._lock:
+            self.stats.health_checks += 1
+        try:
+            entry.knowledge_base.verify_index_connection()
+        except Exception as exp:  # pylint: disable=broad-except
+            log(f"Knowledge base connection is broken: {exp}")
+            return False
+
+        entry.last_checked = now
+        return True
+
+    def _get_entry(self, index_name: str, chunk_size: int) -> _PoolEntry:
+        """Get a healthy entry for the given key, connecting a new one if needed."""
+        key = (index_name, chunk_size)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Connecting is done under the key's lock so that concurrent requests for
+        # the same key do not each perform their own handshake
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None and self._is_healthy(entry):
+                with self._lock:
+                    self.stats.reused += 1
+                return entry
+
+            knowledge_base = self._factory(index_name, chunk_size)
+            with self._lock:
+                if entry is not None:
+                    self.stats.reconnected += 1
+                entry = _PoolEntry(
+                    knowledge_base=knowledge_base, last_checked=time.monotonic()
+                )
+                self._entries[key] = entry
+                self.stats.created += 1
+            return entry
+
+    def get_knowledge_base(self, index_name: str, chunk_size: int = 0) -> KnowledgeBase:
+        """Get a connected knowledge base for the given index and chunk size.
+
+        Args:
+            index_name (str): The name of the Pinecone index
+            chunk_size (int): The chunk size of the knowledge base's chunker
+
+        Returns:
+            KnowledgeBase: The pooled knowledge base
+        """
+        return self._get_entry(index_name, chunk_size).knowledge_base
+
+    def get_context_engine(
+        self, index_name: str, chunk_size: int = 0
+    ) -> ExpertContextEngine:
+        """Get a context engine backed by the pooled knowledge base.
+
+        Args:
+            index_name (str): The name of the Pinecone index
+            chunk_size (int): The chunk size of the knowledge base's chunker
+
+        Returns:
+            ExpertContextEngine: The pooled context engine
+        """
+        entry = self._get_entry(index_name, chunk_size)
+        with self._lock:
+            if entry.context_engine is None:
+                entry.context_engine = ExpertContextEngine(entry.knowledge_base)
+            return entry.context_engine
+
+    def invalidate(self, index_name: str, chunk_size: int = 0) -> None:
+        """Force the entry for the given key to be health-checked on its next use.
+
+        Callers should invalidate an entry after an operation on it has failed, so
+        that a broken connection is detected and replaced lazily.
+        """
+        with self._lock:
+            entry = self._entries.get((index_name, chunk_size))
+            if entry is not None:
+                entry.last_checked = 0.0
+
+    def close(self) -> None:
+        """Drop every pooled knowledge base and context engine."""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        """Get the pool usage counters along with the number of pooled entries."""
+        with self._lock:
+            return {**asdict(self.stats), "size": len(self._entries)}
@@ -4,36 +4,186 @@ a partition name and returning the appropriate metadata filter.
 This file implements a `query_documents` function that can be used to query
 the knowledge base for documents under a given partition.
 """
-import json
-from typing import List
+import asyncio
+from typing import Dict, List, NamedTuple, Tuple
 
-from canopy.context_engine import ContextEngine
+from canopy.context_engine.context_builder.stuffing import ContextSnippet
+from canopy.models.data_models import Context
 
-from src.knowledge import ExpertKnowledgeBase
+from src.concurrency import run_blocking
+from src.dedup import unique_snippet_indices
+from src.knowledge import INDEX_NAME, kb_pool
+from src.metrics import stage, with_trace
 from src.partition import PartitionedQuery
+from src.query_cache import CACHE_HIT, CACHE_MISS, query_cache
 
+# The maximum number of queries of a batch
+MAX_BATCH_QUERIES = 100
 
+
+def _unique_snippets(response: Context) -> List[ContextSnippet]:
+    """Get the unique snippets of a context engine response.
+
+    Snippets that are contained in another snippet of the response are dropped,
+    keeping the ranking order of the others.
+    """
+    if not response.content.root:
+        return []
+
+    snippets = response.content.root[0].snippets
+    with stage("dedup"):
+        positions = unique_snippet_indices(
+            [(getattr(snippet, "id", None), snippet.text) for snippet in snippets]
+        )
+    return [snippets[position] for position in positions]
+
+
+def _format_context(response: Context) -> str:
+    """Join the unique snippets of a context engine response into one string."""
+    return "\n".join(snippet.text for snippet in _unique_snippets(response))
+
+
+@with_trace
 def query_context(
     query: str, partition_name: str, max_context_tokens: int = 512
-) -> List:
+) -> str:
     """Query the knowledge base for documents under the given partition."""
     query = PartitionedQuery(query, partition_name)
 
-    # Create a context engine
-    kb = ExpertKnowledgeBase()
-    context_engine = ContextEngine(kb)
-    response = context_engine.query([query], max_context_tokens=max_context_tokens)
-    result = json.loads(response.content.json())
+    # Get a context engine from the pool
+    context_engine = kb_pool.get_context_engine(INDEX_NAME)
+    try:
+        response = context_engine.query([query], max_context_tokens=max_context_tokens)
+    except Exception:
+        # Make sure a broken connection is replaced on the next request
+        kb_pool.invalidate(INDEX_NAME)
+        raise
+
+    return _format_context(response)
+
+
+async def _aquery(query: str, partition_name: str, max_context_tokens: int) -> Context:
+    """Query the async context engine for documents under the given partition."""
+    query = PartitionedQuery(query, partition_name)
+
+    # Getting a pooled context engine may connect to the index, which blocks
+    context_engine = await run_blocking(kb_pool.get_context_engine, INDEX_NAME)
+    try:
+        return await context_engine.aquery([query], max_context_tokens=max_context_tokens)
+    except Exception:
+        kb_pool.invalidate(INDEX_NAME)
+        raise
+
+
+@with_trace
+async def aquery_context(
+    query: str, partition_name: str, max_context_tokens: int = 512
+) -> str:
+    """Async version of `query_context`, using the async context engine."""
+    return _format_context(await _aquery(query, partition_name, max_context_tokens))
+
+
+@with_trace
+async def aquery_snippets(
+    query: str, partition_name: str, max_context_tokens: int = 512
+) -> List[ContextSnippet]:
+    """Like `aquery_context`, but return the unique snippets in ranking order
+    instead of joining them, so that they can be streamed one by one."""
+    return _unique_snippets(await _aquery(query, partition_name, max_context_tokens))
+
+
+@with_trace
+def cached_query_context(
+    query: str, partition_name: str, max_context_tokens: int = 512
+) -> Tuple[str, str]:
+    """Query the context through the query cache.
+
+    Returns:
+        Tuple[str, str]: The context and the cache status (`HIT` or `MISS`)
+    """
+    key, context = query_cache.get(query, partition_name, max_context_tokens)
+    if context is not None:
+        return context, CACHE_HIT
+
+    context = query_context(query, partition_name, max_context_tokens)
+    query_cache.set(key, context)
+    return context, CACHE_MISS
+
+
+@with_trace
+async def acached_query_context(
+    query: str, partition_name: str, max_context_tokens: int = 512
+) -> Tuple[str, str]:
+    """Async version of `cached_query_context`."""
+    key, context = await query_cache.aget(query, partition_name, max_context_tokens)
+    if context is not None:
+        return context, CACHE_HIT
+
+    context = await aquery_context(query, partition_name, max_context_tokens)
+    await query_cache.aset(key, context)
+    return context, CACHE_MISS
+
+
+class ContextRequest(NamedTuple):
+    """A query of a batch of context queries."""
+
+    query: str
+    partition_name: str
+    max_context_tokens: int = 512
+
+
+@with_trace
+async def aquery_context_batch(requests: List[ContextRequest]) -> List[Dict]:
+    """Query the contexts of many queries, with one embedding call for all of them.
+
+    Repeated requests are only queried once, and the requests answered by the query
+    cache are not queried at all. The others are embedded together and searched
+    concurrently, and every context is built with the request's own token budget.
+
+    Args:
+        requests (List[ContextRequest]): The queries
+
+    Returns:
+        List[Dict]: The `context`, cache status (`cache`) and `error` of every
+            request, in order
+    """
+    results: Dict[ContextRequest, Dict] = {}
+    queries: Dict[ContextRequest, PartitionedQuery] = {}
+    for request in dict.fromkeys(requests):
+        if request.max_context_tokens <= 0:
+            results[request] = {
+                "context": None,
+                "cache": None,
+                "error": "`max_context_tokens` must be positive",
+            }
+            continue
+        try:
+            queries[request] = PartitionedQuery(request.query, request.partition_name)
+        except ValueError as exp:
+            results[request] = {"context": None, "cache": None, "error": str(exp)}
 
-    if not result:
-        return ""
+    lookups = await asyncio.gather(*(query_cache.aget(*request) for request in queries))
+    pending: List[Tuple[ContextRequest, str, PartitionedQuery]] = []
+    for (request, query), (key, context) in zip(queries.items(), lookups):
+        if context is not None:
+            results[request] = {"context": context, "cache": CACHE_HIT, "error": None}
+        else:
+            pending.append((request, key, query))
 
-    context = result[0]
-    snippets = [snippet["text"] for snippet in context["snippets"]]
+    if pending:
+        context_engine = await run_blocking(kb_pool.get_context_engine, INDEX_NAME)
+        try:
+            responses = await context_engine.aquery_each(
+                [query for _, _, query in pending],
+                [request.max_context_tokens for request, _, _ in pending],
+            )
+        except Exception:
+            kb_pool.invalidate(INDEX_NAME)
+            raise
 
-    unique_snippets = []
-    for snippet in snippets:
-        if not any(snippet in s for s in snippets if s != snippet):
-            unique_snippets.append(snippet)
+        for (request, key, _), response in zip(pending, responses):
+            context = _format_context(response)
+            await query_cache.aset(key, context)
+            results[request] = {"context": context, "cache": CACHE_MISS, "error": None}
 
-    return "\n".join(unique_snippets)
+    return [results[request] for request in requests]
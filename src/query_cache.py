@@ -0,0 +1,222 @@
+"""The query_cache.py file defines a TTL and LRU cache of `/context` results.
+
+Results are keyed by the `(query, partition_name, max_context_tokens)` triple and by
+the current generation of the queried partition. Storing a document into a
+partition bumps the generation of that partition (and of its expert), so only the
+entries of the partitions that were written to stop matching. Stale entries are
+never read again and simply age out of the cache.
+
+By default the cache lives in process memory. Setting `QUERY_CACHE_URL` to a Redis
+URL shares it between workers instead (this requires the `redis` package). The
+cache is further configured with `QUERY_CACHE_TTL` (seconds, default 300) and
+`QUERY_CACHE_SIZE` (entries kept in memory, default 1024).
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from src.concurrency import run_blocking
+
+# The values of the cache status header
+CACHE_HIT = "HIT"
+CACHE_MISS = "MISS"
+
+
+class MemoryCacheBackend:
+    """An in-process LRU cache whose entries expire after a TTL."""
+
+    # Whether calls to the backend block on I/O
+    blocking = False
+
+    def __init__(self, max_items: int = 1024):
+        self.max_items = max_items
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the value stored under the key, if it has not expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        """Store the value under the key for `ttl` seconds."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def get_generation(self, partition: str) -> int:
+        """Get the current generation of the partition."""
+        with self._lock:
+            return self._generations.get(partition, 0)
+
+    def bump_generation(self, partition: str) -> None:
+        """Move the partition to a new generation."""
+        with self._lock:
+            self._generations[partition] = self._generations.get(partition, 0) + 1
+
+
+class RedisCacheBackend:
+    """A cache shared between workers through Redis."""
+
+    blocking = True
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise ImportError("The `redis` package is required to use QUERY_CACHE_URL")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the value stored under the key, if it has not expired."""
+        value = self._client.get(f"context:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        """Store the value under the key for `ttl` seconds."""
+        self._client.set(f"context:{key}", value, ex=max(int(ttl), 1))
+
+    def get_generation(self, partition: str) -> int:
+        """Get the current generation of the partition."""
+        return int(self._client.get(f"context-generation:{partition}") or 0)
+
+    def bump_generation(self, partition: str) -> None:
+        """Move the partition to a new generation."""
+        self._client.incr(f"context-generation:{partition}")
+
+
+@dataclass
+class QueryCacheStats:
+    """Counters describing how the query cache has been used."""
+
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+
+
+class QueryCache:
+    """A cache of query contexts with partition-aware invalidation."""
+
+    def __init__(self, backend, ttl: float = 300.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = QueryCacheStats()
+
+    @classmethod
+    def from_env(cls) -> "QueryCache":
+        """Create a query cache configured from the environment."""
+        url = os.getenv("QUERY_CACHE_URL")
+        if url:
+            backend = RedisCacheBackend(url)
+        else:
+            backend = MemoryCacheBackend(int(os.getenv("QUERY_CACHE_SIZE", "1024")))
+        return cls(backend, ttl=float(os.getenv("QUERY_CACHE_TTL", "300")))
+
+    def _key(self, query: str, partition_name: str, max_context_tokens: int) -> str:
+        """Get the key of the query in the current generation of its partition."""
+        generation = self.backend.get_generation(partition_name)
+        payload = json.dumps([query, partition_name, max_context_tokens, generation])
+        return sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(
+        self, query: str, partition_name: str, max_context_tokens: int
+    ) -> Tuple[str, Optional[str]]:
+        """Get the cached context of the query.
+
+        The returned key pins the generation the lookup was made in, so that a
+        context computed while the partition is being written to is stored under
+        the old generation and never served afterwards.
+
+        Args:
+            query (str): The query text
+            partition_name (str): The queried partition
+            max_context_tokens (int): The token budget of the context
+
+        Returns:
+            Tuple[str, Optional[str]]: The cache key and the cached context, or None
+                on a miss
+        """
+        key = self._key(query, partition_name, max_context_tokens)
+        value = self.backend.get(key)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return key, value
+
+    def set(self, key: str, context: str) -> None:
+        """Cache the context under the key returned by `get`.
+
+        Args:
+            key (str): The cache key
+            context (str): The context to cache
+        """
+        self.backend.set(key, context, self.ttl)
+
+    def invalidate(self, partition_name: str) -> None:
+        """Invalidate the cached contexts that a write to the partition may change.
+
+        Queries on `expert_name:document_name` only see documents stored under that
+        exact partition, while queries on `expert_name` see every document of the
+        expert, so both generations are bumped.
+
+        Args:
+            partition_name (str): The partition that was written to
+        """
+        expert_name = partition_name.split(":")[0]
+        self.backend.bump_generation(expert_name)
+        if partition_name != expert_name:
+            self.backend.bump_generation(partition_name)
+        self.stats.invalidations += 1
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Run a cache call, off the event loop if the backend blocks on I/O."""
+        if self.backend.blocking:
+            return await run_blocking(func, *args)
+        return func(*args)
+
+    async def aget(
+        self, query: str, partition_name: str, max_context_tokens: int
+    ) -> Tuple[str, Optional[str]]:
+        """Async version of `get`."""
+        return await self._run(self.get, query, partition_name, max_context_tokens)
+
+    async def aset(self, key: str, context: str) -> None:
+        """Async version of `set`."""
+        await self._run(self.set, key, context)
+
+    async def ainvalidate(self, partition_name: str) -> None:
+        """Async version of `invalidate`."""
+        await self._run(self.invalidate, partition_name)
+
+    def get_stats(self) -> Dict:
+        """Get the hit and miss counters along with the hit ratio."""
+        stats = asdict(self.stats)
+        lookups = self.stats.hits + self.stats.misses
+        stats["hit_ratio"] = self.stats.hits / lookups if lookups else 0.0
+        return stats
+
+
+# The process-wide query cache
+query_cache = QueryCache.from_env()
@@ -0,0 +1,133 @@
+"""The revisions.py file defines the incremental re-ingestion of keyed documents.
+
+A document stored with `store_document` is identified by the hash of its content,
+so every edit makes a new document: all of its chunks are embedded and upserted
+again, and the chunks of the previous revision are left in the index. A keyed
+document is identified by its partition (`expert_name:document_name`) instead, and
+is chunked section by section, with the chunk IDs of every section drawn from its
+text rather than its position (see `TokenLengthChunker.iter_keyed_chunks`), so the
+sections that an edit did not touch keep their chunk IDs across revisions.
+
+The content hash of every stored chunk of a keyed document is kept in the
+`document_chunks` table. Updating the document diffs the hashes of its new chunks
+against the stored ones, and only embeds and upserts the chunks that changed,
+deletes the chunks that no longer exist, and leaves the others untouched. The
+hashes are written after the index, so a failed update is retried in full by the
+next one.
+"""
+import json
+from hashlib import blake2b
+from typing import Dict, List, NamedTuple
+
+from canopy.knowledge_base.models import KBDocChunk
+
+from src import models
+from src.database import SessionLocal
+from src.metrics import stage
+
+
+def chunk_hash(chunk: KBDocChunk) -> str:
+    """Hash the text and metadata of a chunk, i.e. everything stored with its vector.
+
+    Args:
+        chunk (KBDocChunk): The chunk
+
+    Returns:
+        str: The hex digest of the chunk
+    """
+    digest = blake2b(chunk.text.encode("utf-8"), digest_size=16)
+    digest.update(json.dumps(chunk.metadata, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ChunkDiff(NamedTuple):
+    """The difference between the new chunks of a document and the stored ones."""
+
+    # The chunks that are new or whose text or metadata changed
+    changed: List[KBDocChunk]
+    # The IDs of the stored chunks that the new revision does not have
+    stale: List[str]
+    # The number of chunks that are stored as they are
+    unchanged: int
+    # The hash of every new chunk, by ID
+    hashes: Dict[str, str]
+
+
+def diff_chunks(chunks: List[KBDocChunk], stored: Dict[str, str]) -> ChunkDiff:
+    """Diff the chunks of a new revision against the stored chunk hashes.
+
+    Args:
+        chunks (List[KBDocChunk]): The chunks of the new revision
+        stored (Dict[str, str]): The hash of every stored chunk, by ID
+
+    Returns:
+        ChunkDiff: The changed chunks and the stale chunk IDs
+    """
+    hashes = {chunk.id: chunk_hash(chunk) for chunk in chunks}
+    changed = [chunk for chunk in chunks if stored.get(chunk.id) != hashes[chunk.id]]
+    stale = sorted(set(stored) - set(hashes))
+    return ChunkDiff(changed, stale, len(chunks) - len(changed), hashes)
+
+
+class ChunkHashStore:
+    """The content hashes of the stored chunks of keyed documents."""
+
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+
+    def hashes(self, document_id: str) -> Dict[str, str]:
+        """Get the hash of every stored chunk of a document, by chunk ID."""
+        db = self._session_factory()
+        try:
+            rows = db.query(
+                models.DocumentChunk.chunk_id, models.DocumentChunk.content_hash
+            ).filter(models.DocumentChunk.document_id == document_id)
+            return {row.chunk_id: row.content_hash for row in rows}
+        finally:
+            db.close()
+
+    def apply(self, document_id: str, diff: ChunkDiff) -> None:
+        """Store the hashes of the changed chunks and forget the stale chunks.
+
+        Args:
+            document_id (str): The ID of the document
+            diff (ChunkDiff): The diff that was written to the index
+        """
+        db = self._session_factory()
+        try:
+            if diff.stale:
+                db.query(models.DocumentChunk).filter(
+                    models.DocumentChunk.chunk_id.in_(diff.stale)
+                ).delete(synchronize_session=False)
+            for chunk in diff.changed:
+                db.merge(
+                    models.DocumentChunk(
+                        chunk_id=chunk.id,
+                        document_id=document_id,
+                        content_hash=diff.hashes[chunk.id],
+                    )
+                )
+            with stage("db_commit"):
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def remove(self, document_ids: List[str]) -> None:
+        """Forget every chunk of the given documents."""
+        if not document_ids:
+            return
+        db = self._session_factory()
+        try:
+            db.query(models.DocumentChunk).filter(
+                models.DocumentChunk.document_id.in_(document_ids)
+            ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+# The process-wide store of chunk hashes
+chunk_hashes = ChunkHashStore()
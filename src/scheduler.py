@@ -0,0 +1,241 @@
+"""The scheduler.py file defines the admission control of the ingestion and query
+traffic.
+
+Ingestion requests (`/document`, `/documents`, `/wiki-upload`) and context queries
+(`/context`, `/context/stream`, `/context/batch`) are admitted by two separate
+pools, so that a large upload does not delay the queries:
+    - Every pool runs at most `*_CONCURRENCY` requests at once. The others wait
+      for a slot, in arrival order, in a queue of at most `*_QUEUE_SIZE` requests.
+      When the queue is full, the request is rejected with an `Overloaded` error,
+      which the server turns into a 429 with a `Retry-After` header.
+    - The blocking work of an admitted request runs on the threads of its pool
+      (see `use_executor`). Ingestion gets its own `INGEST_THREADS` threads, and
+      the queries keep the I/O thread pool, so that the embedding, upsert and
+      chunking calls of an upload never take the threads of the queries.
+
+Writes to a partition are also serialized by `partition_writes`: a document is
+stored under a partition once the previous write to the partition is done, and
+concurrent writes of the same content to the same partition, e.g. an upload sent
+twice, share the work of the first one instead of embedding it again.
+
+The queue depth, running requests, wait times and rejections of every pool are
+exposed by the `/metrics` endpoint. The limits hold per server process.
+"""
+import asyncio
+import math
+import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Optional,
+)
+
+from src.concurrency import use_executor
+from src.metrics import in_flight, queue_depth, queue_wait, rejected_total
+
+INGEST = "ingest"
+QUERY = "query"
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "32"))
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", "16"))
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", "64"))
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", "256"))
+
+# The weight of the last request in the average time a request holds a slot
+_HOLD_TIME_WEIGHT = 0.2
+
+
+class Overloaded(Exception):
+    """Raised when the queue of a pool is full."""
+
+    def __init__(self, pool: str, retry_after: int):
+        super().__init__(f"The {pool} queue is full, retry in {retry_after}s")
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class WorkPool:
+    """A bounded number of concurrent requests, with a bounded queue of waiting
+    requests."""
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        max_queue: int,
+        executor: Optional[Executor] = None,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.executor = executor
+        self.waiting = 0
+        self.running = 0
+
+        # The average time a request holds a slot, in seconds
+        self.hold_seconds = 1.0
+        self._slots = asyncio.Semaphore(concurrency)
+
+    def retry_after(self) -> int:
+        """Estimate the seconds until the queue has room again."""
+        seconds = self.hold_seconds * (self.waiting + 1) / self.concurrency
+        return max(1, math.ceil(seconds))
+
+    def _update_gauges(self) -> None:
+        queue_depth.set(self.waiting, self.name)
+        in_flight.set(self.running, self.name)
+
+    @asynccontextmanager
+    async def admit(self, reject: bool = True) -> AsyncIterator[None]:
+        """Wait for a slot of the pool and run the body on the pool's executor.
+
+        Args:
+            reject (bool): Whether to raise `Overloaded` when the queue is full,
+                rather than wait
+
+        Raises:
+            Overloaded: If there is no free slot and the queue is full
+        """
+        if reject:
+            self.check()
+
+        start = time.perf_counter()
+        self.waiting += 1
+        self._update_gauges()
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+            self._update_gauges()
+
+        admitted = time.perf_counter()
+        queue_wait.observe(self.name, admitted - start)
+        self.running += 1
+        self._update_gauges()
+        try:
+            with use_executor(self.executor):
+                yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+            self._update_gauges()
+            self.hold_seconds += _HOLD_TIME_WEIGHT * (
+                time.perf_counter() - admitted - self.hold_seconds
+            )
+
+    def check(self) -> None:
+        """Raise `Overloaded` if a request would be rejected now.
+
+        Used for the work that is queued in the background, which waits for its
+        slot rather than fail once it was accepted.
+        """
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            rejected_total.inc(1, self.name)
+            raise Overloaded(self.name, self.retry_after())
+
+    def stats(self) -> Dict:
+        """Get the current load of the pool."""
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "waiting": self.waiting,
+        }
+
+
+class PartitionWrites:
+    """Serializes the writes to every partition, and shares the work of concurrent
+    identical writes."""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # The number of writes holding or waiting for the lock of every partition
+        self._users: Dict[str, int] = {}
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+
+    @asynccontextmanager
+    async def lock(self, partition_names: Iterable[str]) -> AsyncIterator[None]:
+        """Hold the write locks of the given partitions.
+
+        The locks are taken in sorted order, so that two batches of documents
+        that share partitions cannot deadlock.
+        """
+        names = sorted(set(partition_names))
+        for name in names:
+            self._users[name] = self._users.get(name, 0) + 1
+            self._locks.setdefault(name, asyncio.Lock())
+
+        try:
+            async with AsyncExitStack() as stack:
+                for name in names:
+                    await stack.enter_async_context(self._locks[name])
+                yield
+        finally:
+            for name in names:
+                self._users[name] -= 1
+                if not self._users[name]:
+                    del self._users[name]
+                    del self._locks[name]
+
+    async def run(
+        self, partition_name: str, key: Hashable, func: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """Run a write to a partition once the previous writes are done.
+
+        Args:
+            partition_name (str): The partition written to
+            key (Hashable): Identifies the write: a write with the same key as a
+                pending one waits for it and gets its result
+            func (Callable[[], Awaitable[Any]]): Makes the write
+
+        Returns:
+            Any: The result of the write
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        # The error is raised to the first writer, whether or not others wait
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._pending[key] = future
+        try:
+            async with self.lock([partition_name]):
+                result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exp:
+            future.set_exception(exp)
+            raise
+        finally:
+            del self._pending[key]
+
+        future.set_result(result)
+        return result
+
+    def pending(self) -> int:
+        """Get the number of partitions being written to."""
+        return len(self._users)
+
+
+# The admission pools of the ingestion and query traffic
+ingest_pool = WorkPool(
+    INGEST,
+    INGEST_CONCURRENCY,
+    INGEST_QUEUE_SIZE,
+    ThreadPoolExecutor(max_workers=INGEST_THREADS, thread_name_prefix="ingest"),
+)
+query_pool = WorkPool(QUERY, QUERY_CONCURRENCY, QUERY_QUEUE_SIZE)
+
+# The process-wide serialization of the writes to every partition
+partition_writes = PartitionWrites()
@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import Optional
+
 from pydantic import BaseModel, Field
 
 
@@ -14,7 +17,20 @@ class CreateFile(FileBase):
     class Config:
         orm_mode = True
 
+class FileSummary(BaseModel):
+    """A listed file, whose content is only included when asked for."""
+
+    id: int
+    filename: str
+    partition: str
+    created_at: Optional[datetime] = None
+    content: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+
 class UploadItem(BaseModel):
     pages: list[str] = Field(default=[])
     should_filter: bool = Field(default=True)
-    chunk_size: int = Field(default=0)
\ No newline at end of file
+    chunk_size: int = Field(default=0)
+    concurrency: int = Field(default=8, ge=1, le=32)
\ No newline at end of file
@@ -1,20 +1,75 @@
 """The FastAPI server implementation."""
-import time
+import json
+from contextlib import asynccontextmanager
 from typing import Optional, List
 
-from fastapi import FastAPI, HTTPException, Query, Depends, Body
+from fastapi import FastAPI, HTTPException, Query, Depends, Body, Response, BackgroundTasks
 from sqlalchemy.orm import Session
 from starlette import status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
-
-from src.knowledge import store_document
-from src.query import query_context
-from src.wikipedia import fetch_wiki_data
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from src.dispatcher import embedding_dispatcher
+from src.embedding_cache import embedding_cache
+from src.files import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    find_file,
+    insert_files,
+    iter_file_body,
+    iter_files,
+    list_files,
+)
+from src.ingest import ingest_jobs, run_job
+from src.catalog import partition_catalog
+from src.concurrency import run_blocking
+from src.knowledge import (
+    INDEX_NAME,
+    DocumentInput,
+    astore_document,
+    astore_documents,
+    aupdate_document,
+    delete_partition,
+    kb_pool,
+)
+from src.local_index import local_indexes
+from src.metrics import METRICS_MEDIA_TYPE, TracingMiddleware, log, render_metrics
+from src.query import (
+    MAX_BATCH_QUERIES,
+    ContextRequest,
+    acached_query_context,
+    aquery_context_batch,
+    aquery_snippets,
+)
+from src.query_cache import query_cache
+from src.scheduler import Overloaded, ingest_pool, partition_writes, query_pool
+from src.settings import WARMUP, warmup
 from src import models, schemas
-from src.database import get_db
+from src.database import get_db, run_in_session
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Create the missing tables on startup, and release the pooled knowledge bases
+    when the server shuts down.
+
+    With `WARMUP` set, the lazily initialized resources and the default knowledge
+    base are also created on startup instead of on the first request.
+    """
+    if WARMUP:
+        await run_blocking(warmup)
+        await run_blocking(kb_pool.get_context_engine, INDEX_NAME)
+    await run_blocking(models.create_tables)
+    yield
+    kb_pool.close()
+    local_indexes.close()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+
+# The media type of the streaming endpoints: one JSON object per line
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
 origins = [
     "https://file-upload-ui.netlify.app",
@@ -22,6 +77,7 @@ origins = [
     "http://localhost:5173",
 ]
 
+app.add_middleware(TracingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -31,32 +87,77 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(_, exp: Overloaded):
+    """Reject the requests that the scheduler has no room for, see
+    `src/scheduler.py`."""
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exp)},
+        headers={"Retry-After": str(exp.retry_after)},
+    )
+
+
 class DocumentPayload(BaseModel):
     """The payload for the document."""
 
     content: str
     partition_name: str
     chunk_size: int
+    # Whether to update the document of the partition in place, only embedding the
+    # chunks that changed (see `src/revisions.py`)
+    incremental: bool = False
 
 
 @app.put("/document")
-def put_document(document: DocumentPayload):
+async def put_document(document: DocumentPayload):
     # Using partition_name as the key to store the content
-    try:
-        # Store the document in the knowledge base
-        doc = store_document(document.content, document.partition_name, document.chunk_size)
+    async with ingest_pool.admit():
+        try:
+            if document.incremental:
+                return await aupdate_document(
+                    document.content, document.partition_name, document.chunk_size
+                )
+
+            # Store the document in the knowledge base
+            doc = await astore_document(
+                document.content, document.partition_name, document.chunk_size
+            )
+
+            # Return the document ID to the caller
+            return {"document_id": doc.id}
+        except Exception as exp:  # pylint: disable=broad-except
+            log(str(exp))
+            raise HTTPException(
+                status_code=500, detail="Error while saving the document"
+            ) from exp
+
+
+class DocumentsPayload(BaseModel):
+    """The payload for a batch of documents."""
+
+    documents: List[DocumentPayload]
+
+
+@app.put("/documents")
+async def put_documents(payload: DocumentsPayload):
+    """Store a batch of documents, embedding and upserting their chunks together."""
+    async with ingest_pool.admit():
+        results = await astore_documents(
+            [
+                DocumentInput(
+                    document.content, document.partition_name, document.chunk_size
+                )
+                for document in payload.documents
+            ]
+        )
 
-        # Return the document ID to the caller
-        return {"document_id": doc.id}
-    except Exception as exp:  # pylint: disable=broad-except
-        print(exp)
-        raise HTTPException(
-            status_code=500, detail="Error while saving the document"
-        ) from exp
+    return {"documents": results}
 
 
 @app.get("/context")
-def get_context(
+async def get_context(
+    response: Response,
     query: Optional[str] = Query(None),
     partition_name: Optional[str] = Query(None),
     max_context_tokens: Optional[int] = 512,
@@ -77,75 +178,249 @@ def get_context(
             status_code=400,
             detail="Query parameter `max_context_tokens` must be an integer",
         )
+    if max_context_tokens <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Query parameter `max_context_tokens` must be positive",
+        )
 
-    context = query_context(
-        query, partition_name, max_context_tokens=max_context_tokens
-    )
+    async with query_pool.admit():
+        context, cache_status = await acached_query_context(
+            query, partition_name, max_context_tokens=max_context_tokens
+        )
+    response.headers["X-Cache"] = cache_status
 
     return {"context": context}
 
 
-@app.get('/files', response_model=List[schemas.CreateFile])
-def test_files(db: Session = Depends(get_db)):
-    files = db.query(models.File).all()
+@app.get("/context/stream")
+async def get_context_stream(
+    query: Optional[str] = Query(None),
+    partition_name: Optional[str] = Query(None),
+    max_context_tokens: Optional[int] = 512,
+):
+    """Stream the snippets of the context for the given query, one JSON object per
+    line, in ranking order."""
+    if partition_name is None:
+        raise HTTPException(
+            status_code=400, detail="Query parameter `partition_name` not provided"
+        )
+    if query is None:
+        raise HTTPException(
+            status_code=400, detail="Query parameter `query` not provided"
+        )
+    if not isinstance(max_context_tokens, int):
+        raise HTTPException(
+            status_code=400,
+            detail="Query parameter `max_context_tokens` must be an integer",
+        )
+    if max_context_tokens <= 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Query parameter `max_context_tokens` must be positive",
+        )
+
+    async with query_pool.admit():
+        snippets = await aquery_snippets(
+            query, partition_name, max_context_tokens=max_context_tokens
+        )
+
+    def lines():
+        for snippet in snippets:
+            yield snippet.model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+class ContextQueryPayload(BaseModel):
+    """A query of a batch of context queries."""
+
+    query: str
+    partition_name: str
+    max_context_tokens: int = 512
+
+
+class ContextBatchPayload(BaseModel):
+    """The payload for a batch of context queries."""
+
+    queries: List[ContextQueryPayload] = Field(..., max_length=MAX_BATCH_QUERIES)
+
+
+@app.post("/context/batch")
+async def post_context_batch(payload: ContextBatchPayload):
+    """Get the contexts of many queries, embedding them with a single call and
+    searching them concurrently."""
+    async with query_pool.admit():
+        results = await aquery_context_batch(
+            [
+                ContextRequest(item.query, item.partition_name, item.max_context_tokens)
+                for item in payload.queries
+            ]
+        )
+
+    return {"results": results}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Get the stage latency histograms and the chunk and token counters, in the
+    Prometheus text format."""
+    return Response(render_metrics(), media_type=METRICS_MEDIA_TYPE)
+
+
+@app.get("/pool/stats")
+def get_pool_stats():
+    """Get the number of knowledge base connections created and reused."""
+    return kb_pool.get_stats()
+
+
+@app.get("/scheduler/stats")
+def get_scheduler_stats():
+    """Get the running and waiting requests of the ingestion and query pools."""
+    return {
+        "ingest": ingest_pool.stats(),
+        "query": query_pool.stats(),
+        "partitions_writing": partition_writes.pending(),
+    }
+
+
+@app.get("/embeddings/stats")
+def get_embedding_stats():
+    """Get the hit rate of the embedding cache and the batches of the embedding
+    dispatcher."""
+    return {
+        **embedding_cache.get_stats(),
+        "dispatcher": embedding_dispatcher.get_stats(),
+    }
+
+
+@app.get("/context/cache/stats")
+def get_context_cache_stats():
+    """Get the hit ratio of the query result cache."""
+    return query_cache.get_stats()
+
+
+@app.get("/partitions/{partition_name}/stats")
+async def get_partition_stats(partition_name: str):
+    """Get the number of documents, chunks and files stored under a partition."""
+    try:
+        return await run_blocking(partition_catalog.stats, partition_name)
+    except ValueError as exp:
+        raise HTTPException(status_code=400, detail=str(exp)) from exp
+
+
+@app.delete("/partitions/{partition_name}")
+async def delete_partition_documents(partition_name: str):
+    """Delete every document and file stored under a partition."""
+    try:
+        return await run_blocking(delete_partition, partition_name)
+    except ValueError as exp:
+        raise HTTPException(status_code=400, detail=str(exp)) from exp
+    except Exception as exp:  # pylint: disable=broad-except
+        log(str(exp))
+        raise HTTPException(
+            status_code=500, detail="Error while deleting the partition"
+        ) from exp
+
+
+@app.get('/files', response_model=List[schemas.FileSummary], response_model_exclude_none=True)
+async def test_files(
+    response: Response,
+    after: Optional[int] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    partition: Optional[str] = Query(None),
+    include_content: bool = Query(False),
+):
+    """List a page of files. The cursor of the next page is in `X-Next-Cursor`."""
+    files, next_cursor = await run_in_session(
+        list_files, after, limit, partition, include_content
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
 
     return files
 
 
+@app.get('/files/stream')
+def stream_files(
+    after: Optional[int] = Query(None),
+    partition: Optional[str] = Query(None),
+    include_content: bool = Query(True),
+):
+    """Stream every file, one JSON object per line, from a server-side cursor."""
+
+    def lines():
+        for rows in iter_files(after, partition, include_content):
+            yield "".join(
+                schemas.FileSummary(**row).model_dump_json(exclude_none=True)
+                + "\n"
+                for row in rows
+            )
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
 @app.get('/files/{filename}', response_model=schemas.CreateFile, status_code=status.HTTP_200_OK)
 def get_test_one_file(filename:str, db:Session = Depends(get_db)):
-    file = db.query(models.File).filter(models.File.partition == filename).first()
+    file = find_file(db, filename)
 
     if file is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"The filename: {filename} you requested for does not exist")
-    return file
+
+    def body():
+        # The content is decompressed and escaped piece by piece
+        yield (
+            f'{{"filename": {json.dumps(file.filename)}, '
+            f'"partition": {json.dumps(file.partition)}, "content": "'
+        )
+        for piece in iter_file_body(file):
+            yield json.dumps(piece)[1:-1]
+        yield '"}'
+
+    return StreamingResponse(body(), media_type="application/json")
 
 
 @app.post('/files', status_code=status.HTTP_201_CREATED, response_model=List[schemas.CreateFile])
 def test_file_sent(post_file:schemas.CreateFile, db:Session = Depends(get_db)):
-    new_file = models.File(**post_file.dict())
-    db.add(new_file)
-    db.commit()
-    db.refresh(new_file)
+    insert_files(db, [post_file.dict()])
 
-    return [new_file]
+    return [post_file]
 
 
 @app.post('/wiki-upload')
-def get_wiki_info(
-    payload: schemas.UploadItem,
-    db:Session = Depends(get_db)
-):
-    payload_dict = payload.dict()
-    
-    pagelist = payload_dict['pages']
-    added_items = []
-    already_present = []
-    for page in pagelist:
-        title = page.split('/')[-1]
-
-        file = db.query(models.File).filter(models.File.partition == title).first()
-
-        if file is None:
-            wiki_payload = fetch_wiki_data(page=title, should_filter=payload_dict['should_filter'])
-            store_document_start_time = time.time()
-            print(f"Beginning document storing with {payload_dict['chunk_size']} chunk size")
-            store_document(wiki_payload['content'], wiki_payload['partition_name'], chunk_size=payload_dict['chunk_size'])
-            print(f'Document stored with a total time of {time.time() - store_document_start_time}')
-            new_file = models.File(**{
-                'filename': wiki_payload['partition_name'].split(':')[1],
-                'partition': wiki_payload['partition_name'].split(':')[0],
-                'content': wiki_payload['content']
-            })
-            db.add(new_file)
-            db.commit()
-            db.refresh(new_file)
-            added_items.append(title)
-        else:
-            print('Page already added')
-            already_present.append(title)
-    
-    return { "added": added_items, "alreadyPresent": already_present }
+async def get_wiki_info(payload: schemas.UploadItem):
+    async with ingest_pool.admit():
+        job = ingest_jobs.create(**payload.dict())
+        await run_job(job)
+
+    return { "added": job.added, "alreadyPresent": job.already_present }
+
+
+async def run_admitted_job(job):
+    """Run a background ingestion job once the ingestion pool admits it."""
+    async with ingest_pool.admit(reject=False):
+        await run_job(job)
+
+
+@app.post('/wiki-upload/jobs', status_code=status.HTTP_202_ACCEPTED)
+def start_wiki_upload_job(payload: schemas.UploadItem, background_tasks: BackgroundTasks):
+    """Start ingesting the given pages in the background."""
+    # Accepted jobs wait for their turn in the ingestion pool rather than fail
+    ingest_pool.check()
+    job = ingest_jobs.create(**payload.dict())
+    background_tasks.add_task(run_admitted_job, job)
+
+    return { "job_id": job.id }
+
+
+@app.get('/wiki-upload/jobs/{job_id}')
+def get_wiki_upload_job(job_id: str):
+    """Get the progress of a background ingestion job."""
+    job = ingest_jobs.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"The job: {job_id} does not exist")
+    return job.progress()
 
 
 """
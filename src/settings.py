@@ -0,0 +1,95 @@
+"""The settings.py file defines the lazily initialized resources of the service.
+
+Importing `src` used to validate the environment, print it and load the tokenizer,
+which downloads its encoding on a cold cache. Every process that imported any
+module of `src`, including tests, CLIs and workers that never tokenize, paid for it
+and failed without network access or a complete `.env` file. These resources are
+now created on first use instead:
+    - `get_settings()` reads and validates the required environment variables the
+      first time the service needs one of them
+    - `LazyTokenizer` initializes Canopy's tokenizer on the first tokenize call
+    - `src.database.get_engine()` creates the database engine on the first session
+
+Setting `WARMUP` to a true value makes the server initialize all of them on
+startup, so that the first request does not pay for them (see `warmup()`).
+"""
+import os
+import threading
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from typing import List
+
+from canopy.tokenizer import Tokenizer
+
+# Whether the server initializes the lazy resources on startup
+WARMUP = os.getenv("WARMUP", "").lower() in ("1", "true", "yes")
+
+_tokenizer_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The environment variables that the service requires."""
+
+    index_name: str
+    pinecone_api_key: str
+    pinecone_environment: str
+    openai_api_key: str
+    postgresql_database_url: str
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """Read the settings from the environment, named after the fields."""
+        return cls(**{f.name: os.getenv(f.name.upper(), "") for f in fields(cls)})
+
+    def missing(self) -> List[str]:
+        """List the environment variables that are not set."""
+        return [f.name.upper() for f in fields(self) if not getattr(self, f.name)]
+
+    def __repr__(self) -> str:
+        # Never print the secrets
+        return f"Settings(index_name={self.index_name!r}, ...)"
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Read and validate the settings on first use.
+
+    Returns:
+        Settings: The settings of the service
+
+    Raises:
+        RuntimeError: If a required environment variable is not set
+    """
+    settings = Settings.from_env()
+    missing = settings.missing()
+    if missing:
+        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
+    return settings
+
+
+def ensure_tokenizer():
+    """Initialize Canopy's tokenizer singleton, once per process."""
+    if Tokenizer._initialized:  # pylint: disable=protected-access
+        return
+    with _tokenizer_lock:
+        if not Tokenizer._initialized:  # pylint: disable=protected-access
+            Tokenizer.initialize()
+
+
+class LazyTokenizer:
+    """A stand-in for Canopy's `Tokenizer()` that initializes it on first use."""
+
+    def __getattr__(self, name: str):
+        ensure_tokenizer()
+        return getattr(Tokenizer(), name)
+
+
+def warmup():
+    """Initialize the settings, the tokenizer and the database engine."""
+    # pylint: disable=import-outside-toplevel
+    from src.database import get_engine
+
+    get_settings()
+    ensure_tokenizer()
+    get_engine().connect().close()
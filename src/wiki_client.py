@@ -0,0 +1,288 @@
+"""The wiki_client.py file defines the HTTP layer used to fetch Wikipedia pages.
+
+The `WikipediaClient` keeps a single `requests.Session`, so connections to the API
+are pooled and kept alive between pages. Every request has a timeout and is retried
+with exponential backoff on connection errors, 429s and 5xx responses.
+
+Fetching a page first looks up its latest revision ID, which is cheap and can be
+done for up to 50 pages in one request. The rendered HTML of that revision is then
+read from an on-disk cache keyed by page and revision, and only downloaded if the
+page changed since it was last fetched. The cache is bounded in size and evicts the
+least recently used responses first.
+
+The client is configured with the following environment variables:
+    - `WIKIPEDIA_API_URL`: The API endpoint, e.g. a local stub server for offline
+      testing (default `https://en.wikipedia.org/w/api.php`)
+    - `WIKIPEDIA_CACHE_PATH`: The cache directory (default `.cache/wikipedia`). Set
+      it to an empty string to disable the cache.
+    - `WIKIPEDIA_CACHE_SIZE`: The maximum size of the cache in bytes (default 256 MiB)
+    - `WIKIPEDIA_TIMEOUT`: The read timeout of every request in seconds (default 30)
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# The maximum number of titles per revisions query allowed by the API
+MAX_TITLES_PER_QUERY = 50
+
+
+@dataclass
+class WikiPage:
+    """The rendered HTML of a revision of a Wikipedia page."""
+
+    title: str
+    pageid: int
+    revid: int
+    html: str
+
+
+class WikiResponseCache:
+    """A size-bounded on-disk cache of rendered pages, keyed by page and revision."""
+
+    def __init__(self, path: str, max_bytes: int = 256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _file(self, page: str, revid: int) -> str:
+        """Get the cache file of the given page revision."""
+        page_hash = sha256(page.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.path, f"{page_hash}-{revid}.json")
+
+    def get(self, page: str, revid: int) -> Optional[WikiPage]:
+        """Get the cached revision of the page, if any."""
+        path = self._file(page, revid)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cached = WikiPage(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+        # Mark the entry as recently used, unless it was just evicted
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return cached
+
+    def put(self, page: str, wiki_page: WikiPage) -> None:
+        """Cache the revision of the page, evicting old entries if the cache is full."""
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file(page, wiki_page.revid)
+        data = json.dumps(asdict(wiki_page)).encode("utf-8")
+
+        with self._lock:
+            # Write to a temporary file first so that readers never see partial data
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            if self._size is None:
+                self._size = sum(entry.stat().st_size for entry in self._entries())
+            else:
+                self._size += len(data)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> List[os.DirEntry]:
+        """List the cache files."""
+        with os.scandir(self.path) as entries:
+            return [entry for entry in entries if entry.name.endswith(".json")]
+
+    def _evict(self) -> None:
+        """Delete the least recently used entries until the cache fits its bound."""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class WikipediaClient:
+    """A pooled, retrying and caching client for the Wikipedia API."""
+
+    def __init__(
+        self,
+        api_url: str = "https://en.wikipedia.org/w/api.php",
+        cache: Optional[WikiResponseCache] = None,
+        timeout: float = 30.0,
+        pool_size: int = 32,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ):
+        self.api_url = api_url
+        self.cache = cache
+        self.timeout = (5.0, timeout)
+        self.pool_size = pool_size
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "canopy-api (knowledge base ingestion)"
+
+    @classmethod
+    def from_env(cls) -> "WikipediaClient":
+        """Create a client configured from the environment."""
+        cache_path = os.getenv("WIKIPEDIA_CACHE_PATH", ".cache/wikipedia")
+        cache = None
+        if cache_path:
+            cache = WikiResponseCache(
+                cache_path,
+                max_bytes=int(os.getenv("WIKIPEDIA_CACHE_SIZE", str(256 * 2**20))),
+            )
+        return cls(
+            api_url=os.getenv("WIKIPEDIA_API_URL", "https://en.wikipedia.org/w/api.php"),
+            cache=cache,
+            timeout=float(os.getenv("WIKIPEDIA_TIMEOUT", "30")),
+        )
+
+    def _get(self, params: Dict) -> Dict:
+        """Send a GET request to the API and decode its JSON response."""
+        response = self.session.get(
+            self.api_url, params={"format": "json", **params}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def get_revisions(self, pages: List[str]) -> Dict[str, int]:
+        """Get the latest revision ID of every page, following redirects.
+
+        Args:
+            pages (List[str]): The page titles, at most 50
+
+        Returns:
+            Dict[str, int]: The revision ID of every page that exists, by title
+        """
+        response = self._get(
+            {
+                "action": "query",
+                "prop": "revisions",
+                "rvprop": "ids",
+                "titles": "|".join(pages),
+                "redirects": "",
+            }
+        )
+        query = response.get("query", {})
+
+        # Follow the title normalizations and redirects back to the requested titles
+        resolved = {page: page for page in pages}
+        for step in ("normalized", "redirects"):
+            renames = {item["from"]: item["to"] for item in query.get(step, [])}
+            resolved = {page: renames.get(title, title) for page, title in resolved.items()}
+
+        revisions = {
+            info["title"]: info["revisions"][0]["revid"]
+            for info in query.get("pages", {}).values()
+            if info.get("revisions")
+        }
+        return {
+            page: revisions[title] for page, title in resolved.items() if title in revisions
+        }
+
+    def lookup_revisions(self, pages: List[str]) -> Dict[str, int]:
+        """Get the latest revision ID of every page, 50 pages per request.
+
+        Args:
+            pages (List[str]): The page titles
+
+        Returns:
+            Dict[str, int]: The revision ID of every page that exists, by title
+        """
+        pages = list(dict.fromkeys(pages))
+        revisions = {}
+        for i in range(0, len(pages), MAX_TITLES_PER_QUERY):
+            revisions.update(self.get_revisions(pages[i : i + MAX_TITLES_PER_QUERY]))
+        return revisions
+
+    def fetch_revision(self, page: str, revid: int) -> WikiPage:
+        """Fetch the rendered HTML of a revision of a page, through the cache.
+
+        Args:
+            page (str): The page title
+            revid (int): The revision ID, e.g. from `lookup_revisions`
+
+        Returns:
+            WikiPage: The rendered revision of the page
+        """
+        if self.cache is not None:
+            cached = self.cache.get(page, revid)
+            if cached is not None:
+                return cached
+
+        parsed = self._get(
+            {"action": "parse", "oldid": revid, "prop": "text|revid"}
+        )["parse"]
+        wiki_page = WikiPage(
+            title=parsed["title"],
+            pageid=parsed["pageid"],
+            revid=parsed["revid"],
+            html=parsed["text"]["*"],
+        )
+
+        if self.cache is not None:
+            self.cache.put(page, wiki_page)
+        return wiki_page
+
+    def fetch_page(self, page: str) -> WikiPage:
+        """Fetch the latest revision of a page.
+
+        Args:
+            page (str): The page title
+
+        Returns:
+            WikiPage: The rendered latest revision of the page
+        """
+        revisions = self.get_revisions([page])
+        if page not in revisions:
+            raise ValueError(f"The Wikipedia page {page} does not exist")
+        return self.fetch_revision(page, revisions[page])
+
+    def fetch_pages(self, pages: List[str]) -> Dict[str, WikiPage]:
+        """Fetch the latest revision of many pages concurrently.
+
+        The revision IDs are looked up 50 pages at a time and the revisions that are
+        not cached are then downloaded concurrently over the pooled connections.
+
+        Args:
+            pages (List[str]): The page titles
+
+        Returns:
+            Dict[str, WikiPage]: The rendered revision of every page that exists
+        """
+        revisions = self.lookup_revisions(pages)
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            fetched = executor.map(
+                lambda item: self.fetch_revision(*item), revisions.items()
+            )
+            return dict(zip(revisions, fetched))
+
+
+# The process-wide Wikipedia client
+wiki_client = WikipediaClient.from_env()
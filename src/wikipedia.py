@@ -1,34 +1,130 @@
 """
-The upload.py file ...
+The wikipedia.py file fetches Wikipedia pages and extracts the text of their
+paragraphs. Pages are fetched through the pooled and cached `wiki_client`.
+
+The page HTML is parsed as a stream with a SAX-style parser target: the text of
+every `<p>` element is collected as the parser reaches it and no document tree is
+ever built. Paragraphs are collected in a list and joined once, without a
+separator, as they always were: the content hash of a page, and so its document
+ID, does not depend on how it was parsed.
+Stopwords are looked up in a set (a `frozenset` by default) that is built once.
 """
-import requests
-from lxml import html
-from typing import Dict
-
-def fetch_wiki_data(page: str, should_filter: bool=True) -> Dict:    
-    response = requests.get(
-    'https://en.wikipedia.org/w/api.php',
-    params={
-        'action': 'parse',
-        'format': 'json',
-        'page': page,
-        'prop': 'text',
-        'redirects':''
-    }).json()
-    raw_html = response['parse']['text']['*']
-    pageid = response['parse']['pageid']
-    document = html.document_fromstring(raw_html)
-
-    text = ''
-    for p in document.xpath('//p'):
-        line = p.text_content()
-        if should_filter:
-            stopwords = ['is', 'a', 'at', 'is', 'the']
-            querytext = line.split()
-
-            result  = [word for word in querytext if word.lower() not in stopwords]
-            text += ' '.join(result)
+from typing import AbstractSet, Dict, Iterator, List, Optional
+
+from lxml import etree
+
+from src.metrics import stage
+from src.wiki_client import wiki_client
+
+# The words removed from the text when filtering is enabled
+DEFAULT_STOPWORDS = frozenset({"is", "a", "at", "the"})
+
+
+class _ParagraphCollector:
+    """An lxml parser target that collects the text of every `<p>` element.
+
+    The parser calls the target for every tag and text node as it parses, so no
+    tree is ever built.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._buffer: List[str] = []
+        self.paragraphs: List[str] = []
+
+    def start(self, tag, attrib):  # pylint: disable=unused-argument
+        if tag == "p":
+            self._depth += 1
+
+    def end(self, tag):
+        if tag == "p" and self._depth:
+            self._depth -= 1
+            if not self._depth:
+                self.paragraphs.append("".join(self._buffer))
+                self._buffer = []
+
+    def data(self, data):
+        if self._depth:
+            self._buffer.append(data)
+
+    def close(self):
+        return self.paragraphs
+
+
+def iter_paragraphs(raw_html: str, feed_size: int = 1 << 16) -> Iterator[str]:
+    """Stream the text of every paragraph of the given HTML.
+
+    Args:
+        raw_html (str): The HTML to extract the paragraphs from
+        feed_size (int): The number of characters fed to the parser at a time
+
+    Returns:
+        Iterator[str]: The text of each paragraph, in document order
+    """
+    collector = _ParagraphCollector()
+    parser = etree.HTMLParser(target=collector)
+    for i in range(0, len(raw_html), feed_size):
+        parser.feed(raw_html[i : i + feed_size])
+
+        # Hand out the paragraphs that are complete so far
+        yield from collector.paragraphs
+        collector.paragraphs.clear()
+
+    parser.close()
+    yield from collector.paragraphs
+
+
+def filter_stopwords(line: str, stopwords: AbstractSet[str] = DEFAULT_STOPWORDS) -> str:
+    """Remove the stopwords from the given line, case-insensitively.
+
+    Args:
+        line (str): The line to filter
+        stopwords (AbstractSet[str]): The lowercase words to remove
+
+    Returns:
+        str: The words of the line that are not stopwords, separated by spaces
+    """
+    return " ".join([word for word in line.split() if word.lower() not in stopwords])
+
+
+def extract_text(
+    raw_html: str,
+    should_filter: bool = True,
+    stopwords: AbstractSet[str] = DEFAULT_STOPWORDS,
+) -> str:
+    """Extract the paragraph text of a Wikipedia page.
+
+    Args:
+        raw_html (str): The HTML of the page
+        should_filter (bool): Whether to remove the stopwords from the text
+        stopwords (AbstractSet[str]): The lowercase words to remove
+
+    Returns:
+        str: The text of the paragraphs, concatenated
+    """
+    if not should_filter:
+        return "".join(iter_paragraphs(raw_html))
+    return "".join(
+        filter_stopwords(line, stopwords) for line in iter_paragraphs(raw_html)
+    )
+
+
+def fetch_wiki_data(
+    page: str,
+    should_filter: bool = True,
+    stopwords: AbstractSet[str] = DEFAULT_STOPWORDS,
+    revid: Optional[int] = None,
+) -> Dict:
+    with stage("wiki_fetch"):
+        if revid is None:
+            wiki_page = wiki_client.fetch_page(page)
         else:
-            text += line
+            # The latest revision was already looked up, e.g. along with others
+            wiki_page = wiki_client.fetch_revision(page, revid)
+
+    with stage("html_parse"):
+        text = extract_text(
+            wiki_page.html, should_filter=should_filter, stopwords=stopwords
+        )
 
-    return {"content": text, "partition_name": f'{page}:{pageid}'}
+    return {"content": text, "partition_name": f'{page}:{wiki_page.pageid}'}
@@ -0,0 +1,28 @@
+"""Run the tests offline: a local index, a SQLite database and hashed embeddings
+instead of Pinecone, PostgreSQL and OpenAI."""
+import os
+import tempfile
+
+_DIRECTORY = tempfile.mkdtemp(prefix="canopy-api-tests-")
+
+os.environ.update(
+    INDEX_NAME="test",
+    PINECONE_API_KEY="test",
+    PINECONE_ENVIRONMENT="test",
+    OPENAI_API_KEY="test",
+    POSTGRESQL_DATABASE_URL=f"sqlite:///{os.path.join(_DIRECTORY, 'test.db')}",
+    LOCAL_INDEXES="test",
+    LOCAL_INDEX_PATH="",
+    EMBEDDING_CACHE_PATH="",
+    QUERY_CACHE_URL="",
+)
+
+# pylint: disable=wrong-import-position
+from canopy.tokenizer import Tokenizer  # noqa: E402
+
+from benchmarks.fakes import WordTokenizer, use_hashing_embeddings  # noqa: E402
+from src import models  # noqa: E402
+
+Tokenizer.initialize(WordTokenizer)
+use_hashing_embeddings()
+models.create_tables()
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SMALL_RUN = [
+    "--ops", "4", "--rounds", "1", "--memory-ops", "2", "--concurrency", "2",
+    "--words", "300", "--document-words", "100", "--snippets", "10",
+]  # fmt: skip
+
+
+def _suite(*args):
+    return subprocess.run(
+        [sys.executable, "-m", "benchmarks.suite", *SMALL_RUN, *args],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        timeout=300,
+        check=False,
+    )
+
+
+def test_suite_runs_offline_and_flags_regressions(tmp_path):
+    baseline = str(tmp_path / "baseline.json")
+
+    saved = _suite("--baseline", baseline, "--save-baseline")
+    assert saved.returncode == 0, saved.stderr
+    with open(baseline, "r", encoding="utf-8") as f:
+        cases = json.load(f)["cases"]
+    assert set(cases) == {"chunk", "wiki_parse", "hash", "dedup", "document", "context"}
+
+    unchanged = _suite("--baseline", baseline, "--tolerance", "1000")
+    assert unchanged.returncode == 0, unchanged.stderr
+    assert "REGRESSION" not in unchanged.stdout
+
+    # A baseline far faster than any machine makes every case a regression
+    for case in cases.values():
+        case["ops_per_second"] *= 1e6
+    with open(baseline, "w", encoding="utf-8") as f:
+        json.dump({"environment": {}, "cases": cases}, f)
+    regressed = _suite("--baseline", baseline, "--cases", "hash", "dedup")
+    assert regressed.returncode == 1
+    assert regressed.stdout.count("REGRESSION") == 2
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fakes import make_text
+from src.catalog import PartitionCatalog
+from src.database import SessionLocal, run_in_session
+from src.files import insert_files
+
+
+def _store(catalog, partition_name, document_id):
+    expert_name, filename = partition_name.split(":")
+    catalog.record([(partition_name, document_id, 3)])
+    row = {"filename": filename, "partition": expert_name, "content": make_text(40)}
+    asyncio.run(run_in_session(insert_files, [row]))
+
+
+def test_remove_deletes_the_rows_of_the_partition_only():
+    catalog = PartitionCatalog()
+    _store(catalog, "removal:kept", "kept-document")
+    _store(catalog, "removal:removed", "removed-document")
+
+    assert catalog.remove("removal:removed") == {"documents": 1, "files": 1}
+
+    assert not catalog.exists("removal:removed")
+    assert catalog.stats("removal:kept") == {
+        "partition_name": "removal:kept",
+        "documents": 1,
+        "chunks": 3,
+        "files": 1,
+    }
+
+
+def test_failed_remove_is_rolled_back():
+    rollbacks = []
+
+    def failing_session():
+        db = SessionLocal()
+
+        def commit():
+            db.flush()
+            raise RuntimeError("The database is down")
+
+        def rollback(rollback=db.rollback):
+            rollbacks.append(db)
+            rollback()
+
+        db.commit = commit
+        db.rollback = rollback
+        return db
+
+    _store(PartitionCatalog(), "rollback:page", "rollback-document")
+
+    with pytest.raises(RuntimeError):
+        PartitionCatalog(failing_session).remove("rollback:page")
+
+    assert len(rollbacks) == 1
+    assert PartitionCatalog().stats("rollback:page")["documents"] == 1
+    assert PartitionCatalog().stats("rollback:page")["files"] == 1
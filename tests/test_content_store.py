@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fakes import make_text
+from src import content_store, models
+from src.content_store import (
+    ZLIB,
+    ZSTD,
+    compress_content,
+    decompress_content,
+    iter_text,
+)
+from src.database import SessionLocal, run_in_session
+from src.files import find_file, insert_files, iter_file_body
+
+# Multi-byte characters that are split across the pieces of a blob
+TEXT = make_text(400, seed=6) + " Schrödinger, Ångström 量子力学 ⚛️ " * 200
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [
+        ZLIB,
+        pytest.param(
+            ZSTD,
+            marks=pytest.mark.skipif(
+                content_store.zstandard is None, reason="zstandard is not installed"
+            ),
+        ),
+    ],
+)
+def test_blobs_round_trip_piece_by_piece(monkeypatch, codec):
+    monkeypatch.setattr(content_store, "READ_CHUNK_SIZE", 7)
+    blob = compress_content(TEXT, codec)
+
+    assert blob.codec == codec
+    assert blob.size == len(TEXT.encode("utf-8"))
+    assert blob.size > len(blob.data)
+    assert len(list(iter_text(blob.codec, blob.data))) > 1
+    assert decompress_content(blob.codec, blob.data) == TEXT
+
+
+def test_files_with_the_same_content_share_one_blob():
+    rows = [
+        {"filename": "1", "partition": partition, "content": TEXT}
+        for partition in ["store-a", "store-b"]
+    ]
+    asyncio.run(run_in_session(insert_files, rows))
+    asyncio.run(run_in_session(insert_files, rows[:1]))
+
+    db = SessionLocal()
+    try:
+        hashes = {
+            row.content_hash
+            for row in db.query(models.File.content_hash).filter(
+                models.File.partition.in_(["store-a", "store-b"])
+            )
+        }
+        blobs = db.query(models.FileContent).filter(models.FileContent.hash.in_(hashes))
+        assert hashes == {compress_content(TEXT).hash}
+        assert blobs.count() == 1
+
+        file = find_file(db, "store-b")
+        assert "".join(iter_file_body(file)) == TEXT
+    finally:
+        db.close()
+
+
+def test_inline_contents_are_read_as_they_are():
+    db = SessionLocal()
+    try:
+        db.add(models.File(filename="1", partition="store-inline", content=TEXT))
+        db.commit()
+        assert "".join(iter_file_body(find_file(db, "store-inline"))) == TEXT
+    finally:
+        db.close()
@@ -0,0 +1,61 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from benchmarks.fakes import HashingRecordEncoder, RateLimitedEmbeddings
+from src.dispatcher import EmbeddingDispatcher
+
+BAD_TEXT = "rejected by the service"
+
+
+class RejectingEmbeddings(RateLimitedEmbeddings):
+    """Rejects every call that holds `BAD_TEXT`, like a text over the input limit."""
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        vectors = await super().embed_batch(texts)
+        if BAD_TEXT in texts:
+            raise ValueError("Invalid input")
+        return vectors
+
+
+def test_error_only_fails_the_caller_of_the_bad_text():
+    service = RejectingEmbeddings(requests=5, tokens=100000, period=0.2)
+    dispatcher = EmbeddingDispatcher(
+        requests_per_minute=5 * 60 / 0.2, tokens_per_minute=0, burst_seconds=0.2
+    )
+    texts = [[f"text {caller} {i}" for i in range(3)] for caller in range(20)]
+    texts[7][1] = BAD_TEXT
+
+    async def embed_all():
+        return await asyncio.gather(
+            *(
+                dispatcher.embed("model", caller_texts, service.embed_batch)
+                for caller_texts in texts
+            ),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(embed_all())
+
+    # pylint: disable-next=protected-access
+    embed_text = HashingRecordEncoder()._embed_text
+    for caller, (caller_texts, vectors) in enumerate(zip(texts, results)):
+        if caller == 7:
+            assert isinstance(vectors, ValueError)
+        else:
+            assert vectors == [embed_text(text) for text in caller_texts]
+    # The callers were batched together before the error, and sent alone after it
+    assert service.batches[0] == 60
+    assert dispatcher.get_stats()["failed"] == 2
+
+
+def test_error_of_a_single_caller_is_not_retried():
+    service = RejectingEmbeddings(requests=5, tokens=100000, period=0.2)
+    dispatcher = EmbeddingDispatcher(requests_per_minute=0, tokens_per_minute=0)
+
+    with pytest.raises(ValueError):
+        asyncio.run(
+            dispatcher.embed("model", ["text", BAD_TEXT], service.embed_batch)
+        )
+    assert service.batches == [2]
@@ -0,0 +1,43 @@
+import asyncio
+
+from benchmarks.fakes import make_text
+from src.catalog import partition_catalog
+from src.knowledge import DocumentInput, astore_documents, store_documents
+
+
+def test_same_content_in_two_partitions_stores_the_first_only():
+    text = make_text(300, seed=11)
+    results = store_documents(
+        [
+            DocumentInput(text, "chemistry:shared"),
+            DocumentInput(text, "physics:shared"),
+            DocumentInput(text, "chemistry:shared", chunk_size=64),
+            DocumentInput(text, "physics:shared", chunk_size=64),
+        ]
+    )
+
+    document_id = results[0]["document_id"]
+    assert results[0] == {"document_id": document_id, "error": None}
+    assert results[1] == {
+        "document_id": None,
+        "error": "A document with the same content is stored under "
+        "chemistry:shared in this batch",
+    }
+    assert results[2] == results[0]
+    assert results[3] == results[1]
+    assert partition_catalog.document_ids("chemistry:shared") == [document_id]
+    assert not partition_catalog.exists("physics:shared")
+
+
+def test_async_batch_reports_the_collapsed_document():
+    text = make_text(300, seed=12)
+    results = asyncio.run(
+        astore_documents(
+            [DocumentInput(text, "biology:a"), DocumentInput(text, "biology:b")]
+        )
+    )
+
+    assert results[0]["error"] is None
+    assert results[1]["document_id"] is None
+    assert partition_catalog.exists("biology:a")
+    assert not partition_catalog.exists("biology:b")
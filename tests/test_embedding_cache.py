@@ -0,0 +1,44 @@
+import random
+
+from src.embedding_cache import EmbeddingCache
+
+
+def make_vectors(count: int, model: str = "model"):
+    rng = random.Random(0)
+    return {
+        EmbeddingCache.key(model, f"text {i}"): [rng.random() for _ in range(8)]
+        for i in range(count)
+    }
+
+
+def test_both_levels_return_the_same_vectors(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    vectors = make_vectors(10)
+    stored = EmbeddingCache(path).put_many(vectors)
+    assert stored != vectors
+
+    memory = EmbeddingCache(path)
+    memory.put_many(vectors)
+    disk = EmbeddingCache(path)
+    assert memory.get_many(list(vectors)) == stored
+    assert disk.get_many(list(vectors)) == stored
+    assert memory.get_stats()["memory_hits"] == 10
+    assert disk.get_stats()["disk_hits"] == 10
+
+
+def test_missing_keys_are_read_with_one_query_per_batch(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    vectors = {**make_vectors(1200), **make_vectors(5, model="other")}
+    EmbeddingCache(path).put_many(vectors)
+
+    cache = EmbeddingCache(path)
+    queries = []
+    # pylint: disable-next=protected-access
+    cache._get_connection().set_trace_callback(queries.append)
+    keys = list(vectors) + [EmbeddingCache.key("model", "not stored")]
+    found = cache.get_many(keys)
+
+    assert len(found) == len(vectors)
+    # 1201 keys of the first model in batches of 500, and 5 of the second one
+    assert len([query for query in queries if query.startswith("SELECT")]) == 4
+    assert cache.get_stats()["misses"] == 1
@@ -0,0 +1,61 @@
+import asyncio
+
+from benchmarks.fakes import make_text
+from src.database import run_in_session
+from src.files import insert_files, iter_files, list_files
+
+
+def _insert(partition, count):
+    rows = [
+        {"filename": str(index), "partition": partition, "content": make_text(30)}
+        for index in range(count)
+    ]
+    asyncio.run(run_in_session(insert_files, rows))
+
+
+def _pages(partition, limit, include_content=False):
+    pages, after = [], None
+    while True:
+        files, after = asyncio.run(
+            run_in_session(
+                list_files,
+                after=after,
+                limit=limit,
+                partition=partition,
+                include_content=include_content,
+            )
+        )
+        pages.append(files)
+        if after is None:
+            return pages
+
+
+def test_keyset_pages_have_no_gaps_or_repeats():
+    _insert("paging-a", 23)
+    _insert("paging-b", 5)
+    _insert("paging-a", 2)
+
+    pages = _pages("paging-a", limit=10)
+
+    assert [len(files) for files in pages] == [10, 10, 5]
+    ids = [file["id"] for files in pages for file in files]
+    assert ids == sorted(set(ids))
+    assert {file["partition"] for files in pages for file in files} == {"paging-a"}
+    assert all("content" not in file for files in pages for file in files)
+
+
+def test_a_full_last_page_has_no_next_cursor():
+    _insert("paging-c", 6)
+
+    assert [len(files) for files in _pages("paging-c", limit=3)] == [3, 3]
+
+
+def test_pages_and_streams_hold_the_same_contents():
+    _insert("paging-d", 7)
+
+    listed = [file for files in _pages("paging-d", 4, True) for file in files]
+    batches = iter_files(partition="paging-d", batch_size=3)
+    streamed = [file for batch in batches for file in batch]
+
+    assert streamed == listed
+    assert all(file["content"] == make_text(30) for file in listed)
@@ -0,0 +1,59 @@
+from canopy.knowledge_base.models import (
+    DocumentWithScore,
+    KBDocChunkWithScore,
+    QueryResult,
+)
+
+from src.context import PackingContextBuilder
+from src.hierarchy import assemble, chunk_metadata
+
+SIZES = [16, 32]
+
+
+def _hit(index):
+    start = index * 16
+    return KBDocChunkWithScore(
+        id=f"doc-16-{index}",
+        text=" ".join(f"w{token}" for token in range(start, start + 16)) + " ",
+        document_id="doc",
+        score=1.0 - index / 10,
+        metadata=chunk_metadata({}, 0, 16, start, start + 16),
+    )
+
+
+def _fetch(ids):
+    chunks = {}
+    for chunk_id in ids:
+        index = int(chunk_id.rsplit("-", 1)[1])
+        start = index * 32
+        chunks[chunk_id] = {
+            "text": " ".join(f"w{token}" for token in range(start, start + 32)) + " ",
+            **chunk_metadata({}, 1, 32, start, start + 32),
+        }
+    return chunks
+
+
+def test_adjacent_hits_are_not_merged_past_the_largest_chunk_size():
+    documents = assemble([_hit(index) for index in range(4)], SIZES, _fetch)
+
+    assert [document.id for document in documents] == ["doc-32-0", "doc-32-1"]
+    assert all(document.metadata["token_count"] == 32 for document in documents)
+
+
+def test_small_budget_still_gets_a_context():
+    documents = assemble([_hit(index) for index in range(4)], SIZES, _fetch)
+    result = QueryResult(
+        query="w1",
+        documents=[
+            DocumentWithScore(**document.model_dump(exclude={"document_id"}))
+            for document in documents
+        ],
+    )
+
+    context = PackingContextBuilder().build([result], max_context_tokens=40)
+
+    snippets = [
+        snippet for query in context.content.root for snippet in query.snippets
+    ]
+    assert [snippet.id for snippet in snippets] == ["doc-32-0"]
+    assert context.num_tokens == 32
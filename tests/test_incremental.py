@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.fakes import make_text
+from src.knowledge import TokenLengthChunker, update_document
+from src.partition import PartitionedDocument
+
+
+@pytest.mark.parametrize("chunk_size", [0, 64])
+def test_edit_near_the_start_only_embeds_its_section(chunk_size):
+    partition_name = f"physics:large_page_{chunk_size}"
+    text = make_text(20000, seed=1)
+    stored = update_document(text, partition_name, chunk_size)
+    total = stored["embedded"]
+
+    # Rewrite the second sentence of the document
+    sentences = text.split(". ")
+    sentences[1] = "An edited sentence about a different subject"
+    edited = ". ".join(sentences)
+    updated = update_document(edited, partition_name, chunk_size)
+
+    # Only the chunks of the edited section, out of hundreds, are embedded again
+    assert total > 300
+    assert 0 < updated["embedded"] <= total // 20
+    assert updated["deleted"] <= total // 20
+
+
+def test_keyed_chunks_join_back_into_the_document():
+    chunker = TokenLengthChunker()
+    document = PartitionedDocument(
+        "physics:page", make_text(5000, seed=2) + "\n" + make_text(800, seed=3), True
+    )
+    chunks = chunker.chunk_keyed_document(document)
+
+    assert "".join(chunker.sections(document.text)) == document.text
+    assert len({chunk.id for chunk in chunks}) == len(chunks)
+    for chunk in chunks:
+        size, start = chunk.metadata["chunk_size"], chunk.metadata["token_start"]
+        assert start % size == 0
+        assert chunk.id == f"{document.id}-{size}-{start // size}"
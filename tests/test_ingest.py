@@ -0,0 +1,65 @@
+import asyncio
+
+from benchmarks.fakes import make_text
+from src import ingest
+from src.database import run_in_session
+from src.files import insert_files
+
+
+def _recording_insert(batches, failing=()):
+    def insert(db, rows):
+        batches.append([row["partition"] for row in rows])
+        if any(row["partition"] in failing for row in rows):
+            raise RuntimeError("The database is down")
+        return insert_files(db, rows)
+
+    return insert
+
+
+def _row(title):
+    return {"filename": "1", "partition": title, "content": make_text(20)}
+
+
+def test_file_writer_inserts_full_batches(monkeypatch):
+    batches = []
+    insert = _recording_insert(batches, failing={"Writer 6"})
+    monkeypatch.setattr(ingest, "insert_files", insert)
+    job = ingest.IngestJob(pages=[])
+    writer = ingest._FileWriter(job, batch_size=5)  # pylint: disable=protected-access
+    titles = [f"Writer {index}" for index in range(12)]
+
+    async def write():
+        for title in titles:
+            await writer.add(title, _row(title))
+        assert len(batches) == 2
+        await writer.flush()
+
+    asyncio.run(write())
+
+    assert batches == [titles[:5], titles[5:10], titles[10:]]
+    assert job.added == titles[:5] + titles[10:]
+    assert job.errors == {title: "The database is down" for title in titles[5:10]}
+
+
+def test_rows_of_a_partial_batch_are_inserted_when_the_job_ends(monkeypatch):
+    batches = []
+    monkeypatch.setattr(ingest, "insert_files", _recording_insert(batches))
+    monkeypatch.setattr(ingest.wiki_client, "lookup_revisions", lambda pages: {})
+
+    def fetch_wiki_data(page, should_filter=True, revid=None):
+        if page == "Job 3":
+            raise ValueError(f"The Wikipedia page {page} does not exist")
+        return {"content": make_text(50, seed=len(page)), "partition_name": f"{page}:1"}
+
+    monkeypatch.setattr(ingest, "fetch_wiki_data", fetch_wiki_data)
+    titles = [f"Job {index}" for index in range(7)]
+
+    job = asyncio.run(ingest.run_job(ingest.IngestJob(pages=titles)))
+
+    stored = [title for title in titles if title != "Job 3"]
+    assert job.status == "completed"
+    assert sorted(job.added) == stored
+    assert list(job.errors) == ["Job 3"]
+    assert [sorted(batch) for batch in batches] == [stored]
+    present = ingest._find_present  # pylint: disable=protected-access
+    assert asyncio.run(run_in_session(present, titles)) == set(stored)
@@ -0,0 +1,17 @@
+from src.loader import Checkpoint, ChunkedFile, iter_sources
+
+
+def test_checkpoint_keys_depend_on_the_expert_and_chunk_size(tmp_path):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    (corpus / "page.txt").write_text("Some text.", encoding="utf-8")
+    [source] = iter_sources([str(corpus)], "physics", 0)
+
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.jsonl"))
+    checkpoint.add([ChunkedFile(source, "physics:page.txt", "id", [])])
+    checkpoint.close()
+    done = Checkpoint(str(tmp_path / "checkpoint.jsonl")).done
+
+    assert next(iter_sources([str(corpus)], "physics", 0)).key in done
+    assert next(iter_sources([str(corpus)], "physics", 256)).key not in done
+    assert next(iter_sources([str(corpus)], "chemistry", 0)).key not in done
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from src.local_index import LocalIndex, matches_filter
+
+DIMENSION = 16
+
+FILTERS = [
+    None,
+    {"expert_name": "physics"},
+    {"expert_name": {"$in": ["physics", "chemistry"]}, "chunk_level": 0},
+    {"document_name": "page-3", "chunk_level": {"$ne": 0}},
+    {"expert_name": {"$nin": ["biology"]}, "document_id": {"$ne": "doc-1"}},
+    {"expert_name": "astronomy"},
+]
+
+
+def _records(rng, count, offset=0):
+    experts = ["physics", "chemistry", "biology"]
+    return [
+        {
+            "id": f"chunk-{offset + index}",
+            "values": rng.standard_normal(DIMENSION).tolist(),
+            "metadata": {
+                "expert_name": experts[index % 3],
+                "document_name": f"page-{index % 7}",
+                "document_id": f"doc-{index % 5}",
+                "chunk_level": index % 2,
+            },
+        }
+        for index in range(count)
+    ]
+
+
+def _brute_force(records, vector, top_k, metadata_filter):
+    scored = [
+        (float(np.dot(np.float32(record["values"]), np.float32(vector))), record["id"])
+        for record in records.values()
+        if matches_filter(record["metadata"], metadata_filter)
+    ]
+    return [record_id for _, record_id in sorted(scored, reverse=True)[:top_k]]
+
+
+def _build(index, rng):
+    # More records than the initial capacity, some replaced and some deleted
+    records = {record["id"]: record for record in _records(rng, 1500)}
+    index.upsert(list(records.values()))
+    index.upsert(list(records.values())[:1000], namespace="other")
+
+    replaced = _records(rng, 200)
+    index.upsert(replaced)
+    records.update({record["id"]: record for record in replaced})
+
+    deleted = [f"chunk-{index}" for index in range(100, 400, 3)]
+    index.delete(ids=deleted)
+    for record_id in deleted:
+        del records[record_id]
+    index.delete(filter={"document_name": "page-6"})
+    records = {
+        record_id: record
+        for record_id, record in records.items()
+        if record["metadata"]["document_name"] != "page-6"
+    }
+
+    added = _records(rng, 50, offset=2000)
+    index.upsert(added)
+    records.update({record["id"]: record for record in added})
+    return records
+
+
+@pytest.mark.parametrize("metadata_filter", FILTERS)
+def test_queries_match_brute_force(metadata_filter):
+    rng = np.random.default_rng(7)
+    index = LocalIndex()
+    records = _build(index, rng)
+    vectors = rng.standard_normal((3, DIMENSION)).tolist()
+
+    results = index.query_batch(vectors, top_k=10, filter=metadata_filter)
+
+    for vector, result in zip(vectors, results):
+        expected = _brute_force(records, vector, 10, metadata_filter)
+        assert [match["id"] for match in result["matches"]] == expected
+        for match in result["matches"]:
+            assert match["metadata"] == records[match["id"]]["metadata"]
+
+
+def test_top_k_larger_than_the_candidates_returns_them_all():
+    rng = np.random.default_rng(8)
+    index = LocalIndex()
+    records = _build(index, rng)
+    metadata_filter = {"document_name": "page-2", "document_id": "doc-3"}
+    vector = rng.standard_normal(DIMENSION).tolist()
+
+    matches = index.query(vector, top_k=1000, filter=metadata_filter)["matches"]
+
+    expected = _brute_force(records, vector, 1000, metadata_filter)
+    assert 0 < len(expected) < 1000
+    assert [match["id"] for match in matches] == expected
+
+
+def test_stored_index_is_reloaded(tmp_path):
+    rng = np.random.default_rng(9)
+    index = LocalIndex(str(tmp_path))
+    records = _build(index, rng)
+    vector = rng.standard_normal(DIMENSION).tolist()
+    index.close()
+
+    reloaded = LocalIndex(str(tmp_path))
+    matches = reloaded.query(vector, top_k=10, filter={"chunk_level": 1})["matches"]
+    stats = reloaded.describe_index_stats()
+    reloaded.close()
+
+    expected = _brute_force(records, vector, 10, {"chunk_level": 1})
+    assert [match["id"] for match in matches] == expected
+    assert stats["namespaces"][""]["vector_count"] == len(records)
@@ -0,0 +1,70 @@
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.concurrency import run_blocking
+from src.metrics import (
+    TRACE_HEADER,
+    Histogram,
+    TracingMiddleware,
+    current_trace_id,
+    stage,
+    with_trace,
+)
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test durations.", "stage", (0.1, 1.0))
+    for seconds in [0.05, 0.5, 0.5, 3.0]:
+        histogram.observe('say "hi"', seconds)
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test durations.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="say \\"hi\\"",le="0.1"} 1',
+        'test_seconds_bucket{stage="say \\"hi\\"",le="1"} 3',
+        'test_seconds_bucket{stage="say \\"hi\\"",le="+Inf"} 4',
+        'test_seconds_sum{stage="say \\"hi\\""} 4.050000',
+        'test_seconds_count{stage="say \\"hi\\""} 4',
+    ]
+
+
+def _blocking_stage():
+    with stage("test_blocking"):
+        time.sleep(0.002)
+    return current_trace_id()
+
+
+def test_requests_report_their_trace_and_stages():
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/traced")
+    async def traced_endpoint():
+        with stage("test_async"):
+            thread_trace_id = await run_blocking(_blocking_stage)
+        return {"trace_id": current_trace_id(), "thread_trace_id": thread_trace_id}
+
+    client = TestClient(app)
+    response = client.get("/traced", headers={TRACE_HEADER: "trace-1"})
+    generated = client.get("/traced")
+
+    assert response.json() == {"trace_id": "trace-1", "thread_trace_id": "trace-1"}
+    assert response.headers[TRACE_HEADER] == "trace-1"
+    timing = response.headers["Server-Timing"]
+    assert [part.split(";")[0] for part in timing.split(", ")] == [
+        "test_blocking",
+        "test_async",
+    ]
+    assert generated.headers[TRACE_HEADER] not in ("", "trace-1")
+    assert generated.json()["trace_id"] == generated.headers[TRACE_HEADER]
+
+
+def test_work_outside_of_requests_gets_its_own_trace():
+    traced = with_trace(current_trace_id)
+
+    first, second = traced(), traced()
+
+    assert current_trace_id() is None
+    assert first and second and first != second
@@ -0,0 +1,65 @@
+import threading
+
+from src.pool import KnowledgeBasePool
+
+
+class FakeKnowledgeBase:
+    """A knowledge base whose connection check waits for `release` if it is slow."""
+
+    def __init__(self, release: threading.Event, slow: bool):
+        self.release = release
+        self.slow = slow
+        self.healthy = True
+
+    def verify_index_connection(self) -> None:
+        if self.slow:
+            self.release.wait()
+        if not self.healthy:
+            raise RuntimeError("Connection lost")
+
+
+def make_pool(release: threading.Event) -> KnowledgeBasePool:
+    def factory(index_name: str, chunk_size: int):
+        return FakeKnowledgeBase(release, slow=index_name == "slow")
+
+    # Every request checks the connection of its entry
+    return KnowledgeBasePool(factory, health_check_interval=0.0)
+
+
+def test_slow_health_check_does_not_block_other_keys():
+    release = threading.Event()
+    pool = make_pool(release)
+    pool.get_knowledge_base("slow")
+    pool.get_knowledge_base("fast")
+
+    slow = threading.Thread(target=pool.get_knowledge_base, args=("slow",))
+    slow.start()
+    try:
+        fast = threading.Thread(target=pool.get_knowledge_base, args=("fast",))
+        fast.start()
+        fast.join(timeout=1.0)
+        assert not fast.is_alive()
+        assert slow.is_alive()
+    finally:
+        release.set()
+        slow.join()
+
+
+def test_broken_entry_is_reconnected_once():
+    release = threading.Event()
+    pool = make_pool(release)
+    first = pool.get_knowledge_base("index")
+    first.healthy = False
+
+    threads = [
+        threading.Thread(target=pool.get_knowledge_base, args=("index",))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert pool.get_knowledge_base("index") is not first
+    assert pool.get_stats()["reconnected"] == 1
+    assert pool.get_stats()["created"] == 2
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from src.scheduler import Overloaded, PartitionWrites, WorkPool
+from src.server import overloaded_handler
+
+
+def test_full_queue_is_rejected_with_a_429():
+    pool = WorkPool("test", concurrency=1, max_queue=1)
+    events = []
+
+    async def request(name, reject=True):
+        async with pool.admit(reject=reject):
+            events.append(name)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        running = asyncio.create_task(request("running"))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(request("queued"))
+        await asyncio.sleep(0)
+        assert pool.stats()["running"] == 1
+        assert pool.stats()["waiting"] == 1
+
+        with pytest.raises(Overloaded) as overloaded:
+            await request("rejected")
+        # Background work waits for its slot instead
+        await asyncio.gather(running, queued, request("background", reject=False))
+        return overloaded.value
+
+    overloaded = asyncio.run(main())
+
+    assert events == ["running", "queued", "background"]
+    assert pool.stats()["running"] == pool.stats()["waiting"] == 0
+    response = asyncio.run(overloaded_handler(None, overloaded))
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) == overloaded.retry_after >= 1
+
+
+def test_identical_writes_share_the_first_one():
+    writes = PartitionWrites()
+    calls = []
+
+    async def store(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name
+
+    async def main():
+        return await asyncio.gather(
+            writes.run("physics:page", "same", lambda: store("first")),
+            writes.run("physics:page", "same", lambda: store("second")),
+            writes.run("physics:page", "other", lambda: store("other")),
+        )
+
+    assert asyncio.run(main()) == ["first", "first", "other"]
+    assert calls == ["first", "other"]
+    assert writes.pending() == 0
+
+
+def test_writes_to_a_partition_are_serialized():
+    writes = PartitionWrites()
+    events = []
+
+    async def store(name):
+        events.append(f"{name} started")
+        await asyncio.sleep(0.01)
+        events.append(f"{name} done")
+
+    async def main():
+        await asyncio.gather(
+            *(
+                writes.run(partition, name, lambda name=name: store(name))
+                for name, partition in [
+                    ("a", "physics:page"),
+                    ("b", "physics:page"),
+                    ("c", "chemistry:page"),
+                ]
+            )
+        )
+
+    asyncio.run(main())
+
+    assert events.index("b started") > events.index("a done")
+    assert events.index("c started") < events.index("a done")
+
+
+def test_a_failed_write_fails_the_writes_that_share_it():
+    writes = PartitionWrites()
+
+    async def store():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("The index is down")
+
+    async def main():
+        return await asyncio.gather(
+            writes.run("physics:page", "same", store),
+            writes.run("physics:page", "same", store),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+
+    assert [str(result) for result in results] == ["The index is down"] * 2
@@ -0,0 +1,202 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from src.wiki_client import WikiPage, WikipediaClient, WikiResponseCache
+
+
+class StubWikipedia(BaseHTTPRequestHandler):
+    """A stub of the Wikipedia API that serves the pages of its server."""
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        params = {
+            name: values[0]
+            for name, values in parse_qs(
+                urlparse(self.path).query, keep_blank_values=True
+            ).items()
+        }
+        server.requests.append(params)
+
+        if server.failures:
+            status = server.failures.pop(0)
+            if status is None:
+                # A response slower than the read timeout of the client
+                time.sleep(server.delay)
+            else:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        if params["action"] == "query":
+            body = {"query": self._query(params["titles"].split("|"))}
+        else:
+            revid = int(params["oldid"])
+            title = server.titles[revid]
+            body = {
+                "parse": {
+                    "title": title,
+                    "pageid": revid // 100,
+                    "revid": revid,
+                    "text": {"*": f"<p>{title} at revision {revid}</p>"},
+                }
+            }
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _query(self, titles):
+        server = self.server
+        normalized = [
+            {"from": title, "to": title.replace("_", " ")}
+            for title in titles
+            if "_" in title
+        ]
+        titles = [title.replace("_", " ") for title in titles]
+        redirects = [
+            {"from": title, "to": server.redirects[title]}
+            for title in titles
+            if title in server.redirects
+        ]
+        titles = [server.redirects.get(title, title) for title in titles]
+
+        pages = {}
+        for index, title in enumerate(titles):
+            if title in server.revisions:
+                pages[str(index)] = {
+                    "title": title,
+                    "revisions": [{"revid": server.revisions[title]}],
+                }
+            else:
+                pages[str(-index - 1)] = {"title": title, "missing": ""}
+        return {"normalized": normalized, "redirects": redirects, "pages": pages}
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubWikipedia)
+    server.daemon_threads = True
+    server.requests = []
+    server.failures = []
+    server.delay = 0.0
+    server.redirects = {"Gravitation": "Gravity"}
+    server.revisions = {"Gravity": 1001, "Light": 2001}
+    server.titles = {1001: "Gravity", 2001: "Light"}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/w/api.php"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, cache=None, **kwargs):
+    return WikipediaClient(api_url=server.url, cache=cache, backoff_factor=0, **kwargs)
+
+
+def _actions(server):
+    return [params["action"] for params in server.requests]
+
+
+def test_server_errors_are_retried(server):
+    server.failures = [503, 429]
+
+    page = _client(server).fetch_page("Light")
+
+    assert page.revid == 2001
+    assert _actions(server) == ["query", "query", "query", "parse"]
+
+
+def test_slow_responses_time_out_and_are_retried(server):
+    server.failures = [None]
+    server.delay = 1.0
+
+    start = time.perf_counter()
+    page = _client(server, timeout=0.2).fetch_page("Light")
+
+    assert page.revid == 2001
+    assert time.perf_counter() - start < server.delay
+    assert _actions(server) == ["query", "query", "parse"]
+
+
+def test_a_request_fails_once_its_retries_are_spent(server):
+    server.failures = [None, None]
+    server.delay = 0.5
+
+    with pytest.raises(requests.RequestException):
+        _client(server, timeout=0.1, retries=1).get_revisions(["Light"])
+
+
+def test_revisions_follow_normalizations_and_redirects(server):
+    revisions = _client(server).get_revisions(["Gravitation", "Light", "Dark_matter"])
+
+    assert revisions == {"Gravitation": 1001, "Light": 2001}
+
+
+def test_revisions_are_looked_up_fifty_pages_at_a_time(server):
+    pages = [f"Page {index}" for index in range(120)]
+    server.revisions.update({page: 5000 + index for index, page in enumerate(pages)})
+
+    revisions = _client(server).lookup_revisions(pages + ["Light", pages[0]])
+
+    expected = {page: server.revisions[page] for page in pages}
+    assert revisions == {**expected, "Light": 2001}
+    assert [len(params["titles"].split("|")) for params in server.requests] == [
+        50,
+        50,
+        21,
+    ]
+
+
+def test_unchanged_revisions_are_read_from_the_cache(server, tmp_path):
+    client = _client(server, cache=WikiResponseCache(str(tmp_path)))
+
+    first = client.fetch_page("Gravity")
+    second = client.fetch_page("Gravity")
+    assert second == first
+    assert _actions(server) == ["query", "parse", "query"]
+
+    # A new revision of the page is downloaded
+    server.revisions["Gravity"] = 1002
+    server.titles[1002] = "Gravity"
+    assert client.fetch_page("Gravity").revid == 1002
+    assert _actions(server)[-2:] == ["query", "parse"]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    pages = {
+        title: WikiPage(title=title, pageid=index, revid=index, html="x" * 1000)
+        for index, title in enumerate(["Gravity", "Light", "Sound"])
+    }
+    entry_size = len(json.dumps(vars(pages["Gravity"])))
+    cache = WikiResponseCache(str(tmp_path), max_bytes=2 * entry_size + 10)
+
+    now = time.time()
+    for age, title in zip([20, 10], ["Gravity", "Light"]):
+        cache.put(title, pages[title])
+        # pylint: disable-next=protected-access
+        path = cache._file(title, pages[title].revid)
+        os.utime(path, (now - age, now - age))
+
+    # Reading Gravity makes Light the least recently used entry
+    assert cache.get("Gravity", 0) == pages["Gravity"]
+    cache.put("Sound", pages["Sound"])
+
+    assert cache.get("Light", 1) is None
+    assert cache.get("Gravity", 0) == pages["Gravity"]
+    assert cache.get("Sound", 2) == pages["Sound"]
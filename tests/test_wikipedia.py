@@ -0,0 +1,13 @@
+import pytest
+
+from benchmarks.fakes import make_html
+from benchmarks.wikipedia import legacy_extract_text
+from src.wikipedia import extract_text
+
+
+@pytest.mark.parametrize("should_filter", [True, False])
+def test_streaming_extraction_matches_the_previous_text(should_filter):
+    raw_html = make_html(30, seed=4)
+
+    expected = legacy_extract_text(raw_html, should_filter=should_filter)
+    assert extract_text(raw_html, should_filter=should_filter) == expected